@@ -1,7 +1,9 @@
-from redis import Redis
 from jamboree.base.processors.abstracts import Processor
+from jamboree.base.processors.connections import ConnectionManager
 from jamboree.base.processors.event import JamboreeEvents
 from jamboree.base.processors.files import JamboreeFileProcessor
+from jamboree.storage.databases.retention import RetentionCompactor
+from jamboree.utils.helper import Helpers
 
 class Jamboree(Processor):
     def __init__(self, **kwargs) -> None:
@@ -10,8 +12,20 @@ class Jamboree(Processor):
         redis_host = kwargs.get("REDIS_HOST", "localhost")
         redis_port = int(kwargs.get("REDIS_PORT", "6379"))
         mongo_host = kwargs.get("MONGO_HOST", "localhost")
-        rconn = Redis(host=redis_host, port=redis_port)
-        # redis.Redis(redis_host, port=redis_port)
+        write_mode = kwargs.get("WRITE_MODE", "lock")
+        layout = kwargs.get("LAYOUT", "dual")
+        read_mode = kwargs.get("READ_MODE", "watch")
+        compact_interval = kwargs.get("COMPACT_INTERVAL", None)
+        client_cache = kwargs.get("CLIENT_CACHE", False)
+        backend = kwargs.get("BACKEND", "redis")
+        if "KEY_SCHEME" in kwargs:
+            # Process wide. Every helper resolves keys the same way.
+            Helpers.set_key_scheme(
+                kwargs["KEY_SCHEME"], lookup=kwargs.get("KEY_LOOKUP", True)
+            )
+        # Pool sizes, timeouts and keepalive come from the REDIS_* kwargs. See `ConnectionManager.from_settings`.
+        self.connections = ConnectionManager.from_settings(kwargs)
+        rconn = self.connections.client("events")
 
         self.event = JamboreeEvents(
             mongodb_host=mongo_host,
@@ -21,8 +35,45 @@ class Jamboree(Processor):
 
         # Set the files management here
         self.storage = JamboreeFileProcessor()
-        self.storage.rconn = rconn
+        self.storage.rconn = self.connections.client("storage")
         self.event.rconn = rconn
+        self.event.backend = backend
+        self.event.sqlite_path = kwargs.get("SQLITE_PATH", "jamboree.db")
         self.event.initialize()
+        self.event.redis_conn.write_mode = write_mode
+        self.event.redis_conn.layout = layout
+        self.event.redis_conn.read_mode = read_mode
+        self.compactor = None
+        if compact_interval is not None:
+            self.compactor = RetentionCompactor(
+                self.event.redis_conn, interval=float(compact_interval)
+            )
+            self.compactor.start()
+        if "TIER_PATH" in kwargs:
+            # Events older than the hot window (relative seconds) move to columnar files
+            self.event.enable_tiering(
+                kwargs["TIER_PATH"],
+                hot_window=float(kwargs.get("HOT_WINDOW", 86400)),
+                interval=kwargs.get("SPILL_INTERVAL", None),
+            )
+        if client_cache:
+            # Latest-value reads are served in process until redis says the key changed.
+            self.event.enable_cache(
+                max_size=int(kwargs.get("CLIENT_CACHE_SIZE", 10000)),
+                ttl=kwargs.get("CLIENT_CACHE_TTL", None),
+                mode=kwargs.get("CLIENT_CACHE_MODE", "auto"),
+            )
+        if "WRITE_BUFFER_SIZE" in kwargs:
+            # Saves are coalesced per key and written as one append per batch
+            self.event.buffered(
+                max_events=int(kwargs["WRITE_BUFFER_SIZE"]),
+                max_latency=float(kwargs.get("WRITE_BUFFER_LATENCY", 0.05)),
+            )
+        if "EXECUTOR_WORKERS" in kwargs or "EXECUTOR_QUEUE" in kwargs:
+            # Process wide. Has to be set before the first background task.
+            self.executor.configure(
+                max_workers=kwargs.get("EXECUTOR_WORKERS", None),
+                max_queue=kwargs.get("EXECUTOR_QUEUE", None),
+            )
         self.storage.initialize()
-        self.rconn = rconn
\ No newline at end of file
+        self.rconn = self.connections.client("search")
\ No newline at end of file
@@ -1,5 +1,5 @@
 from abc import ABC
-from typing import List
+from typing import Callable, List, Optional
 
 
 class EventProcessor(ABC):
@@ -26,6 +26,50 @@ class EventProcessor(ABC):
         raise NotImplementedError
 
 
+    def get_between_frame(self, query:dict, min_epoch:float, max_epoch:float, abs_rel:str="relative"):
+        raise NotImplementedError
+
+
+    def get_all_frame(self, query:dict):
+        raise NotImplementedError
+
+
+    def update_rollups(self, query:dict, min_epoch:float, max_epoch:float):
+        raise NotImplementedError
+
+
+    def rebuild_rollups(self, query:dict):
+        raise NotImplementedError
+
+
+    def get_rollups_between(self, query:dict, min_epoch:float, max_epoch:float, tiers:List[str]):
+        raise NotImplementedError
+
+
+    def spill(self, query:Optional[dict]=None) -> int:
+        raise NotImplementedError
+
+
+    def buffered(self, max_events:int=1000, max_latency:Optional[float]=0.05):
+        raise NotImplementedError
+
+
+    def unbuffered(self):
+        raise NotImplementedError
+
+
+    def batch(self, watch:Optional[List[dict]]=None):
+        raise NotImplementedError
+
+
+    def transaction(self, step:Callable, watch:Optional[List[dict]]=None, retries:int=10):
+        raise NotImplementedError
+
+
+    def get_between_many(self, queries:List[dict], min_epoch, max_epoch, abs_rel:str="absolute") -> dict:
+        raise NotImplementedError
+
+
     def get_latest_by(self, query:dict, max_epoch, abs_rel="absolute", limit:int=10) -> dict:
         raise NotImplementedError
     
@@ -33,9 +77,31 @@ class EventProcessor(ABC):
     def get_all(self, query:dict, abs_rel:str="relative"):
         raise NotImplementedError
 
+    def iter_between(self, query:dict, min_epoch, max_epoch, abs_rel:str="absolute", chunk_size:int=1000):
+        raise NotImplementedError
+
+    def iter_all(self, query:dict, abs_rel:str="relative", chunk_size:int=1000):
+        raise NotImplementedError
+
+    def delete_all_many(self, queries: List[dict]):
+        raise NotImplementedError
+
+    def set_retention(self, entity: str, max_len: int = 0, max_age: float = 0.0, age_by: str = "relative"):
+        raise NotImplementedError
+
+
+    def set_codec(self, entity: str, codec: str = "json", fields: Optional[dict] = None):
+        raise NotImplementedError
+
+    def compact(self) -> int:
+        raise NotImplementedError
+
     def count(self, query: dict) -> int:
         raise NotImplementedError
 
+    def stats(self, query: dict) -> dict:
+        raise NotImplementedError
+
 
     def remove_first(self, query: dict):
         raise NotImplementedError
@@ -61,4 +127,56 @@ class EventProcessor(ABC):
         raise NotImplementedError
 
     def lock(self, query):
-        raise NotImplementedError
\ No newline at end of file
+        raise NotImplementedError
+
+    def save_chunked(self, query: dict, frame):
+        raise NotImplementedError
+
+    def get_chunked_between(self, query: dict, min_epoch: float, max_epoch: float, abs_rel: str = "relative"):
+        raise NotImplementedError
+
+    def get_chunked_latest_by(self, query: dict, max_epoch: float) -> dict:
+        raise NotImplementedError
+
+    def get_chunked_latest(self, query: dict) -> dict:
+        raise NotImplementedError
+
+    def get_chunked_all(self, query: dict):
+        raise NotImplementedError
+
+    def iter_chunked_between(self, query: dict, min_epoch: float, max_epoch: float, abs_rel: str = "relative"):
+        raise NotImplementedError
+
+    def stats_chunked(self, query: dict) -> dict:
+        raise NotImplementedError
+
+    def count_chunked(self, query: dict) -> int:
+        raise NotImplementedError
+
+    def delete_chunked(self, query: dict):
+        raise NotImplementedError
+
+    async def asave(self, query: dict, data: dict):
+        raise NotImplementedError
+
+    async def asave_many(self, query: dict, data: List[dict]):
+        raise NotImplementedError
+
+    async def aupdate_rollups(self, query: dict, min_epoch: float, max_epoch: float):
+        raise NotImplementedError
+
+    async def aget_latest(self, query: dict, abs_rel="absolute"):
+        raise NotImplementedError
+
+    async def aget_latest_many(self, query: dict, limit=1000, abs_rel="absolute"):
+        raise NotImplementedError
+
+    async def aget_between(self, query: dict, min_epoch: float, max_epoch: float, abs_rel: str = "absolute"):
+        raise NotImplementedError
+
+    async def acount(self, query: dict) -> int:
+        raise NotImplementedError
+
+    async def astats(self, query: dict) -> dict:
+        raise NotImplementedError
+
@@ -1,6 +1,7 @@
 from abc import ABC
-from typing import List, Optional
+from typing import Callable, List, Optional
 from jamboree.base.processors.abstracts import EventProcessor, FileProcessor, SearchProcessor
+from jamboree.utils.executor import Executor, shared_executor
 
 
 class Processor(ABC):
@@ -9,6 +10,8 @@ class Processor(ABC):
         self._event:Optional[EventProcessor] = None
         self._storage:Optional[FileProcessor] = None
         self._search:Optional[SearchProcessor] = None
+        # Shared by every processor of the process. Threads start on the first submit.
+        self.executor:Executor = shared_executor()
 
     @property
     def event(self) -> EventProcessor:
@@ -38,4 +41,20 @@ class Processor(ABC):
         return self._search
     
     def search(self, _search:SearchProcessor):
-        self._search = self.search
\ No newline at end of file
+        self._search = self.search
+
+    def batch(self, watch:Optional[List[dict]]=None):
+        """ 
+            Send every handler write issued on this thread inside of the block as one MULTI/EXEC pipeline.
+
+            ```
+                with jam.batch(watch=[portfolio.bound()]):
+                    portfolio.save(positions)
+                    trades.save(trade)
+            ```
+        """
+        return self.event.batch(watch=watch)
+
+    def transaction(self, step:Callable, watch:Optional[List[dict]]=None, retries:int=10):
+        """ Run `step` inside of a batch, again and again until no key of the `watch` queries changed before it was sent. """
+        return self.event.transaction(step, watch=watch, retries=retries)
@@ -0,0 +1,106 @@
+"""
+    # Write Buffer
+    ---
+    Coalesces event saves per key and writes each key's batch as one append (a single ZADD pair, or one EVALSHA in script mode).
+
+    Events are encoded exactly like `save` would (with the key's codec), so they're stored as the same members with the same times.
+    A buffer flushes once it holds `max_events` events or its oldest event has waited `max_latency` seconds, on `flush()`, and when the block ends.
+
+    ```
+        with jam.event.buffered(max_events=500, max_latency=0.05):
+            for tick in ticks:
+                handler.save(tick)
+    ```
+
+    Reads and deletes through the processor flush the pending events of their key first, so they always see every save.
+"""
+import threading
+from copy import copy
+from typing import Dict, List, Optional, Tuple
+
+from jamboree.utils.helper import Helpers
+
+
+class WriteBuffer(object):
+    def __init__(self, events, max_events: int = 1000, max_latency: Optional[float] = 0.05) -> None:
+        if max_events < 1:
+            raise ValueError("The buffer has to hold at least one event")
+        self.events = events
+        self.max_events = max_events
+        self.max_latency = max_latency
+        self.helpers = Helpers()
+        self._lock = threading.RLock()
+        self._pending: Dict[str, Tuple[dict, List[Tuple[bytes, float, float]]]] = {}
+        self._size = 0
+        self._timer: Optional[threading.Timer] = None
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add(self, query: dict, data: dict):
+        """ Queue an event. The same as `save(query, data)` once flushed. """
+        if not self.helpers.validate_query(query):
+            return
+        _hash = self.helpers.generate_hash(query)
+        merged = copy(query)
+        merged.update(data)
+        data, timing = self.helpers.separate_time_data(merged)
+        member = self.events.redis_conn.encode(query, data, _hash=_hash)
+        with self._lock:
+            if _hash not in self._pending:
+                self._pending[_hash] = (copy(query), [])
+            self._pending[_hash][1].append((member, timing["time"], timing["timestamp"]))
+            self._size += 1
+            if self._size >= self.max_events:
+                self.flush()
+            elif self._timer is None and self.max_latency is not None:
+                self._timer = threading.Timer(self.max_latency, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _write(self, query: dict, batch: List[Tuple[bytes, float, float]]):
+        try:
+            self.events.redis_conn.save_events(query, batch)
+        finally:
+            self.events._invalidate(query)
+
+    def flush(self) -> int:
+        """ Write every pending event. Returns the number written. """
+        with self._lock:
+            pending, self._pending, self._size = self._pending, {}, 0
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            # Held while writing so a concurrent flush of the same key can't overtake this one
+            for query, batch in pending.values():
+                self._write(query, batch)
+        flushed = sum(len(batch) for _, batch in pending.values())
+        self.events.redis_conn.metrics.incr("buffer.flushes")
+        self.events.redis_conn.metrics.incr("buffer.events", flushed)
+        return flushed
+
+    def flush_key(self, query: dict) -> int:
+        """ Write the pending events of one query only. """
+        with self._lock:
+            if len(self._pending) == 0:
+                return 0
+            _hash = self.helpers.generate_hash(query)
+            if _hash not in self._pending:
+                return 0
+            stored, batch = self._pending.pop(_hash)
+            self._size -= len(batch)
+            self._write(stored, batch)
+        return len(batch)
+
+    def close(self):
+        """ Flush and stop buffering the processor's saves. """
+        self.flush()
+        if self.events.write_buffer is self:
+            self.events.write_buffer = None
+
+    def __enter__(self) -> "WriteBuffer":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
@@ -0,0 +1,219 @@
+"""
+    # Client Side Cache
+    ---
+    Keeps the replies of latest-value reads (`get_latest`, `single_get`) in process, keyed by the storage hash.
+
+    Every hash has a local version stamp. Invalidating a hash bumps its stamp, which makes every entry stored under an older stamp a miss.
+    A read remembers the stamp from before it went to redis, so an invalidation that lands during the read can't be overwritten by a stale reply.
+
+    Invalidations come from one of:
+
+    * `tracking` - redis 6 client tracking, redirected to our own pubsub connection. Keys are tracked one by one:
+      each cache miss reads the watched keys of its hash on a tracking connection first, so redis only tells us about keys we cache.
+    * `keyspace` - keyspace notifications, when the server already has them turned on (`notify-keyspace-events` with K, h, $ and g, or KA).
+    * `local` - writes made through this process only. Entries also expire after `ttl` seconds so other processes' writes show up.
+
+    Every event write and delete rewrites `{hash}:stats`, and single values live under `{hash}:single`. Those two keys are all we listen to.
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+from loguru import logger
+from redis import Redis
+from redis.exceptions import ConnectionError as RedisConnectionError, ResponseError
+
+WATCHED_SUFFIXES = (":stats", ":single")
+
+
+class ReadCache(object):
+    def __init__(self, max_size: int = 10000, ttl: Optional[float] = None) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Tuple[str, Any], Tuple[Any, int, float]]" = OrderedDict()
+        self._versions: Dict[str, int] = {}
+
+    def version(self, _hash: str) -> int:
+        with self._lock:
+            return self._versions.get(_hash, 0)
+
+    def get(self, _hash: str, key: Any) -> Tuple[bool, Any]:
+        """ Returns (hit, value). """
+        with self._lock:
+            entry = self._entries.get((_hash, key))
+            if entry is not None:
+                value, version, stored = entry
+                fresh = version == self._versions.get(_hash, 0) and (
+                    self.ttl is None or time.monotonic() - stored < self.ttl
+                )
+                if fresh:
+                    self._entries.move_to_end((_hash, key))
+                    self.hits += 1
+                    return True, value
+                del self._entries[(_hash, key)]
+            self.misses += 1
+            return False, None
+
+    def put(self, _hash: str, key: Any, value: Any, version: int):
+        """ Store a reply read under `version`. It's dropped if the hash was invalidated since. """
+        with self._lock:
+            if version != self._versions.get(_hash, 0):
+                return
+            self._entries[(_hash, key)] = (value, version, time.monotonic())
+            self._entries.move_to_end((_hash, key))
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, _hash: str):
+        with self._lock:
+            self._versions[_hash] = self._versions.get(_hash, 0) + 1
+
+    def invalidate_key(self, key: str):
+        """ Invalidate the hash behind a redis key we watch. Other keys are ignored. """
+        for suffix in WATCHED_SUFFIXES:
+            if key.endswith(suffix):
+                self.invalidate(key[: -len(suffix)])
+                return
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            # Bump everything so reads that are in flight don't store stale replies
+            for _hash in self._versions:
+                self._versions[_hash] += 1
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class CacheInvalidator(object):
+    """ Listens for changed keys on a dedicated pubsub connection and invalidates the cache. """
+
+    def __init__(self, cache: ReadCache, client: Redis, mode: str = "auto") -> None:
+        if mode not in ["auto", "tracking", "keyspace", "local"]:
+            raise ValueError("The mode must be one of 'auto', 'tracking', 'keyspace' or 'local'")
+        self.cache = cache
+        self.client = client
+        self.requested = mode
+        self.mode = "local"
+        self._pubsub = None
+        self._tracker = None
+        self._tracker_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> str:
+        """ Subscribe with the best mode the server allows. Returns the mode in use. """
+        modes = ["tracking", "keyspace"] if self.requested == "auto" else [self.requested]
+        for mode in modes:
+            if mode == "local":
+                break
+            try:
+                subscribed = getattr(self, f"_subscribe_{mode}")()
+            except (ResponseError, RedisConnectionError, OSError) as e:
+                logger.debug(f"Client cache can't use {mode} invalidation: {e}")
+                self._close()
+                continue
+            if subscribed:
+                self.mode = mode
+                self._thread = threading.Thread(
+                    target=self._run, name="jamboree-cache-invalidator", daemon=True
+                )
+                self._thread.start()
+                return self.mode
+            self._close()
+        self.mode = "local"
+        return self.mode
+
+    def _subscribe_tracking(self) -> bool:
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        self._pubsub = pubsub
+        # Ask for our own id and turn tracking on before subscribing. A subscribed connection can't run either.
+        pubsub.execute_command("CLIENT", "ID")
+        client_id = pubsub.parse_response()
+        # Tracking goes on a connection of our own. A pooled one could be handed to reads we don't cache.
+        pool = self.client.connection_pool
+        tracker = pool.connection_class(**pool.connection_kwargs)
+        self._tracker = tracker
+        tracker.send_command("CLIENT", "TRACKING", "on", "REDIRECT", client_id)
+        tracker.read_response()
+        pubsub.subscribe("__redis__:invalidate")
+        return True
+
+    def track(self, _hash: str):
+        """ Have redis tell us when the watched keys of a hash change. Call it before reading the hash, so a write landing in between still invalidates. """
+        if self.mode != "tracking":
+            return
+        with self._tracker_lock:
+            try:
+                self._tracker.send_command("EXISTS", *[f"{_hash}{suffix}" for suffix in WATCHED_SUFFIXES])
+                self._tracker.read_response()
+            except (RedisConnectionError, OSError) as e:
+                # A reconnected tracker isn't tracking anymore
+                self._fall_back(e)
+
+    def _subscribe_keyspace(self) -> bool:
+        flags = self.client.config_get("notify-keyspace-events").get("notify-keyspace-events", "")
+        if "K" not in flags or not ("A" in flags or all(flag in flags for flag in "h$g")):
+            return False
+        db = self.client.connection_pool.connection_kwargs.get("db", 0)
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        self._pubsub = pubsub
+        pubsub.psubscribe(*[f"__keyspace@{db}__:*{suffix}" for suffix in WATCHED_SUFFIXES])
+        return True
+
+    def _handle(self, message: dict):
+        if self.mode == "tracking":
+            keys = message.get("data")
+            if keys is None:
+                # FLUSHDB/FLUSHALL
+                self.cache.clear()
+                return
+            if not isinstance(keys, list):
+                keys = [keys]
+            for key in keys:
+                self.cache.invalidate_key(key.decode("utf-8") if isinstance(key, bytes) else key)
+            return
+        channel = message.get("channel")
+        channel = channel.decode("utf-8") if isinstance(channel, bytes) else channel
+        self.cache.invalidate_key(channel.split(":", 1)[1])
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                message = self._pubsub.get_message(timeout=1.0)
+            except Exception as e:
+                self._fall_back(e)
+                return
+            if message is not None:
+                self._handle(message)
+
+    def _fall_back(self, error: Exception):
+        """ We can't trust the cache without a listener. Fall back to local invalidation with a short ttl. """
+        logger.exception(error)
+        self.mode = "local"
+        if self.cache.ttl is None:
+            self.cache.ttl = 1.0
+        self.cache.clear()
+
+    def _close(self):
+        if self._pubsub is not None:
+            try:
+                self._pubsub.close()
+            except Exception:
+                pass
+        self._pubsub = None
+        if self._tracker is not None:
+            self._tracker.disconnect()
+        self._tracker = None
+
+    def stop(self, timeout: Optional[float] = None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._thread = None
+        self._close()
@@ -0,0 +1,164 @@
+"""
+    # Connection Manager
+    ---
+    Owns the redis connection pools of a processor.
+
+    Every pool is a `BlockingConnectionPool`, so a burst of callers waits for a free connection instead of opening new sockets without bound.
+    Each subsystem (`events`, `storage`, `search`) can get its own pool so large blob transfers don't starve the event reads.
+
+    ```
+        jam = Jamboree(REDIS_MAX_CONNECTIONS=100, SEPARATE_POOLS=True, POOL_SIZES={"storage": 8})
+        jam.connections.stats()
+    ```
+
+    Waits are recorded as the `pool.{name}.wait` timing of `metrics`, and callers that gave up waiting under `pool.{name}.exhausted`.
+"""
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+from redis import BlockingConnectionPool, Redis
+from redis.exceptions import ConnectionError
+
+from jamboree.utils.metrics import Metrics
+
+SUBSYSTEMS = ["events", "storage", "search"]
+
+
+class InstrumentedBlockingPool(BlockingConnectionPool):
+    """ A blocking pool that records how long callers wait for a connection and resets itself in forked children. """
+
+    def __init__(self, name: str = "shared", metrics: Optional[Metrics] = None, **kwargs):
+        self.name = name
+        self.metrics = metrics or Metrics()
+        self._fork_guard = threading.Lock()
+        super().__init__(**kwargs)
+
+    @property
+    def in_use(self) -> int:
+        """ Connections that are currently checked out. """
+        return self.max_connections - self.pool.qsize()
+
+    def _checkpid(self):
+        # Older redis-py versions disconnect the inherited sockets in a forked child, which shuts them down under the parent too.
+        # Drop them instead and let the child open its own.
+        if self.pid != os.getpid():
+            with self._fork_guard:
+                if self.pid != os.getpid():
+                    self.metrics.incr(f"pool.{self.name}.forks")
+                    self.reset()
+
+    def get_connection(self, command_name, *keys, **options):
+        started = time.perf_counter()
+        try:
+            connection = super().get_connection(command_name, *keys, **options)
+        except ConnectionError:
+            self.metrics.incr(f"pool.{self.name}.exhausted")
+            raise
+        self.metrics.timing(f"pool.{self.name}.wait", time.perf_counter() - started)
+        return connection
+
+
+class ConnectionManager(object):
+    """
+        * `max_connections` - the size of each pool.
+        * `timeout` - seconds to wait for a free connection before a `ConnectionError`. None waits forever.
+        * `socket_timeout`, `socket_connect_timeout`, `socket_keepalive` and `health_check_interval` are passed to every connection.
+        * `separate` - give every subsystem its own pool. `sizes` overrides the size of a subsystem's pool.
+    """
+
+    def __init__(
+        self,
+        host: str = "localhost",
+        port: int = 6379,
+        max_connections: int = 50,
+        timeout: Optional[float] = 20,
+        socket_timeout: Optional[float] = None,
+        socket_connect_timeout: Optional[float] = None,
+        socket_keepalive: bool = True,
+        health_check_interval: int = 30,
+        separate: bool = False,
+        sizes: Optional[Dict[str, int]] = None,
+    ) -> None:
+        self.host = host
+        self.port = port
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.connection_kwargs = {
+            "socket_timeout": socket_timeout,
+            "socket_connect_timeout": socket_connect_timeout,
+            "socket_keepalive": socket_keepalive,
+            "health_check_interval": health_check_interval,
+        }
+        self.separate = separate
+        self.sizes = sizes or {}
+        self.metrics = Metrics()
+        self._lock = threading.Lock()
+        self._pools: Dict[str, InstrumentedBlockingPool] = {}
+        self._clients: Dict[str, Redis] = {}
+
+    @classmethod
+    def from_settings(cls, settings: dict) -> "ConnectionManager":
+        """ Build a manager from processor kwargs. """
+        return cls(
+            host=settings.get("REDIS_HOST", "localhost"),
+            port=int(settings.get("REDIS_PORT", "6379")),
+            max_connections=int(settings.get("REDIS_MAX_CONNECTIONS", 50)),
+            timeout=settings.get("REDIS_POOL_TIMEOUT", 20),
+            socket_timeout=settings.get("REDIS_SOCKET_TIMEOUT", None),
+            socket_connect_timeout=settings.get("REDIS_CONNECT_TIMEOUT", None),
+            socket_keepalive=settings.get("REDIS_KEEPALIVE", True),
+            health_check_interval=int(settings.get("REDIS_HEALTH_CHECK_INTERVAL", 30)),
+            separate=settings.get("SEPARATE_POOLS", False),
+            sizes=settings.get("POOL_SIZES", None),
+        )
+
+    def _pool_name(self, subsystem: str) -> str:
+        if subsystem not in SUBSYSTEMS:
+            raise ValueError(f"The subsystem must be one of {SUBSYSTEMS}")
+        return subsystem if self.separate else "shared"
+
+    def pool(self, subsystem: str = "events") -> InstrumentedBlockingPool:
+        """ Get the pool of a subsystem. Every subsystem shares one pool unless `separate` is set. """
+        name = self._pool_name(subsystem)
+        with self._lock:
+            if name not in self._pools:
+                self._pools[name] = InstrumentedBlockingPool(
+                    name=name,
+                    metrics=self.metrics,
+                    host=self.host,
+                    port=self.port,
+                    max_connections=int(self.sizes.get(name, self.max_connections)),
+                    timeout=self.timeout,
+                    **self.connection_kwargs,
+                )
+            return self._pools[name]
+
+    def client(self, subsystem: str = "events") -> Redis:
+        """ Get a redis client on the pool of a subsystem. """
+        name = self._pool_name(subsystem)
+        pool = self.pool(subsystem)
+        with self._lock:
+            if name not in self._clients:
+                self._clients[name] = Redis(connection_pool=pool)
+            return self._clients[name]
+
+    def stats(self) -> dict:
+        """ The size, connections in use and connections created of each pool, plus the wait metrics. """
+        with self._lock:
+            pools = {
+                name: {
+                    "max_connections": pool.max_connections,
+                    "in_use": pool.in_use,
+                    "created": len(pool._connections),
+                }
+                for name, pool in self._pools.items()
+            }
+        return {"pools": pools, **self.metrics.snapshot()}
+
+    def disconnect(self):
+        """ Close every connection of every pool. """
+        with self._lock:
+            for pool in self._pools.values():
+                pool.disconnect()
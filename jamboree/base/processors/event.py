@@ -1,14 +1,20 @@
+import itertools
 from copy import copy
 import orjson
 import ujson
-from typing import List, Optional
+from typing import Callable, List, Optional
 import redis
 from redis import Redis
-from pebble.pool import ThreadPool
+from redis.exceptions import WatchError
 import base64
-from multiprocessing import cpu_count
-from jamboree.storage.databases import MongoDatabaseConnection, ZRedisDatabaseConnection
+import pandas as pd
+from jamboree.storage.databases import MongoDatabaseConnection, ZRedisDatabaseConnection, ChunkRedisDatabaseConnection, AsyncZRedisDatabaseConnection, MemoryDatabaseConnection, SQLiteDatabaseConnection, async_client
+from jamboree.storage.databases.batch import Batch
+from jamboree.storage.databases.cold import ColdSpiller, ColdStore
+from jamboree.utils.executor import Executor, shared_executor
 from jamboree.utils.helper import Helpers
+from jamboree.base.processors.buffer import WriteBuffer
+from jamboree.base.processors.cache import CacheInvalidator, ReadCache
 from jamboree.base.processors.abstracts import EventProcessor
 from jamboree.base.processors.abstracts import LegacyProcessor
 from loguru import logger
@@ -22,9 +28,23 @@ class JamboreeEvents(EventProcessor):
         # self.redis = redis.Redis(redis_host, port=redis_port)
         self._redis:Optional[Redis] = None
         self._redis_conn = ZRedisDatabaseConnection()
+        self._chunk_conn = ChunkRedisDatabaseConnection()
+        self._async_conn: Optional[AsyncZRedisDatabaseConnection] = None
+        self._backend = "redis"
+        self.sqlite_path = "jamboree.db"
+        self.redis_host = redis_host
+        self.redis_port = redis_port
+        self.async_max_connections = 64
+        self.cache: Optional[ReadCache] = None
+        self.invalidator: Optional[CacheInvalidator] = None
+        self.cold: Optional[ColdStore] = None
+        self.spiller: Optional[ColdSpiller] = None
+        self.hot_window = 0.0
+        self.write_buffer: Optional[WriteBuffer] = None
         self.dominant_database = ""
         self.helpers = Helpers()
-        self.pool = ThreadPool(max_workers=cpu_count() * 6)
+        # Background work goes to the executor of the process. No threads start until something is submitted.
+        self.executor: Executor = shared_executor()
     
     @property
     def rconn(self) -> redis.client.Redis:
@@ -45,11 +65,204 @@ class JamboreeEvents(EventProcessor):
     @redis_conn.setter
     def redis_conn(self, _rconn: ZRedisDatabaseConnection):
         self._redis_conn = _rconn
+        # Rollups count the events spilled to the cold tier
+        _rconn.cold = self.cold
+
+    @property
+    def backend(self) -> str:
+        """ 
+            Where events and single values live. Takes effect on `initialize`.
+
+            * `redis` - the default.
+            * `memory` - in process, for single process backtests.
+            * `sqlite` - the file at `sqlite_path`, for history larger than RAM.
+        """
+        return self._backend
+
+    @backend.setter
+    def backend(self, _backend: str):
+        if _backend not in ["redis", "memory", "sqlite"]:
+            raise ValueError("The backend must be one of 'redis', 'memory' or 'sqlite'")
+        self._backend = _backend
+
+    @property
+    def chunk_conn(self) -> ChunkRedisDatabaseConnection:
+        if self._chunk_conn is None:
+            raise AttributeError("Chunk connection hasn't been set")
+        return self._chunk_conn
+
+    @chunk_conn.setter
+    def chunk_conn(self, _cconn: ChunkRedisDatabaseConnection):
+        self._chunk_conn = _cconn
+
+    @property
+    def async_conn(self) -> AsyncZRedisDatabaseConnection:
+        """ The asyncio twin of `redis_conn`. Created on first use with the same layout and its own connection pool. """
+        if self._async_conn is None:
+            if self.backend != "redis":
+                raise AttributeError(f"The {self.backend} backend has no async connection. Use the sync calls.")
+            aconn = AsyncZRedisDatabaseConnection()
+            aconn.connection = async_client(
+                self.redis_host, self.redis_port, max_connections=self.async_max_connections
+            )
+            aconn.layout = self.redis_conn.layout
+            self._async_conn = aconn
+        return self._async_conn
+
+    @async_conn.setter
+    def async_conn(self, _aconn: AsyncZRedisDatabaseConnection):
+        self._async_conn = _aconn
+
+    def enable_cache(self, max_size: int = 10000, ttl: Optional[float] = None, mode: str = "auto") -> str:
+        """ 
+            Cache `get_latest` and `single_get` replies in process. Returns the invalidation mode in use (see `cache`).
+            Without a server side mode, entries expire after `ttl` seconds (one second by default).
+        """
+        self.disable_cache()
+        if self.backend != "redis":
+            # Redis can't tell us about changes to events it doesn't hold
+            mode = "local"
+        self.cache = ReadCache(max_size=max_size, ttl=ttl)
+        self.invalidator = CacheInvalidator(self.cache, self.rconn, mode=mode)
+        if self.invalidator.start() == "local" and ttl is None:
+            self.cache.ttl = 1.0
+        return self.invalidator.mode
+
+    def disable_cache(self):
+        if self.invalidator is not None:
+            self.invalidator.stop()
+        self.invalidator = None
+        self.cache = None
+
+    def _invalidate(self, query: dict):
+        """ 
+            Drop our own cached reads of a query once we've written to it, whatever the invalidation mode.
+            Call it after the write (even a failed one). Dropping first lets a read that lands in between cache the old events.
+        """
+        if self.cache is not None and self._validate_query(query):
+            self.cache.invalidate(self._generate_hash(query))
+
+    def buffered(self, max_events: int = 1000, max_latency: Optional[float] = 0.05) -> WriteBuffer:
+        """ 
+            Coalesce `save` calls into one append per key (see `buffer`). Returns the buffer. Use it as a context manager, or `close` it.
+            Reads and deletes of a key flush its pending events first.
+        """
+        self.unbuffered()
+        self.write_buffer = WriteBuffer(self, max_events=max_events, max_latency=max_latency)
+        return self.write_buffer
+
+    def unbuffered(self):
+        """ Flush the pending events and go back to writing every save straight away. """
+        if self.write_buffer is not None:
+            self.write_buffer.close()
+        self.write_buffer = None
+
+    def _flush(self, query: dict):
+        """ Write the buffered events of a query before it's read or deleted. """
+        if self.write_buffer is not None and self._validate_query(query):
+            self.write_buffer.flush_key(query)
+
+    def batch(self, watch: Optional[List[dict]] = None) -> Batch:
+        """ 
+            Queue every write of this thread into one MULTI/EXEC pipeline until the block ends (see `batch`).
+            If a key of the `watch` queries changes before then, nothing is written and `WatchError` is raised.
+        """
+        batch = self.redis_conn.batch(watch or [])
+        batch.on_commit(self._invalidate_hashes)
+        return batch
+
+    def transaction(self, step: Callable, watch: Optional[List[dict]] = None, retries: int = 10):
+        """ 
+            Run `step` inside of a batch watching the `watch` queries. Runs it again whenever a watched key changed first.
+            Returns what `step` returns. Raises `WatchError` once `retries` runs were beaten.
+        """
+        for attempt in range(retries + 1):
+            try:
+                with self.batch(watch):
+                    result = step()
+                return result
+            except WatchError:
+                self.redis_conn.metrics.incr("batch.conflicts")
+                if attempt == retries:
+                    raise
+
+    def _invalidate_hashes(self, hashes):
+        """ Writes of a batch land when it's sent. Reads cached inside of the block are stale after that. """
+        if self.cache is not None:
+            for _hash in hashes:
+                self.cache.invalidate(_hash)
+
+    def enable_tiering(self, path: str, hot_window: float, interval: Optional[float] = None, rows_per_file: int = 100000):
+        """ 
+            Keep only the newest `hot_window` seconds (relative time) of each key in the event store.
+            Older events are moved to columnar files under `path` (see `cold`) by `spill`, every `interval` seconds if one is given.
+            Range and full reads merge both tiers.
+        """
+        self.disable_tiering()
+        self.cold = ColdStore(path, rows_per_file=rows_per_file)
+        self.redis_conn.cold = self.cold
+        self.hot_window = float(hot_window)
+        if interval is not None:
+            self.spiller = ColdSpiller(self, interval=float(interval))
+            self.spiller.start()
+
+    def disable_tiering(self):
+        """ Stop spilling and reading the cold tier. The files stay where they are. """
+        if self.spiller is not None:
+            self.spiller.stop()
+        self.spiller = None
+        self.cold = None
+        self.redis_conn.cold = None
+
+    def spill(self, query: Optional[dict] = None) -> int:
+        """ Move the events older than the hot window of one query, or of every key, to the cold tier. Returns the number moved. """
+        if self.cold is None:
+            return 0
+        if query is not None:
+            if self._validate_query(query) == False: return 0
+            hashes = [self._generate_hash(query)]
+        else:
+            hashes = list(self.redis_conn.event_hashes())
+        moved = 0
+        for _hash in hashes:
+            stats = self.redis_conn.stats(_hash)
+            if stats.get("count", 0) == 0:
+                continue
+            moved += self.cold.spill(self.redis_conn, _hash, stats["max_time"] - self.hot_window)
+        self.redis_conn.metrics.incr("tiering.spilled", moved)
+        return moved
+
+    def _merge_cold(self, query: dict, hot: list, min_epoch="-inf", max_epoch="+inf", abs_rel: str = "relative") -> list:
+        """ Merge the cold events of a range with the hot ones, ordered by the requested time. """
+        if self.cold is None or self._validate_query(query) == False:
+            return hot
+        cold = self.cold.between(self._generate_hash(query), min_epoch, max_epoch, abs_rel)
+        if len(cold) == 0:
+            return hot
+        field = "timestamp" if abs_rel == "absolute" else "time"
+        return sorted(cold + hot, key=lambda event: event.get(field, 0))
+
+    def _merge_cold_frame(self, query: dict, hot, min_epoch="-inf", max_epoch="+inf", abs_rel: str = "relative"):
+        if self.cold is None or self._validate_query(query) == False:
+            return hot
+        cold = self.cold.frame(self._generate_hash(query), min_epoch, max_epoch, abs_rel)
+        if cold.empty:
+            return hot
+        field = "timestamp" if abs_rel == "absolute" else "time"
+        frame = pd.concat([cold, hot], ignore_index=True, sort=False)
+        return frame.sort_values(field, kind="mergesort", ignore_index=True)
 
     def initialize(self):
         """ Initialize database connections. Use this so we can use the same connections for search, files, and events. """
-        self.redis_conn = ZRedisDatabaseConnection()
-        self.redis_conn.connection = self.rconn
+        if self.backend == "memory":
+            self.redis_conn = MemoryDatabaseConnection()
+        elif self.backend == "sqlite":
+            self.redis_conn = SQLiteDatabaseConnection(self.sqlite_path)
+        else:
+            self.redis_conn = ZRedisDatabaseConnection()
+            self.redis_conn.connection = self.rconn
+        self.chunk_conn = ChunkRedisDatabaseConnection()
+        self.chunk_conn.connection = self.rconn
 
     def _validate_query(self, query: dict):
         """ Validates a query. Must have `type` and a second identifier at least"""
@@ -62,10 +275,7 @@ class JamboreeEvents(EventProcessor):
         return True
 
     def _generate_hash(self, query: dict):
-        _hash = ujson.dumps(query, sort_keys=True)
-        _hash = base64.b64encode(str.encode(_hash))
-        _hash = _hash.decode('utf-8')
-        return _hash
+        return self.helpers.generate_hash(query)
 
     
 
@@ -91,7 +301,10 @@ class JamboreeEvents(EventProcessor):
             Does it in a background process. Use with add event.
             We save the information both in mongodb and redis. We assume there's many of each collection. We find a specific collection using the query.
         """
-        self.redis_conn.save(query, data)
+        try:
+            self.redis_conn.save(query, data)
+        finally:
+            self._invalidate(query)
         # self.pool.schedule(self.mongo_conn.save, args=(query, data))
 
     """
@@ -120,8 +333,11 @@ class JamboreeEvents(EventProcessor):
             
         """
         # self.pool.schedule(self.mongo_conn.delete_all, args=(query, details))
-        self.redis_conn.delete(query, details)
-        self.pool.schedule(self.redis_conn.delete_all, args=(query))
+        self._flush(query)
+        try:
+            self.redis_conn.delete(query, details)
+        finally:
+            self._invalidate(query)
 
     def _remove_first_redis(self, _hash, query: dict):
         pass
@@ -129,8 +345,43 @@ class JamboreeEvents(EventProcessor):
     def remove_first(self, query: dict):
         pass
     
+    def set_retention(self, entity: str, max_len: int = 0, max_age: float = 0.0, age_by: str = "relative"):
+        """ Cap how many events (or how old) an entity keeps. Enforced on every write and by `compact`. """
+        return self.redis_conn.set_retention(entity, max_len=max_len, max_age=max_age, age_by=age_by)
+
+    def set_codec(self, entity: str, codec: str = "json", fields: Optional[dict] = None):
+        """ Encode the events of new keys of an entity with `json`, `msgpack` or `struct` (given the schema `fields`). """
+        spec = self.redis_conn.set_codec(entity, codec=codec, fields=fields)
+        if self._async_conn is not None:
+            # Reload on the next async write
+            self._async_conn._codecs = None
+        return spec
+
+    def compact(self) -> int:
+        """ Apply the retention policies to every stored key. """
+        return self.redis_conn.compact()
+
+    def delete_all_many(self, queries: List[dict]):
+        """ Delete all of the events of many queries at once. Use it to tear down an episode. """
+        for query in queries:
+            self._flush(query)
+        try:
+            for query in queries:
+                if self.cold is not None and self._validate_query(query):
+                    self.cold.delete(self._generate_hash(query))
+            return self.redis_conn.delete_all_many(queries)
+        finally:
+            for query in queries:
+                self._invalidate(query)
+
     def delete_all(self, query: dict):
-        self.redis_conn.delete_all(query)
+        self._flush(query)
+        try:
+            if self.cold is not None and self._validate_query(query):
+                self.cold.delete(self._generate_hash(query))
+            self.redis_conn.delete_all(query)
+        finally:
+            self._invalidate(query)
         # _hash = self._generate_hash(query)
         # count = self._get_count(_hash, query)
 
@@ -144,6 +395,10 @@ class JamboreeEvents(EventProcessor):
     """
 
     def save(self, query: dict, data: dict, abs_rel="absolute"):
+        # A batch already sends its saves together
+        if self.write_buffer is not None and self.redis_conn.active_batch is None:
+            self.write_buffer.add(query, data)
+            return
         self._save(query, data)
 
     def save_many(self, query: dict, data: List[dict]):
@@ -158,8 +413,12 @@ class JamboreeEvents(EventProcessor):
 
     def _bulk_save(self, query, data: list):
         """ Bulk adds a list to redis."""
+        self._flush(query)
         events = self.helpers.convert_to_storable_relative(data)
-        self.redis_conn.save_many(query, events)
+        try:
+            self.redis_conn.save_many(query, events)
+        finally:
+            self._invalidate(query)
         # self.pool.schedule(self.mongo_conn.save_many, args=(query, data))
 
 
@@ -190,18 +449,34 @@ class JamboreeEvents(EventProcessor):
         """ Gets the latest query"""
         # Add a conditional time lock
         # logger.debug(abs_rel)
-        _hash = self._generate_hash(query)
+        if self._validate_query(query) == False: return {}
+        self._flush(query)
+        # Hashed once here. The connection reuses it.
+        query = self.helpers.bind(query)
+        _hash = query.hash
+        if self.cache is not None:
+            hit, cached = self.cache.get(_hash, ("latest", abs_rel))
+            if hit:
+                # Callers change the dicts they get back. Hand out a fresh copy every time.
+                return orjson.loads(cached)
+            version = self.cache.version(_hash)
+            self.invalidator.track(_hash)
         count, database = self._get_count(_hash, query)
+        latest = {}
         if count > 0:
-            return self.redis_conn.query_latest(query, abs_rel)
-        return {}
+            latest = self.redis_conn.query_latest(query, abs_rel)
+        if self.cache is not None:
+            self.cache.put(_hash, ("latest", abs_rel), orjson.dumps(latest), version)
+        return latest
         # # Mongo, slowdown
         # return self.mongo_conn.query_latest(query)
 
     def get_latest_many(self, query: dict, limit=1000, abs_rel="absolute"):
 
         if self._validate_query(query) == False: return []
-        _hash = self._generate_hash(query)
+        self._flush(query)
+        query = self.helpers.bind(query)
+        _hash = query.hash
         count = self._get_count(_hash, query)
         if count == 0: return []
 
@@ -215,18 +490,136 @@ class JamboreeEvents(EventProcessor):
 
 
     def get_between(self, query:dict, min_epoch:float, max_epoch:float, abs_rel:str="absolute"):
+        self._flush(query)
         items = self.redis_conn.query_between(query, min_epoch, max_epoch, abs_rel)
-        return items
+        return self._merge_cold(query, items, min_epoch, max_epoch, abs_rel)
+
+
+    def get_between_frame(self, query:dict, min_epoch:float, max_epoch:float, abs_rel:str="relative"):
+        """ Get the events between two epochs as a dataframe. """
+        self._flush(query)
+        frame = self.redis_conn.query_between_frame(query, min_epoch, max_epoch, abs_rel)
+        return self._merge_cold_frame(query, frame, min_epoch, max_epoch, abs_rel)
+
+
+    def get_all_frame(self, query:dict):
+        """ Get every event as a dataframe. """
+        self._flush(query)
+        return self._merge_cold_frame(query, self.redis_conn.query_all_frame(query))
+
+
+    def update_rollups(self, query:dict, min_epoch:float, max_epoch:float):
+        """ Recompute the rollup buckets touched by a write between two relative times. """
+        self._flush(query)
+        return self.redis_conn.update_rollups(query, min_epoch, max_epoch)
+
+
+    def rebuild_rollups(self, query:dict):
+        """ Build the rollup tiers of a query again from every stored event. """
+        self._flush(query)
+        return self.redis_conn.rebuild_rollups(query)
+
+
+    def get_rollups_between(self, query:dict, min_epoch:float, max_epoch:float, tiers:List[str]):
+        """ Get the rollup states covering two relative times. None if the query has no rollups. """
+        self._flush(query)
+        return self.redis_conn.query_rollups(query, min_epoch, max_epoch, tiers)
+
+
+    def get_between_many(self, queries:List[dict], min_epoch, max_epoch, abs_rel:str="absolute") -> dict:
+        """ 
+            Get the events between two epochs for many queries in one round trip. 
+            Pass a single window or a list of windows (one per query). Returns the events keyed by each query's hash.
+        """
+        for query in queries:
+            self._flush(query)
+        results = self.redis_conn.query_between_many(queries, min_epoch, max_epoch, abs_rel)
+        if self.cold is None:
+            return results
+        size = len(queries)
+        mins = min_epoch if isinstance(min_epoch, (list, tuple)) else [min_epoch] * size
+        maxes = max_epoch if isinstance(max_epoch, (list, tuple)) else [max_epoch] * size
+        for query, _min, _max in zip(queries, mins, maxes):
+            if self._validate_query(query) == False:
+                continue
+            _hash = self._generate_hash(query)
+            if _hash in results:
+                results[_hash] = self._merge_cold(query, results[_hash], _min, _max, abs_rel)
+        return results
     
 
     def get_latest_by(self, query:dict, max_epoch, abs_rel="absolute", limit:int=10):
+        self._flush(query)
         item = self.redis_conn.query_latest_by_time(query, max_epoch, abs_rel)
+        if self.cold is None or self._validate_query(query) == False:
+            return item
+        # The closest event at or after the epoch can be one that was spilled
+        cold = self.cold.first(self._generate_hash(query), max_epoch, abs_rel)
+        field = "timestamp" if abs_rel == "absolute" else "time"
+        if len(cold) > 0 and (len(item) == 0 or cold[field] < item[field]):
+            return cold
         return item
 
 
     def get_all(self, query:dict, abs_rel:str="relative"):
+        self._flush(query)
         items = self.redis_conn.query_all(query)
-        return items
+        return self._merge_cold(query, items, abs_rel="absolute")
+
+
+    def iter_between(self, query:dict, min_epoch, max_epoch, abs_rel:str="absolute", chunk_size:int=1000):
+        """ Stream the events between two epochs in batches of `chunk_size`. The spilled events come first. """
+        self._flush(query)
+        hot = self.redis_conn.iter_between(query, min_epoch, max_epoch, abs_rel, chunk_size=chunk_size)
+        if self.cold is None or self._validate_query(query) == False:
+            return hot
+        if chunk_size < 1:
+            raise ValueError("The chunk size must be at least 1")
+        cold = self.cold.pages(self._generate_hash(query), min_epoch, max_epoch, abs_rel, chunk_size=chunk_size)
+        return itertools.chain(cold, hot)
+
+
+    def iter_all(self, query:dict, abs_rel:str="relative", chunk_size:int=1000):
+        """ Stream every event in batches of `chunk_size`. """
+        return self.iter_between(query, "-inf", "+inf", abs_rel=abs_rel, chunk_size=chunk_size)
+
+    """
+        COLUMNAR CHUNK FUNCTIONS
+    """
+
+    def save_chunked(self, query: dict, frame):
+        """ Save a dataframe as compressed column chunks. The frame needs a `time` column. """
+        if self._validate_query(query) == False: return
+        self.chunk_conn.save_frame(query, frame)
+
+    def get_chunked_between(self, query: dict, min_epoch: float, max_epoch: float, abs_rel: str = "relative"):
+        return self.chunk_conn.query_between(query, min_epoch, max_epoch, abs_rel)
+
+    def get_chunked_latest_by(self, query: dict, max_epoch: float) -> dict:
+        return self.chunk_conn.query_latest_by_time(query, max_epoch)
+
+    def get_chunked_latest(self, query: dict) -> dict:
+        return self.chunk_conn.query_latest(query)
+
+    def get_chunked_all(self, query: dict):
+        return self.chunk_conn.query_all(query)
+
+    def iter_chunked_between(self, query: dict, min_epoch: float, max_epoch: float, abs_rel: str = "relative"):
+        """ Stream rows between two epochs. Each batch is the rows of one chunk. """
+        return self.chunk_conn.iter_between(query, min_epoch, max_epoch, abs_rel)
+
+    def stats_chunked(self, query: dict) -> dict:
+        if self._validate_query(query) == False: return {}
+        _hash = self._generate_hash(query)
+        return self.chunk_conn.stats(_hash)
+
+    def count_chunked(self, query: dict) -> int:
+        if self._validate_query(query) == False: return 0
+        _hash = self._generate_hash(query)
+        return self.chunk_conn.count(_hash)
+
+    def delete_chunked(self, query: dict):
+        self.chunk_conn.delete_all(query)
 
     """
         SEARCH ONE FUNCTIONS
@@ -255,23 +648,46 @@ class JamboreeEvents(EventProcessor):
     def count(self, query):
         """ """
         if self._validate_query(query) == False: return []
+        self._flush(query)
         _hash = self._generate_hash(query)
         count, database = self._get_count(_hash, query)
         self.dominant_database = database
+        if self.cold is not None:
+            count += self.cold.count(_hash)
         return count
 
     def single_get(self, query:dict, is_serialized=True):
         if self._validate_query(query) == False: return {}
-        item = self.redis_conn.get(query, is_serialized=is_serialized)
-        return item 
+        if self.cache is None:
+            return self.redis_conn.get(query, is_serialized=is_serialized)
+        _hash = self._generate_hash(query)
+        hit, raw = self.cache.get(_hash, "single")
+        if not hit:
+            version = self.cache.version(_hash)
+            self.invalidator.track(_hash)
+            raw = self.redis_conn.get(query, is_serialized=False)
+            # Only bytes are cached. Callers get their own dict, even for a missing key.
+            raw = raw if isinstance(raw, bytes) else None
+            self.cache.put(_hash, "single", raw, version)
+        if raw is None:
+            return {}
+        if is_serialized:
+            return orjson.loads(raw)
+        return raw
 
     def single_set(self, query:dict, data:dict, is_serialized=True):
         if self._validate_query(query) == False: return
-        self.redis_conn.add(query, data, is_serialized=is_serialized)
+        try:
+            self.redis_conn.add(query, data, is_serialized=is_serialized)
+        finally:
+            self._invalidate(query)
 
     def single_delete(self, query:dict):
         if self._validate_query(query) == False: return
-        self.redis_conn.kill(query)
+        try:
+            self.redis_conn.kill(query)
+        finally:
+            self._invalidate(query)
     
     def lock(self, query:dict):
         if self._validate_query(query) == False:
@@ -280,9 +696,79 @@ class JamboreeEvents(EventProcessor):
         return self.redis_conn.general_lock(query)
     
     def max_time(self, query:dict):
-        _hash = self._generate_hash(query)
-        return self.redis_conn.max_score(_hash)
+        """ The largest relative time of a query, in either tier. 0 without events. """
+        return float(self.stats(query).get("max_time", 0.0))
 
     def min_time(self, query:dict):
+        """ The smallest relative time of a query, in either tier. 0 without events. """
+        return float(self.stats(query).get("min_time", 0.0))
+
+    def stats(self, query:dict) -> dict:
+        """ Get the count, time bounds and last write time of a query in one read. """
+        if self._validate_query(query) == False: return {}
+        self._flush(query)
         _hash = self._generate_hash(query)
-        return self.redis_conn.min_score(_hash)
\ No newline at end of file
+        stats = self.redis_conn.stats(_hash)
+        cold = {} if self.cold is None else self.cold.stats(_hash)
+        if len(cold) == 0:
+            return stats
+        if len(stats) == 0:
+            return cold
+        merged = dict(stats, count=stats["count"] + cold["count"])
+        for bound in ["min_time", "min_timestamp"]:
+            merged[bound] = min(stats[bound], cold[bound])
+        for bound in ["max_time", "max_timestamp"]:
+            merged[bound] = max(stats[bound], cold[bound])
+        return merged
+
+    """
+        ASYNC FUNCTIONS
+        ---
+        Coroutine versions of the common event calls. They run on `async_conn`, so many of them can overlap on one pool.
+    """
+
+    async def asave(self, query: dict, data: dict):
+        try:
+            trimmed = await self.async_conn.save(query, data)
+        finally:
+            self._invalidate(query)
+        await self._arefresh_rollups(query, trimmed)
+
+    async def asave_many(self, query: dict, data: List[dict]):
+        if self._validate_query(query) == False or len(data) == 0:
+            return
+        data_list = [self.helpers.update_dict(query, item) for item in data]
+        events = self.helpers.convert_to_storable_relative(data_list)
+        try:
+            trimmed = await self.async_conn.save_many(query, events)
+        finally:
+            self._invalidate(query)
+        await self._arefresh_rollups(query, trimmed)
+
+    async def _arefresh_rollups(self, query: dict, trimmed: Optional[tuple]):
+        """ Recompute the rollups over the span an async write trimmed. The rollup code is sync, so it runs on the executor. """
+        if trimmed is None:
+            return
+        await self.executor.arun(self.redis_conn.refresh_rollups, self._generate_hash(query), *trimmed)
+
+    async def aupdate_rollups(self, query: dict, min_epoch: float, max_epoch: float):
+        """ `update_rollups` on the executor, so it doesn't block the loop. """
+        await self.executor.arun(self.update_rollups, query, min_epoch, max_epoch)
+
+    async def aget_latest(self, query: dict, abs_rel="absolute"):
+        return await self.async_conn.query_latest(query, abs_rel)
+
+    async def aget_latest_many(self, query: dict, limit=1000, abs_rel="absolute"):
+        return await self.async_conn.query_latest_many(query, abs_rel=abs_rel, limit=limit)
+
+    async def aget_between(self, query: dict, min_epoch: float, max_epoch: float, abs_rel: str = "absolute"):
+        return await self.async_conn.query_between(query, min_epoch, max_epoch, abs_rel)
+
+    async def acount(self, query: dict) -> int:
+        if self._validate_query(query) == False: return 0
+        return await self.async_conn.count(self._generate_hash(query))
+
+    async def astats(self, query: dict) -> dict:
+        if self._validate_query(query) == False: return {}
+        return await self.async_conn.stats(self._generate_hash(query))
+
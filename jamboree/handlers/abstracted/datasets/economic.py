@@ -6,4 +6,4 @@ class EconomicData(DataHandler):
         
         A way to browse economic data. Is an extension of DataHandler and includes basic searches.
     """
-    pass
\ No newline at end of file
+    __slots__ = ()
\ No newline at end of file
@@ -16,6 +16,8 @@ class OrderbookData(DataHandler):
         A way to browse and interact with price data. Is an extension of DataHandler and includes basic searches.
 
     """
+    __slots__ = ("sc", "cat")
+
     def __init__(self):
         super().__init__()
         self['subtype'] = "orderbook" 
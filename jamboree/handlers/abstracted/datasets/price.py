@@ -16,6 +16,10 @@ class PriceData(DataHandler):
         A way to browse and interact with price data. Is an extension of DataHandler and includes basic searches.
 
     """
+    __slots__ = ("sc",)
+    # Bars resample as bars, from the raw events and the rollups alike
+    resample_how = "ohlcv"
+
     def __init__(self):
         super().__init__()
         self['category'] = "markets"
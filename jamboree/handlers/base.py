@@ -7,6 +7,7 @@ class BaseHandler(object, metaclass=ABCMeta):
     """ 
         A way to handle reads and writes consistently without having to write every single variable:
     """
+    __slots__ = ()
 
     def __init__(self):
         pass
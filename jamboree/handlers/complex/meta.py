@@ -52,6 +52,8 @@ class MetaHandler(Access):
                 - Login, logout location data
             - Creating something flexible for this would probably be a good idea. 
     """
+    __slots__ = ("_search", "_settings", "is_auto", "description")
+
     def __init__(self):
         super().__init__()
         self.entity = "metadata"
@@ -63,7 +65,7 @@ class MetaHandler(Access):
             "abbreviation": str,
             "subcategories": dict
         }
-        self._search = MetadataSearchHandler()
+        self._search: Optional[MetadataSearchHandler] = None
         self._settings = {}
         self.is_auto = False
         self.description: Optional[str] = None
@@ -72,6 +74,8 @@ class MetaHandler(Access):
     def search(self):
         metatype = self.metatype
         submetatype = self.submetatype
+        if self._search is None:
+            self._search = MetadataSearchHandler()
         self._search.entity = self.entity
         self._search['metatype'] = {
             "type": "TEXT",
@@ -5,6 +5,8 @@ from jamboree.handlers.default.db import DBHandler
 
 
 class Access(DBHandler):
+    __slots__ = ()
+
     # ---------------------------------------------------------------------------------
     #                          Simple Accessor Properties
     # ---------------------------------------------------------------------------------
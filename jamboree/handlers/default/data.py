@@ -1,6 +1,8 @@
 import uuid
+from typing import Optional, Tuple
 
 import maya
+import numpy as np
 import pandas as pd
 import ujson
 from loguru import logger
@@ -12,6 +14,7 @@ from jamboree.handlers.default import Access, DBHandler, TimeHandler
 from jamboree.handlers.processors import (
     DataProcessorsAbstract, DynamicResample
 )
+from jamboree.storage.databases import rollups
 from jamboree.utils import omit
 from jamboree.utils.support.search import querying
 
@@ -30,7 +33,16 @@ class DataHandler(Access):
             * The MultiDataHandler
         5. Adds autoresampling functionality.
 
+        The time, metadata and search handlers and the preprocessor are only built when they're first used.
+
     """
+    __slots__ = (
+        "_time", "_meta", "_metasearch", "_episode", "_is_live", "_preprocessor",
+        "_engine", "_rollups", "metaid", "is_robust",
+    )
+    # How resampled frames aggregate the events, from the raw events or the rollups. `mean` or `ohlcv` (see `rollups.resample`).
+    resample_how = "mean"
+
     def __init__(self):
         super().__init__()
         self.entity = "data"
@@ -43,13 +55,15 @@ class DataHandler(Access):
             "submetatype": str,
             "abbreviation": str,
         }
-        self._time: TimeHandler = TimeHandler()
-        self._meta: MetaHandler = MetaHandler()
-        self._metasearch = MetadataSearchHandler()
+        self._time: Optional[TimeHandler] = None
+        self._meta: Optional[MetaHandler] = None
+        self._metasearch: Optional[MetadataSearchHandler] = None
         self._episode = uuid.uuid4().hex
         self._is_live = False
-        self._preprocessor: DataProcessorsAbstract = DynamicResample("data")
+        self._preprocessor: Optional[DataProcessorsAbstract] = None
         self.is_event = False # use to make sure there's absolutely no duplicate data
+        self._engine = "zset"
+        self._rollups = False
         self.metaid = ""
         self["metatype"] = self.entity
 
@@ -73,6 +87,8 @@ class DataHandler(Access):
 
     @property
     def time(self) -> "TimeHandler":
+        if self._time is None:
+            self._time = TimeHandler()
         self._time.processor = self.processor
         self._time["episode"] = self.episode
         self._time["live"] = self.live
@@ -84,6 +100,8 @@ class DataHandler(Access):
 
     @property
     def metadata(self):
+        if self._meta is None:
+            self._meta = MetaHandler()
         self._meta.processor = self.processor
         self._meta["name"] = self.name
         self._meta["category"] = self.category
@@ -95,6 +113,8 @@ class DataHandler(Access):
 
     @property
     def search(self):
+        if self._metasearch is None:
+            self._metasearch = MetadataSearchHandler()
         self._metasearch.reset()
         self._metasearch["category"] = querying.text.exact(self.category)
         self._metasearch["metatype"] = querying.text.exact(self.entity)
@@ -105,39 +125,103 @@ class DataHandler(Access):
 
     @property
     def is_next(self) -> bool:
-        """ A boolean that determines if there's anything next """
-
-        next_data = self.closest_head()
-        next_keys = list(next_data.keys())
-        if len(next_keys) == 0:
+        """ A boolean that determines if there's anything next. Reads the stats instead of pulling the next event. """
+        stats = self.stats()
+        if stats.get("count", 0) == 0:
             return False
-        return True
+        if self.is_robust:
+            return True
+        return stats["max_time"] >= self.time.head
 
     @property
     def preprocessor(self) -> DataProcessorsAbstract:
+        if self._preprocessor is None:
+            self._preprocessor = DynamicResample("data")
         return self._preprocessor
 
     @preprocessor.setter
     def preprocessor(self, _preprocessor: DataProcessorsAbstract):
         self._preprocessor = _preprocessor
 
+    @property
+    def engine(self) -> str:
+        """ 
+            The storage engine for the data.
+
+            * `zset` - Every row is its own event (default).
+            * `columnar` - Rows are packed into compressed column chunks by time bucket. Far smaller for dense bars.
+        """
+        return self._engine
+
+    @engine.setter
+    def engine(self, _engine: str):
+        if _engine not in ["zset", "columnar"]:
+            raise ValueError("The engine must either be 'zset' or 'columnar'")
+        self._engine = _engine
+
+    @property
+    def is_columnar(self) -> bool:
+        return self._engine == "columnar"
+
+    @property
+    def rollups(self) -> bool:
+        """ 
+            Keep 1m, 1h and 1d rollup tiers of the data up to date on every write (zset engine only).
+
+            `dataframe_from_head` then reads whole buckets from the coarsest tier that fits the resample rules
+            instead of resampling every raw event in the window.
+        """
+        return self._rollups
+
+    @rollups.setter
+    def rollups(self, _rollups: bool):
+        self._rollups = _rollups
+
     def _timestamp_resample_and_drop(
         self, frame: pd.DataFrame, resample_size="D"
     ):
         timestamps = pd.to_datetime(frame.time, unit="s")
         frame.set_index(timestamps, inplace=True)
         frame = frame.drop(
-            columns=["timestamp", "type", "subcategories", "category", "time"]
+            columns=["timestamp", "type", "subcategories", "category", "time"],
+            errors="ignore"
         )
-        frame = frame.resample(resample_size).mean()
+        if self.resample_how == "ohlcv":
+            numeric = frame.select_dtypes(include="number")
+            frame = numeric.resample(resample_size).agg(
+                {column: rollups.OHLCV.get(column, "mean") for column in numeric.columns}
+            )
+        else:
+            frame = frame.resample(resample_size).mean()
         frame = frame.fillna(method="ffill")
         return frame
 
+    def _chunkable_frame(self, dataframe: pd.DataFrame, is_bar=False):
+        """ Move the time index into a `time` column (epoch seconds) so the frame can be chunked. """
+        frame = dataframe.copy()
+        if is_bar == True:
+            renamed = self.main_helper.generic_standardize(
+                {column: column for column in frame.columns}
+            )
+            frame = frame.rename(columns={v: k for k, v in renamed.items()})
+        if isinstance(frame.index, pd.DatetimeIndex):
+            times = frame.index.asi8 / 1e9
+        else:
+            times = frame.index.to_numpy(dtype=np.float64) * 0.001
+        frame = frame.reset_index(drop=True)
+        frame["time"] = times
+        return frame
+
     def store_time_df(self, dataframe: pd.DataFrame, is_bar=False):
         """ 
             Breaks a dataframe into parts then stores them into redis. 
             Use to handle time series data. Dataframe must have time index
         """
+        if self.is_columnar:
+            self.check()
+            frame = self._chunkable_frame(dataframe, is_bar=is_bar)
+            self.processor.event.save_chunked(self.setup_query(), frame)
+            return
         storable_list = self.main_helper.convert_dataframe_to_storable_item_list(
             dataframe
         )
@@ -152,23 +236,142 @@ class DataHandler(Access):
             data_dict_list = self.main_helper.standardize_outputs(
                 data_dict_list
             )
+        if self.is_columnar:
+            self.check()
+            frame = pd.DataFrame(data_dict_list)
+            if "time" not in frame.columns:
+                frame["time"] = maya.now()._epoch
+            self.processor.event.save_chunked(self.setup_query(), frame)
+            return
         self.save_many(data_dict_list)
 
+    """
+        ## Saves
+        ---
+        With rollups on, every save recomputes the rollup buckets its events landed in.
+    """
+
+    def _write_times(self, items: list) -> Tuple[list, bool]:
+        """ The relative times of a write and whether some items had none. Read before saving, which pops them. """
+        if not self.rollups:
+            return [], False
+        times = [float(item["time"]) for item in items if "time" in item]
+        untimed = len(times) < len(items)
+        if untimed:
+            # Items without a time are saved at the current time
+            times.append(maya.now()._epoch)
+        return times, untimed
+
+    def _rollup_span(self, times: list, untimed: bool) -> Optional[Tuple[float, float]]:
+        if len(times) == 0:
+            return None
+        if untimed:
+            times = times + [maya.now()._epoch]
+        return min(times), max(times)
+
+    def save(self, data: dict, alt={}):
+        times, untimed = self._write_times([data])
+        super().save(data, alt=alt)
+        span = self._rollup_span(times, untimed)
+        if span is not None:
+            self.processor.event.update_rollups(self.setup_query(alt), *span)
+
+    def save_many(self, data: list, ar="absolute", alt={}):
+        times, untimed = self._write_times(data)
+        super().save_many(data, ar=ar, alt=alt)
+        span = self._rollup_span(times, untimed)
+        if span is not None:
+            self.processor.event.update_rollups(self.setup_query(alt), *span)
+
+    async def asave(self, data: dict, alt={}):
+        times, untimed = self._write_times([data])
+        await super().asave(data, alt=alt)
+        span = self._rollup_span(times, untimed)
+        if span is not None:
+            await self.processor.event.aupdate_rollups(self.setup_query(alt), *span)
+
+    async def asave_many(self, data: list, alt={}):
+        times, untimed = self._write_times(data)
+        await super().asave_many(data, alt=alt)
+        span = self._rollup_span(times, untimed)
+        if span is not None:
+            await self.processor.event.aupdate_rollups(self.setup_query(alt), *span)
+
+    def rebuild_rollups(self):
+        """ Build the rollup tiers again from every stored event. Use it after deletes, trims or turning rollups on for old data. """
+        self.check()
+        self.processor.event.rebuild_rollups(self.setup_query())
+
+    def rollup_tiers(self, resample_size="D") -> list:
+        """ The tiers that can be resampled exactly into both our resample size and the rule the preprocessor asks for. """
+        rules = [resample_size]
+        generate_time_string = getattr(self.preprocessor, "generate_time_string", None)
+        if generate_time_string is not None:
+            rules.append(generate_time_string())
+        return [tier for tier, _ in rollups.tiers_for(rules)]
+
+    def dataframe_from_rollups(self, min_epoch: float, max_epoch: float, resample_size="D", how: Optional[str] = None):
+        """ 
+            Get a resampled dataframe between two relative times from the rollup tiers.
+            `how` is either `mean` or `ohlcv` for price bars. It defaults to `resample_how`, so the frame matches resampling the raw events.
+            Returns None when no tier fits or the tiers weren't built, so the caller can read the raw events.
+        """
+        if self.is_columnar:
+            return None
+        self.check()
+        tiers = self.rollup_tiers(resample_size)
+        if len(tiers) == 0:
+            return None
+        states = self.processor.event.get_rollups_between(
+            self.setup_query(), min_epoch, max_epoch, tiers
+        )
+        if states is None:
+            return None
+        frame = rollups.resample(states, resample_size, how=how or self.resample_how)
+        frame = frame.fillna(method="ffill")
+        return frame
+
+    def in_between_frame(self, min_epoch: float, max_epoch: float, ar="relative", alt={}) -> pd.DataFrame:
+        """ Get a raw dataframe between two epochs from whichever engine we're using. Doesn't build a dict per event. """
+        self.check()
+        if not self.main_helper.is_abs_rel(ar):
+            return pd.DataFrame()
+        query = self.setup_query(alt)
+        if self.is_columnar:
+            return self.processor.event.get_chunked_between(
+                query, min_epoch, max_epoch, abs_rel=ar
+            )
+        return self.processor.event.get_between_frame(
+            query, min_epoch, max_epoch, abs_rel=ar
+        )
+
     def dataframe_from_head(self):
         """ Get a dataframe between a head and tail. Resample according to our settings"""
 
         head = self.time.head
         tail = self.time.tail
-        values = self.in_between(tail, head, ar="relative")
+        if self.rollups:
+            frame = self.dataframe_from_rollups(tail, head)
+            if frame is not None:
+                return frame
+        frame = self.in_between_frame(tail, head, ar="relative")
+        frame = self._timestamp_resample_and_drop(frame)
+        return frame
+
+    def dataframe_from_events(self, values: list):
+        """ Turn a list of events into a dataframe. Resample according to our settings"""
         frame = pd.DataFrame(values)
         frame = self._timestamp_resample_and_drop(frame)
         return frame
 
     def dataframe_all(self):
         """ Get a dataframe between a head and tail. Resample according to our settings"""
-
-        values = self.query_all()
-        frame = pd.DataFrame(values)
+        if self.is_columnar:
+            self.check()
+            frame = self.processor.event.get_chunked_all(self.setup_query())
+        else:
+            self.check()
+            frame = self.processor.event.get_all_frame(self.setup_query())
         frame = self._timestamp_resample_and_drop(frame)
         return frame
 
@@ -177,8 +380,7 @@ class DataHandler(Access):
 
         head = self.time.peak_back_num(n_head)
         tail = self.time.peak_back_num_tail(n_tail)
-        values = self.in_between(tail, head, ar="relative")
-        frame = pd.DataFrame(values)
+        frame = self.in_between_frame(tail, head, ar="relative")
         frame = self._timestamp_resample_and_drop(frame)
         return frame
 
@@ -193,8 +395,13 @@ class DataHandler(Access):
     def closest_head(self, is_robust=False):
         """ Get the closest information at the given head. Otherwise get the latest information"""
         head = self.time.head
-        count = self.count()
-        closest = self.last_by(head, ar="relative")
+        stats = self.stats()
+        count = stats.get("count", 0)
+        if count == 0:
+            return {}
+        closest = {}
+        if stats["max_time"] >= head:
+            closest = self.last_by(head, ar="relative")
         if len(closest) == 0:
             if (is_robust or self.is_robust) and count > 0:
                 last = self.last(ar="relative")
@@ -285,6 +492,123 @@ class DataHandler(Access):
         closest = omit(omit_list, closest)
         return closest
 
+    """
+        # Columnar Overrides
+        ---
+        Route the common event queries to the chunk store when the columnar engine is set.
+    """
+
+    def count(self, alt={}) -> int:
+        if not self.is_columnar:
+            return super().count(alt=alt)
+        self.check()
+        return self.processor.event.count_chunked(self.setup_query(alt))
+
+    def stats(self, alt={}) -> dict:
+        if not self.is_columnar:
+            return super().stats(alt=alt)
+        self.check()
+        return self.processor.event.stats_chunked(self.setup_query(alt))
+
+    def last(self, ar="absolute", alt={}):
+        if not self.is_columnar:
+            return super().last(ar=ar, alt=alt)
+        self.check()
+        return self.processor.event.get_chunked_latest(self.setup_query(alt))
+
+    def many(self, limit=1000, ar="absolute", alt={}):
+        if not self.is_columnar:
+            return super().many(limit=limit, ar=ar, alt=alt)
+        self.check()
+        frame = self.processor.event.get_chunked_all(self.setup_query(alt))
+        return frame.tail(limit).to_dict("records")
+
+    def last_by(self, time_index: float, ar="absolute", alt={}):
+        if not self.is_columnar:
+            return super().last_by(time_index, ar=ar, alt=alt)
+        self.check()
+        return self.processor.event.get_chunked_latest_by(
+            self.setup_query(alt), time_index
+        )
+
+    def in_between(
+        self, min_epoch: float, max_epoch: float, ar: str = "absolute", alt={}
+    ):
+        if not self.is_columnar:
+            return super().in_between(min_epoch, max_epoch, ar=ar, alt=alt)
+        self.check()
+        frame = self.processor.event.get_chunked_between(
+            self.setup_query(alt), min_epoch, max_epoch, abs_rel=ar
+        )
+        return frame.to_dict("records")
+
+    def query_all(self, alt={}):
+        if not self.is_columnar:
+            return super().query_all(alt=alt)
+        self.check()
+        frame = self.processor.event.get_chunked_all(self.setup_query(alt))
+        return frame.to_dict("records")
+
+    def iter_between(
+        self, min_epoch: float, max_epoch: float, ar="absolute", chunk_size: int = 1000, alt={}
+    ):
+        if not self.is_columnar:
+            return super().iter_between(
+                min_epoch, max_epoch, ar=ar, chunk_size=chunk_size, alt=alt
+            )
+        self.check()
+        return self._iter_chunked(
+            self.setup_query(alt), min_epoch, max_epoch, ar, chunk_size
+        )
+
+    def iter_all(self, chunk_size: int = 1000, alt={}):
+        if not self.is_columnar:
+            return super().iter_all(chunk_size=chunk_size, alt=alt)
+        return self.iter_between(
+            float("-inf"), float("inf"), ar="relative", chunk_size=chunk_size, alt=alt
+        )
+
+    def _iter_chunked(self, query: dict, min_epoch, max_epoch, ar, chunk_size: int):
+        """ Re-slice the rows of each stored chunk into batches of `chunk_size`. """
+        for rows in self.processor.event.iter_chunked_between(
+            query, min_epoch, max_epoch, abs_rel=ar
+        ):
+            for i in range(0, len(rows), chunk_size):
+                yield rows[i:i + chunk_size]
+
+    def delete_all(self, alt={}):
+        if not self.is_columnar:
+            return super().delete_all(alt=alt)
+        self.check()
+        self.processor.event.delete_chunked(self.setup_query(alt))
+
+    async def _in_executor(self, method: str, *args, **kwargs):
+        """ The chunk store has no async client. Run the sync call on a fork, on the processor's executor, so it doesn't block the loop. """
+        self.check()
+        return await self.processor.executor.arun(getattr(self.fork(), method), *args, **kwargs)
+
+    async def acount(self, alt={}) -> int:
+        if not self.is_columnar:
+            return await super().acount(alt=alt)
+        return await self._in_executor("count", alt=alt)
+
+    async def alast(self, ar="absolute", alt={}):
+        if not self.is_columnar:
+            return await super().alast(ar=ar, alt=alt)
+        return await self._in_executor("last", ar=ar, alt=alt)
+
+    async def amany(self, limit=1000, ar="absolute", alt={}):
+        if not self.is_columnar:
+            return await super().amany(limit=limit, ar=ar, alt=alt)
+        return await self._in_executor("many", limit=limit, ar=ar, alt=alt)
+
+    async def ain_between(
+        self, min_epoch: float, max_epoch: float, ar: str = "absolute", alt={}
+    ):
+        if not self.is_columnar:
+            return await super().ain_between(min_epoch, max_epoch, ar=ar, alt=alt)
+        return await self._in_executor("in_between", min_epoch, max_epoch, ar=ar, alt=alt)
+
     def previous_head(self):
         """ Get the closest information at the given head"""
         head = self.time.peak_back()
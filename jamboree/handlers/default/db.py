@@ -1,6 +1,8 @@
 import copy
-import inspect
-from typing import Any, Dict, Optional, AnyStr
+import functools
+import operator
+from concurrent.futures import Future
+from typing import Any, Dict, Iterator, List, Optional, AnyStr
 
 import ujson
 from loguru import logger
@@ -10,7 +12,22 @@ from jamboree.base.processors.abstracts import EventProcessor, Processor
 from jamboree.handlers.base import BaseHandler
 from jamboree.handlers.default.search import BaseSearchHandler
 from jamboree.utils import memoized_method
-from jamboree.utils.helper import Helpers
+from jamboree.utils.helper import BoundKey, Helpers
+
+
+@functools.lru_cache(maxsize=None)
+def _slot_names(cls) -> tuple:
+    """ 
+        The slots declared by a handler class and its bases, a getter reading all of them at once,
+        and whether its instances have a `__dict__` (some class in between didn't declare slots).
+    """
+    names = []
+    for klass in cls.__mro__:
+        for name in klass.__dict__.get("__slots__", ()):
+            if name not in ("__weakref__", "__dict__") and name not in names:
+                names.append(name)
+    has_dict = any("__slots__" not in klass.__dict__ for klass in cls.__mro__ if klass is not object)
+    return tuple(names), operator.attrgetter(*names), has_dict
 
 
 class DBHandler(BaseHandler):
@@ -19,20 +36,41 @@ class DBHandler(BaseHandler):
         ---
         
         Currently uses zadd to work
+
+        The handler's query is checked and bound to its storage key once (see `bound`).
+        Setting a field (`handler[key] = value`), the `entity`, the `required` fields, `query` or `data` rebinds it.
+        Change fields through those, not by editing `query` or `data` in place.
+
+        `fork` makes a cheap handler for another query from this one (`handler.fork(name="ETH")`).
+
+        Handlers keep their attributes in `__slots__` so large universes of them stay small.
+        Subclasses declare slots for the attributes they add. Ones that don't get a `__dict__` as usual.
     """
+    __slots__ = (
+        "_metatype", "_entity", "_required", "_query", "_data", "_key", "_checked", "_shared",
+        "_is_event", "_processor", "event_proc", "__weakref__",
+    )
+    # Stateless, so every handler uses the same one
+    main_helper = Helpers()
+
     def __init__(self):
         # print("DBHandler")
         self._metatype = "event"
         self._entity = ""
         self._required = {}
         self._query = {}
-        self.data = {}
+        self._data = {}
+        self._key: Optional[BoundKey] = None
+        self._checked = False
+        self._shared = False
         self._is_event = True
         self._processor: Optional[Processor] = None
         self.event_proc: Optional[EventProcessor] = None
-        self.main_helper = Helpers()
 
     def __setitem__(self, key, value):
+        self.unbind()
+        if self._shared:
+            self._own()
         if bool(self.required):
             if key in self.required:
                 self._query[key] = value
@@ -53,6 +91,38 @@ class DBHandler(BaseHandler):
             self._query, self.entity, self._metatype, self.data, alt
         )
 
+    def bound(self, alt={}) -> BoundKey:
+        """ 
+            The handler's query, hashed once and reused by every call until the handler changes.
+            Queries with an `alt` are bound on every call.
+        """
+        if len(alt) > 0:
+            return self.main_helper.bind(self.setup_query(alt))
+        key = self._key
+        if key is None:
+            key = self._key = self.main_helper.bind(self.setup_query())
+        return key
+
+    def _own(self):
+        """ Take private copies of the query and data dicts a fork shares. """
+        self._query = dict(self._query)
+        self._data = dict(self._data)
+        self._shared = False
+
+    def unbind(self):
+        """ Drop the bound key and the passed check. The next call checks and binds the handler again. """
+        self._key = None
+        self._checked = False
+
+    @property
+    def data(self) -> Dict[str, Any]:
+        return self._data
+
+    @data.setter
+    def data(self, _data: Dict[str, Any]):
+        self.unbind()
+        self._data = _data
+
     def setup_key_with_lru(
         self, query: dict, entity: str, metatype: str, data: dict, alt: dict
     ):
@@ -101,6 +171,7 @@ class DBHandler(BaseHandler):
 
     @entity.setter
     def entity(self, _entity: str):
+        self.unbind()
         self._entity = str(_entity)
 
     @property
@@ -110,6 +181,7 @@ class DBHandler(BaseHandler):
     @required.setter
     def required(self, _required: Dict[str, Any]):
         # check to make sure it's not empty
+        self.unbind()
         self._required = _required
 
     @property
@@ -119,9 +191,12 @@ class DBHandler(BaseHandler):
     @query.setter
     def query(self, _query: Dict[str, Any]):
         if len(_query.keys()) > 0:
+            self.unbind()
             self._query = _query
 
     def check(self):
+        if self._checked:
+            return True
 
         # self.processor
         # if self.event_proc is None:
@@ -149,24 +224,25 @@ class DBHandler(BaseHandler):
                 )
             if not isinstance(self._query[req], _type):
                 raise AttributeError(f"{req} is not a {_type}")
+        self._checked = True
         return True
 
     def _get_many(self, limit: int, ar: str, alt={}):
         """ Aims to get many variables """
-        query = self.setup_query(alt)
+        query = self.bound(alt)
         latest_many = self.processor.event.get_latest_many(
             query, abs_rel=ar, limit=limit
         )
         return latest_many
 
     def _get_latest(self, ar, alt={}):
-        query = self.setup_query(alt)
+        query = self.bound(alt)
 
         latest = self.processor.event.get_latest(query, abs_rel=ar)
         return latest
 
     def _last_by(self, time_index: float, ar="absolute", alt={}) -> dict:
-        query = self.setup_query(alt)
+        query = self.bound(alt)
         return self.processor.event.get_latest_by(
             query, time_index, abs_rel=ar
         )
@@ -178,14 +254,14 @@ class DBHandler(BaseHandler):
         ar: str = "absolute",
         alt={}
     ):
-        query = self.setup_query(alt)
+        query = self.bound(alt)
         return self.processor.event.get_between(
             query, min_epoch, max_epoch, abs_rel=ar
         )
 
     def save(self, data: dict, alt={}):
         self.check()
-        query = self.setup_query(alt)
+        query = self.bound(alt)
         if self.is_event:
             data = self.main_helper.add_event_id(data)
         self.processor.event.save(query, data)
@@ -194,7 +270,7 @@ class DBHandler(BaseHandler):
         self.check()
         if not self.main_helper.is_abs_rel(ar):
             return
-        query = self.setup_query(alt)
+        query = self.bound(alt)
         if self.is_event:
             data = self.main_helper.add_event_ids(data)
         self.processor.event.save_many(query, data)
@@ -203,24 +279,22 @@ class DBHandler(BaseHandler):
         self.check()
         if not self.main_helper.is_abs_rel(ar):
             return {}
-        alt.update(self.data)
         return self._get_latest(ar=ar, alt=alt)
 
     def many(self, limit=1000, ar="absolute", alt={}):
         self.check()
         if not self.main_helper.is_abs_rel(ar):
             return []
-        alt.update(self.data)
         return self._get_many(limit, ar, alt=alt)
 
     def pop(self, alt={}):
         self.check()
-        query = self.setup_query(alt)
+        query = self.bound(alt)
         self.processor.event.remove_first(query)
 
     def pop_many(self, _limit, alt={}):
         self.check()
-        query = self.setup_query(alt)
+        query = self.bound(alt)
         return self.processor.event.pop_multiple(query, _limit)
 
     def last_by(self, time_index: float, ar="absolute", alt={}):
@@ -243,15 +317,41 @@ class DBHandler(BaseHandler):
         items = self._in_between(min_epoch, max_epoch, ar=ar, alt=alt)
         return items
 
+    def in_between_many(
+        self,
+        handlers: List["DBHandler"],
+        min_epoch,
+        max_epoch,
+        ar: str = "absolute"
+    ) -> List[list]:
+        """ 
+            Get the events between two epochs for many handlers in a single round trip using this handler's processor.
+            
+            Pass one window for all of them or lists of windows (one per handler). Returns a list of events per handler, in order.
+        """
+        if not self.main_helper.is_abs_rel(ar):
+            return [[] for _ in handlers]
+        queries = []
+        for handler in handlers:
+            handler.check()
+            queries.append(handler.bound())
+        results = self.processor.event.get_between_many(
+            queries, min_epoch, max_epoch, abs_rel=ar
+        )
+        return [
+            results.get(self.main_helper.generate_hash(query), [])
+            for query in queries
+        ]
+
     def count(self, alt={}) -> int:
         """ Aims to get many variables """
         self.check()
-        query = self.setup_query(alt)
+        query = self.bound(alt)
         return self.processor.event.count(query)
 
     def get_single(self, alt={}, is_serialized=True):
         self.check()
-        query = self.setup_query(alt)
+        query = self.bound(alt)
         item = self.processor.event.single_get(
             query, is_serialized=is_serialized
         )
@@ -259,69 +359,268 @@ class DBHandler(BaseHandler):
 
     def set_single(self, data: dict, alt={}, is_serialized=True):
         self.check()
-        query = self.setup_query(alt)
+        query = self.bound(alt)
         self.processor.event.single_set(
             query, data, is_serialized=is_serialized
         )
 
     def delete_single(self, alt={}, is_dumps=False):
         self.check()
-        query = self.setup_query(alt)
+        query = self.bound(alt)
         self.processor.event.single_delete(query)
 
     def delete_all(self, alt={}):
         self.check()
-        query = self.setup_query(alt)
+        query = self.bound(alt)
         self.processor.event.delete_all(query)
 
+    def set_retention(self, max_len: int = 0, max_age: float = 0.0, age_by: str = "relative"):
+        """ 
+            Cap the event logs of this handler's entity. Applies to every handler with the same entity.
+            
+            Keep the newest `max_len` events, drop events older than `max_age` seconds, or both. Zero turns a cap off.
+        """
+        if not bool(self._entity):
+            raise AttributeError("Entity hasn't been set")
+        return self.processor.event.set_retention(
+            self.entity, max_len=max_len, max_age=max_age, age_by=age_by
+        )
+
+    def set_codec(self, codec: str = "json", fields: Optional[Dict[str, str]] = None):
+        """ 
+            Set how the events of this handler's entity are encoded. Only keys created afterwards change.
+
+            `json` (default), `msgpack`, or `struct` with the kind of every field stored once:
+            
+            ```
+                handler.set_codec("struct", {"open": "float", "close": "float", "volume": "int"})
+            ```
+        """
+        if not bool(self._entity):
+            raise AttributeError("Entity hasn't been set")
+        return self.processor.event.set_codec(self.entity, codec=codec, fields=fields)
+
+    def delete_all_many(self, handlers: List["DBHandler"]):
+        """ Delete every event of many handlers in one call using this handler's processor. """
+        queries = []
+        for handler in handlers:
+            if getattr(handler, "is_columnar", False):
+                handler.delete_all()
+                continue
+            handler.check()
+            queries.append(handler.bound())
+        if len(queries) > 0:
+            self.processor.event.delete_all_many(queries)
+
     def query_all(self, alt: Dict[str, Any] = {}):
         self.check()
-        query = self.setup_query(alt)
+        query = self.bound(alt)
         items = self.processor.event.get_all(query)
         return items
 
+    def iter_between(
+        self,
+        min_epoch: float,
+        max_epoch: float,
+        ar: str = "absolute",
+        chunk_size: int = 1000,
+        alt={}
+    ) -> Iterator[list]:
+        """ Stream the events between two epochs in batches. Use this instead of `in_between` on very large keys. """
+        self.check()
+        if not self.main_helper.is_abs_rel(ar):
+            return iter([])
+        query = self.bound(alt)
+        return self.processor.event.iter_between(
+            query, min_epoch, max_epoch, abs_rel=ar, chunk_size=chunk_size
+        )
+
+    def iter_all(self, chunk_size: int = 1000, alt: Dict[str, Any] = {}) -> Iterator[list]:
+        """ Stream every event in batches. The streaming version of `query_all`. """
+        self.check()
+        query = self.bound(alt)
+        return self.processor.event.iter_all(query, chunk_size=chunk_size)
+
+    def stats(self, alt: Dict[str, Any] = {}) -> dict:
+        """ Get the count, min/max time and last write time in one read. """
+        self.check()
+        query = self.bound(alt)
+        return self.processor.event.stats(query)
+
     def get_minimum_time(self, alt: Dict[str, Any] = {}):
         self.check()
-        _query = self.setup_query(alt)
+        _query = self.bound(alt)
         _time = self.processor.event.min_time(_query)
         return _time
 
     def get_maximum_time(self, alt: Dict[str, Any] = {}):
         self.check()
-        _query = self.setup_query(alt)
+        _query = self.bound(alt)
         _time = self.processor.event.max_time(_query)
         return _time
 
+    def _state(self) -> Dict[str, Any]:
+        """ Every attribute set on the handler, from its slots and its `__dict__` if it has one. """
+        names, getter, has_dict = _slot_names(type(self))
+        try:
+            state = dict(zip(names, getter(self)))
+        except AttributeError:
+            # Some slot was never set
+            state = {name: getattr(self, name) for name in names if hasattr(self, name)}
+        if has_dict:
+            state.update(self.__dict__)
+        return state
+
     def copy(self):
         """ Get everything about this DBHandler without the event inside """
-        # _event = self.event
-        # self.event = _event
-        current_dict = copy.copy(self.__dict__)
-        non_lock_types = {}
-        _process = self.processor
-        self._processor = None
-        for key, value in current_dict.items():
-            classified = type(value)
-            if inspect.isclass(classified):
-                if (
-                    isinstance(value, BaseHandler)
-                    or issubclass(classified, BaseHandler)
-                    or issubclass(classified, BaseSearchHandler)
-                ):
-                    non_lock_types[key] = value
-                    setattr(self, key, None)
-
-        self.clear_event()
-        copied: self = copy.deepcopy(self)
-        copied.processor = _process
-        for k, v in non_lock_types.items():
-            setattr(copied, k, v)
-
-        self.__dict__ = current_dict
-        self.processor = _process
+        state = self._state()
+        # Sub-handlers and the processor are shared with the copy, everything else is deep copied
+        memo = {id(self._processor): self._processor}
+        for value in state.values():
+            if isinstance(value, (BaseHandler, BaseSearchHandler)):
+                memo[id(value)] = value
+        state["event_proc"] = None
+        copied = self.__class__.__new__(self.__class__)
+        for name, value in state.items():
+            setattr(copied, name, copy.deepcopy(value, memo))
+        copied._shared = False
+        copied.unbind()
         return copied
 
+    def fork(self, **overrides) -> "DBHandler":
+        """ 
+            A new handler of the same type with this handler's processor, sub-handlers and configuration.
+            
+            The query and data dicts are shared until either handler sets a field, then that handler copies them.
+            `overrides` are set as fields of the fork. This handler is left as it is, so threads can fork the same one.
+            
+            ```
+                eth = handler.fork(name="ETH")
+            ```
+        """
+        # Flag before reading the dicts so a write racing the fork copies instead of leaking into it
+        self._shared = True
+        forked = self.__class__.__new__(self.__class__)
+        for name, value in self._state().items():
+            setattr(forked, name, value)
+        forked._shared = True
+        for key, value in overrides.items():
+            forked[key] = value
+        return forked
+
     def lock(self, alt={}):
         self.check()
-        query = self.setup_query(alt)
+        query = self.bound(alt)
         return self.processor.event.lock(query)
+
+    def buffered(self, max_events: int = 1000, max_latency: Optional[float] = 0.05):
+        """ 
+            Coalesce the saves of every handler on this processor until the block ends.
+
+            ```
+                with handler.buffered(max_events=500):
+                    for tick in ticks:
+                        handler.save(tick)
+            ```
+        """
+        return self.processor.event.buffered(max_events=max_events, max_latency=max_latency)
+
+    def batch(self, *watched: "DBHandler"):
+        """ 
+            Send the writes of every handler on this thread as one MULTI/EXEC pipeline when the block ends.
+            Nothing is written (and `WatchError` is raised) if this handler or one of `watched` was written by someone else first.
+
+            ```
+                with portfolio.batch(trades):
+                    portfolio.save(positions)
+                    trades.save(trade)
+            ```
+        """
+        queries = []
+        for handler in (self,) + watched:
+            handler.check()
+            queries.append(handler.bound())
+        return self.processor.batch(watch=queries)
+
+    """
+        # Futures
+        ---
+        Run save, many and in_between on the processor's executor and get a future back.
+        The call runs on a fork of the handler, so the handler can move on to another query right away.
+
+        ```
+            futures = [handler.fork(name=name).many_async(100) for name in names]
+            frames = [future.result() for future in futures]
+        ```
+    """
+
+    def _submit(self, method: str, *args, **kwargs) -> Future:
+        # Checked here so a bad handler fails in the caller, not inside of the future
+        self.check()
+        return self.processor.executor.submit(getattr(self.fork(), method), *args, **kwargs)
+
+    def save_async(self, data: dict, alt={}) -> Future:
+        return self._submit("save", data, alt=alt)
+
+    def many_async(self, limit=1000, ar="absolute", alt={}) -> Future:
+        return self._submit("many", limit=limit, ar=ar, alt=alt)
+
+    def in_between_async(self, min_epoch: float, max_epoch: float, ar: str = "absolute", alt={}) -> Future:
+        return self._submit("in_between", min_epoch, max_epoch, ar=ar, alt=alt)
+
+    """
+        # Async
+        ---
+        Coroutine versions of save, last, many, in_between and count for asyncio services.
+        They use the processor's async connection, so hundreds of handlers can read at once without blocking the loop.
+
+        ```
+            latest, count = await asyncio.gather(handler.alast(), handler.acount())
+        ```
+    """
+
+    async def asave(self, data: dict, alt={}):
+        self.check()
+        query = self.bound(alt)
+        if self.is_event:
+            data = self.main_helper.add_event_id(data)
+        await self.processor.event.asave(query, data)
+
+    async def asave_many(self, data: list, alt={}):
+        self.check()
+        query = self.bound(alt)
+        if self.is_event:
+            data = self.main_helper.add_event_ids(data)
+        await self.processor.event.asave_many(query, data)
+
+    async def alast(self, ar="absolute", alt={}):
+        self.check()
+        if not self.main_helper.is_abs_rel(ar):
+            return {}
+        query = self.bound(alt)
+        return await self.processor.event.aget_latest(query, abs_rel=ar)
+
+    async def amany(self, limit=1000, ar="absolute", alt={}):
+        self.check()
+        if not self.main_helper.is_abs_rel(ar):
+            return []
+        query = self.bound(alt)
+        return await self.processor.event.aget_latest_many(
+            query, abs_rel=ar, limit=limit
+        )
+
+    async def ain_between(
+        self, min_epoch: float, max_epoch: float, ar: str = "absolute", alt={}
+    ):
+        self.check()
+        if not self.main_helper.is_abs_rel(ar):
+            return []
+        query = self.bound(alt)
+        return await self.processor.event.aget_between(
+            query, min_epoch, max_epoch, abs_rel=ar
+        )
+
+    async def acount(self, alt={}) -> int:
+        self.check()
+        query = self.bound(alt)
+        return await self.processor.event.acount(query)
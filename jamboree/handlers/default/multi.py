@@ -89,6 +89,7 @@ class MultiDataManagement(Access):
         )
 
         self.is_real_filter: bool = kwargs.get("real_filter", True)
+        self.datasethandler.engine = kwargs.get("engine", "zset")
         self.metatype = self.entity
         self.category = "universe"
         self.submetatype = "price_bag"
@@ -262,7 +263,7 @@ class MultiDataManagement(Access):
         self.remove_multiple_datasources(source_list)
 
     def add_dataset_handler(self):
-        _copy = self.datasethandler.copy()
+        _copy = self.datasethandler.fork()
 
         str_copy = str(_copy)
         if str_copy in self.dup_check_list:
@@ -426,17 +427,35 @@ class MultiDataManagement(Access):
             call_type = "dataframe"
 
         data_set = {}
+        batched: List[DataHandler] = []
 
-        # We can multi-thread this
         for dataset in self.datasets:
             dataset_name = str(dataset)
             dataset.event = self.event
             dataset.processor = self.processor
             dataset.preprocessor = self.preprocessor
             if call_type == "dataframe":
-                data_set[dataset_name] = dataset.dataframe_from_head()
+                if dataset.is_columnar or dataset.rollups:
+                    # Both read their own store (chunks or rollup tiers), so they can't share the batched read
+                    data_set[dataset_name] = dataset.dataframe_from_head()
+                    continue
+                data_set[dataset_name] = None
+                batched.append(dataset)
             else:
                 data_set[dataset_name] = dataset.closest_head()
+
+        if len(batched) > 0:
+            # Every dataset shares our time handler. Read the window once and pull all of the raw zset datasets in one round trip.
+            # Cold events are merged by `get_between_many`, just like `dataframe_from_head` gets them.
+            head = self.time.head
+            tail = self.time.tail
+            self.datasethandler.processor = self.processor
+            values_list = self.datasethandler.in_between_many(
+                batched, tail, head, ar="relative"
+            )
+            for dataset, values in zip(batched, values_list):
+                data_set[str(dataset)] = dataset.dataframe_from_events(values)
+
         """ Remove this time step """
         self.sync()
         return data_set
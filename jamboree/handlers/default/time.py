@@ -23,6 +23,12 @@ class TimeHandler(DBHandler):
             current_time:float = time_handler.head
         ```
     """
+    __slots__ = (
+        "micro", "seconds", "minutes", "hours", "days", "weeks",
+        "step_micro", "step_seconds", "step_minutes", "step_hours", "step_days", "step_weeks",
+        "_head",
+    )
+
     def __init__(self):
         super().__init__()
         self.entity = "timeindexing"
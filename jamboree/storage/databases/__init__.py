@@ -1,4 +1,8 @@
 from .database import DatabaseConnection
 from .jmongo import MongoDatabaseConnection
 from .jredis import RedisDatabaseConnection
-from .jredis_zset import RedisDatabaseZSetsConnection as ZRedisDatabaseConnection 
\ No newline at end of file
+from .jredis_zset import RedisDatabaseZSetsConnection as ZRedisDatabaseConnection 
+from .jredis_chunks import RedisDatabaseChunksConnection as ChunkRedisDatabaseConnection
+from .jmemory import MemoryDatabaseConnection
+from .jsqlite import SQLiteDatabaseConnection
+from .jredis_zset_async import AsyncRedisDatabaseZSetsConnection as AsyncZRedisDatabaseConnection, async_client
\ No newline at end of file
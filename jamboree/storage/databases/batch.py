@@ -0,0 +1,120 @@
+"""
+    # Batches
+    ---
+    Queues every event write issued on one thread into a single MULTI/EXEC pipeline and sends it when the block ends.
+    A step writing to several handlers (portfolio, trades, metrics, the time head) costs one round trip and lands atomically.
+
+    Keys of the `watch` queries are WATCHed when the batch opens. If any of them changes before the batch is sent,
+    nothing is written and `redis.exceptions.WatchError` is raised. Use `transaction` to rerun the step until it goes through.
+
+    ```
+        with jam.batch(watch=[portfolio.bound()]):
+            portfolio.save(positions)
+            trades.save(trade)
+            time.head = next_head
+    ```
+
+    Reads inside of the block don't see the queued writes. Rollups of written keys are updated once the batch is sent.
+    An exception inside of the block drops every queued write.
+    The memory backend holds its lock for the block and queues each write, applied in order when the batch is sent.
+    The sqlite backend runs the block inside of one sqlite transaction, rolled back on an exception.
+"""
+from typing import Any, Callable, ContextManager, List, Optional, Set, Tuple
+
+from redis.client import Pipeline
+
+
+class Batch(object):
+    def __init__(self, connection, watch: List[str] = []) -> None:
+        self.connection = connection
+        self.watch = list(watch)
+        self.pipe: Optional[Pipeline] = None
+        self.hashes: Set[str] = set()
+        self._scope: Optional[ContextManager] = None
+        self._replies: List[Tuple[int, Callable]] = []
+        self._after: List[Callable] = []
+        self._hooks: List[Callable[[Set[str]], None]] = []
+        self._queued: List[Callable] = []
+        self._depth = 0
+
+    def __len__(self) -> int:
+        return 0 if self.pipe is None else len(self.pipe)
+
+    def reply(self, callback: Callable):
+        """ Call `callback` with the reply of the last queued command once the batch is sent. """
+        self._replies.append((len(self.pipe) - 1, callback))
+
+    def after(self, callback: Callable):
+        """ Call `callback` once the batch is sent. """
+        self._after.append(callback)
+
+    def queue(self, write: Callable):
+        """ Queue a write of a backend without a pipeline. Queued writes run in order when the batch is sent. """
+        self._queued.append(write)
+
+    def on_commit(self, hook: Callable[[Set[str]], None]):
+        """ Call `hook` with the hashes written by the batch once it's sent. """
+        if hook not in self._hooks:
+            self._hooks.append(hook)
+
+    def open(self) -> "Batch":
+        if self._depth == 0:
+            self._scope = self.connection.batch_scope()
+            if self._scope is not None:
+                self._scope.__enter__()
+            else:
+                self.pipe = self.connection.connection.pipeline()
+                if len(self.watch) > 0:
+                    self.pipe.watch(*self.watch)
+                self.pipe.multi()
+        self._depth += 1
+        return self
+
+    def _close(self, *exc: Any):
+        self.connection._batches.batch = None
+        if self.pipe is not None:
+            self.pipe.reset()
+        if self._scope is not None:
+            self._scope.__exit__(*(exc or (None, None, None)))
+
+    def execute(self) -> list:
+        """ Send every queued write. Raises `WatchError` (and writes nothing) if a watched key changed. """
+        try:
+            results = [] if self.pipe is None else self.pipe.execute()
+            # Writes issued from here on aren't part of the batch anymore
+            self.connection._batches.batch = None
+            for write in self._queued:
+                write()
+        finally:
+            self._close()
+        for position, callback in self._replies:
+            callback(results[position])
+        for callback in self._after:
+            callback()
+        for hook in self._hooks:
+            hook(self.hashes)
+        self.connection.metrics.incr("batch.commits")
+        self.connection.metrics.incr("batch.commands", len(results))
+        return results
+
+    def discard(self, *exc: Any):
+        """ Drop every queued write. Pass the exception that ended the block, if any. """
+        if len(exc) == 0 or exc[0] is None:
+            # Scopes roll back on an exception. Hand them one even when the batch is dropped by hand.
+            error = RuntimeError("The batch was discarded")
+            exc = (RuntimeError, error, None)
+        self._close(*exc)
+        self.connection.metrics.incr("batch.discards")
+
+    def __enter__(self) -> "Batch":
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        self._depth -= 1
+        if self._depth > 0:
+            return False
+        if exc_type is not None:
+            self.discard(exc_type, *exc)
+        else:
+            self.execute()
+        return False
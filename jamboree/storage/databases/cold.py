@@ -0,0 +1,385 @@
+"""
+    # Cold Tier
+    ---
+    Columnar files holding the older part of an event log, so the hot store only keeps a recent window.
+
+    Every spill writes Arrow IPC files under `{root}/{digest of the hash}/`. A `manifest.json` next to them lists each file
+    with its row count and time bounds, so reads only open the files overlapping the range.
+    Files are memory mapped when read. A wide scan is a column filter over the map, not a JSON parse per row.
+
+    A spill writes the file and records it as pending, removes exactly the spilled events from the hot store, then marks it done.
+    Reads skip pending files. If a spill dies in between, the next spill of the key removes whatever of the file is still hot
+    (files keep an `_id` column of member ids for that) and marks it done, so no event is lost or read twice.
+
+    Many processes can share a root. A spill holds an exclusive `fcntl` lock on the key's file under `{root}/.locks/` from start to end,
+    so spills of one key never interleave or drop each other's manifest entries. Readers reload the manifest when its file changes.
+    Without `fcntl` (Windows) the lock only covers the threads of this process.
+
+    Needs `pyarrow` (`pip install jamboree[cold]`). Enabling the tier fails right away without it.
+
+    ```
+        jam.event.enable_tiering("/data/cold", hot_window=86400, interval=300)
+        jam.event.get_between(query, min_epoch, max_epoch, "relative")  # merges both tiers
+    ```
+"""
+import hashlib
+import os
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import orjson
+import pandas as pd
+from loguru import logger
+
+from jamboree.utils.helper import score_bound
+from jamboree.utils.support.events.cereal import single_one
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+COLUMNS = {"relative": "time", "absolute": "timestamp"}
+
+
+def _arrow():
+    try:
+        import pyarrow
+        import pyarrow.compute
+        import pyarrow.ipc
+    except ImportError:
+        raise ImportError("The cold tier needs pyarrow installed. Install it with `pip install jamboree[cold]`.")
+    return pyarrow
+
+
+class ColdStore(object):
+    """
+        * `root` - the directory holding every key's files.
+        * `rows_per_file` - the most events a spill puts in one file.
+    """
+
+    def __init__(self, root: str, rows_per_file: int = 100000) -> None:
+        # Fail where the tier is set up, not on the first spill
+        _arrow()
+        self.root = root
+        self.rows_per_file = rows_per_file
+        self._lock = threading.RLock()
+        # The manifest of each hash and the (inode, mtime, size) of the file it was read from
+        self._manifests: Dict[str, Tuple[Optional[tuple], dict]] = {}
+        self._key_locks: Dict[str, threading.RLock] = {}
+        self._depths: Dict[str, int] = {}
+
+    def directory(self, _hash: str) -> str:
+        # Hashes can hold characters that don't belong in a path
+        return os.path.join(self.root, hashlib.sha1(_hash.encode("utf-8")).hexdigest())
+
+    def _lock_path(self, _hash: str) -> str:
+        # Outside of the key's directory, so deleting the key leaves nothing behind for waiters to miss
+        return os.path.join(self.root, ".locks", hashlib.sha1(_hash.encode("utf-8")).hexdigest())
+
+    def _stamp(self, stat: os.stat_result) -> tuple:
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def manifest(self, _hash: str) -> dict:
+        """ 
+            `{"hash": ..., "upto": ..., "files": [...]}`. `upto` is the relative time everything before was spilled.
+            Read again whenever the file changed since the last read, so spills of other processes show up.
+        """
+        path = os.path.join(self.directory(_hash), "manifest.json")
+        with self._lock:
+            cached = self._manifests.get(_hash)
+            try:
+                handle = open(path, "rb")
+            except FileNotFoundError:
+                if cached is None or cached[0] is not None:
+                    cached = (None, {"hash": _hash, "upto": float("-inf"), "files": []})
+                    self._manifests[_hash] = cached
+                return cached[1]
+            with handle:
+                # Stat the open file. The name can be replaced under us.
+                stamp = self._stamp(os.fstat(handle.fileno()))
+                if cached is not None and cached[0] == stamp:
+                    return cached[1]
+                manifest = orjson.loads(handle.read())
+            manifest["upto"] = float(manifest["upto"])
+            self._manifests[_hash] = (stamp, manifest)
+            return manifest
+
+    def _write_manifest(self, _hash: str, manifest: dict):
+        """ Replace the manifest file. Only while holding `locked`. """
+        directory = self.directory(_hash)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, "manifest.json")
+        temporary = path + f".{os.getpid()}.tmp"
+        stored = dict(manifest, upto=str(manifest["upto"]))
+        with open(temporary, "wb") as handle:
+            handle.write(orjson.dumps(stored))
+        os.replace(temporary, path)
+        with self._lock:
+            self._manifests[_hash] = (self._stamp(os.stat(path)), manifest)
+
+    @contextmanager
+    def locked(self, _hash: str):
+        """ Hold the files of a hash against other threads and processes. Re-entrant inside of a thread. """
+        with self._lock:
+            lock = self._key_locks.setdefault(_hash, threading.RLock())
+        with lock:
+            depth = self._depths.get(_hash, 0)
+            self._depths[_hash] = depth + 1
+            try:
+                if depth > 0 or fcntl is None:
+                    yield
+                    return
+                path = self._lock_path(_hash)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, "ab") as handle:
+                    fcntl.flock(handle.fileno(), fcntl.LOCK_EX)
+                    try:
+                        yield
+                    finally:
+                        fcntl.flock(handle.fileno(), fcntl.LOCK_UN)
+            finally:
+                self._depths[_hash] = depth
+
+    """
+        # Writes
+    """
+
+    def write(self, _hash: str, events: List[dict], ids: List[str], upto: float) -> Optional[dict]:
+        """ Write decoded events (with `time` and `timestamp`) and their member ids as one file and record it as pending. Returns its manifest entry. """
+        if len(events) == 0:
+            return None
+        pa = _arrow()
+        frame = pd.DataFrame.from_records(events)
+        frame["_id"] = ids
+        table = pa.Table.from_pandas(frame, preserve_index=False)
+        with self.locked(_hash):
+            manifest = self.manifest(_hash)
+            directory = self.directory(_hash)
+            os.makedirs(directory, exist_ok=True)
+            name = f"{len(manifest['files']):08d}-{os.getpid()}.arrow"
+            temporary = os.path.join(directory, name + ".tmp")
+            with pa.OSFile(temporary, "wb") as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+            os.replace(temporary, os.path.join(directory, name))
+
+            times, timestamps = table.column("time"), table.column("timestamp")
+            entry = {
+                "name": name,
+                "rows": table.num_rows,
+                "min_time": pa.compute.min(times).as_py(),
+                "max_time": pa.compute.max(times).as_py(),
+                "min_timestamp": pa.compute.min(timestamps).as_py(),
+                "max_timestamp": pa.compute.max(timestamps).as_py(),
+                "pending": True,
+            }
+            manifest["files"].append(entry)
+            manifest["upto"] = max(manifest["upto"], upto)
+            self._write_manifest(_hash, manifest)
+        return entry
+
+    def _done(self, _hash: str, entry: dict):
+        with self.locked(_hash):
+            manifest = self.manifest(_hash)
+            for stored in manifest["files"]:
+                if stored["name"] == entry["name"]:
+                    stored["pending"] = False
+            entry["pending"] = False
+            self._write_manifest(_hash, manifest)
+
+    def settle(self, connection, _hash: str) -> int:
+        """ Finish spills that died before their events left the hot store. Returns the number of hot events removed. """
+        pa = _arrow()
+        removed = 0
+        with self.locked(_hash):
+            for entry in [entry for entry in self.manifest(_hash)["files"] if entry.get("pending")]:
+                path = os.path.join(self.directory(_hash), entry["name"])
+                ids = set(pa.ipc.open_file(pa.memory_map(path, "r")).read_all().column("_id").to_pylist())
+                for triples in connection._pages(_hash, "relative", entry["min_time"], entry["max_time"], 10000):
+                    members = [member for member, _, _ in triples if connection.member_id(member) in ids]
+                    removed += connection.remove_members(_hash, members)
+                self._done(_hash, entry)
+                self._refresh(connection, _hash, entry)
+        return removed
+
+    def _move(self, connection, _hash: str, batch: List[dict], members: List[bytes], cutoff: float) -> int:
+        entry = self.write(_hash, batch, [connection.member_id(member) for member in members], cutoff)
+        moved = connection.remove_members(_hash, members)
+        self._done(_hash, entry)
+        self._refresh(connection, _hash, entry)
+        return moved
+
+    def _refresh(self, connection, _hash: str, entry: dict):
+        """ Recompute the rollups over a finished spill. Only now do reads see its file, so the buckets keep every event. """
+        connection.refresh_rollups(_hash, entry["min_time"], entry["max_time"])
+
+    def spill(self, connection, _hash: str, cutoff: float, chunk_size: int = 10000) -> int:
+        """
+            Move the events of a hash with a relative time before `cutoff` from an event connection into files.
+            Returns the number of events moved.
+        """
+        with self.locked(_hash):
+            return self._spill(connection, _hash, cutoff, chunk_size)
+
+    def _spill(self, connection, _hash: str, cutoff: float, chunk_size: int) -> int:
+        self.settle(connection, _hash)
+        moved = 0
+        while True:
+            batch: List[dict] = []
+            members: List[bytes] = []
+            pages = connection._pages(_hash, "relative", "-inf", f"({cutoff}", min(chunk_size, self.rows_per_file))
+            for triples in pages:
+                for member, _time, _timestamp in triples:
+                    event = single_one(member)
+                    event["time"] = _time
+                    event["timestamp"] = _timestamp
+                    batch.append(event)
+                    members.append(member)
+                if len(batch) >= self.rows_per_file:
+                    break
+            if len(batch) == 0:
+                return moved
+            moved += self._move(connection, _hash, batch, members, cutoff)
+            if len(batch) < self.rows_per_file:
+                return moved
+            # The page cursor doesn't survive removals. Start over from the (new) oldest event.
+
+    def delete(self, _hash: str) -> int:
+        """ Remove every file of a hash. Returns the number of files removed. """
+        with self.locked(_hash):
+            manifest = self.manifest(_hash)
+            directory = self.directory(_hash)
+            for entry in manifest["files"]:
+                path = os.path.join(directory, entry["name"])
+                if os.path.exists(path):
+                    os.remove(path)
+            removed = len(manifest["files"])
+            manifest_path = os.path.join(directory, "manifest.json")
+            if os.path.exists(manifest_path):
+                os.remove(manifest_path)
+            if os.path.isdir(directory) and len(os.listdir(directory)) == 0:
+                os.rmdir(directory)
+            with self._lock:
+                self._manifests.pop(_hash, None)
+        return removed
+
+    """
+        # Reads
+    """
+
+    def _files(self, _hash: str) -> List[dict]:
+        return [entry for entry in self.manifest(_hash)["files"] if not entry.get("pending")]
+
+    def count(self, _hash: str) -> int:
+        return sum(entry["rows"] for entry in self._files(_hash))
+
+    def stats(self, _hash: str) -> dict:
+        """ The count and time bounds of the cold events. Empty if nothing was spilled. """
+        files = self._files(_hash)
+        if len(files) == 0:
+            return {}
+        return {
+            "count": sum(entry["rows"] for entry in files),
+            "min_time": min(entry["min_time"] for entry in files),
+            "max_time": max(entry["max_time"] for entry in files),
+            "min_timestamp": min(entry["min_timestamp"] for entry in files),
+            "max_timestamp": max(entry["max_timestamp"] for entry in files),
+        }
+
+    def _tables(self, _hash: str, abs_rel: str, min_epoch, max_epoch) -> Iterator:
+        """ The rows of every file between two bounds, as memory mapped tables. """
+        pa = _arrow()
+        column = COLUMNS[abs_rel]
+        low, low_open = score_bound(min_epoch)
+        high, high_open = score_bound(max_epoch)
+        directory = self.directory(_hash)
+        for entry in list(self.manifest(_hash)["files"]):
+            if entry.get("pending") or entry[f"max_{column}"] < low or entry[f"min_{column}"] > high:
+                continue
+            source = pa.memory_map(os.path.join(directory, entry["name"]), "r")
+            table = pa.ipc.open_file(source).read_all()
+            values = table.column(column)
+            above = pa.compute.greater(values, low) if low_open else pa.compute.greater_equal(values, low)
+            below = pa.compute.less(values, high) if high_open else pa.compute.less_equal(values, high)
+            yield table.filter(pa.compute.and_(above, below)).drop(["_id"])
+
+    def frame(self, _hash: str, min_epoch="-inf", max_epoch="+inf", abs_rel: str = "relative") -> pd.DataFrame:
+        """ The cold events between two bounds as a dataframe, ordered by the requested time. """
+        frames = [table.to_pandas() for table in self._tables(_hash, abs_rel, min_epoch, max_epoch)]
+        frames = [frame for frame in frames if not frame.empty]
+        if len(frames) == 0:
+            return pd.DataFrame()
+        frame = pd.concat(frames, ignore_index=True, sort=False)
+        return frame.sort_values(COLUMNS[abs_rel], kind="mergesort", ignore_index=True)
+
+    def _events(self, table) -> List[dict]:
+        """ The rows of a table as event dicts. Columns an event never had are left out of it. """
+        return [{key: value for key, value in row.items() if value is not None} for row in table.to_pylist()]
+
+    def between(self, _hash: str, min_epoch="-inf", max_epoch="+inf", abs_rel: str = "relative") -> List[dict]:
+        """ The cold events between two bounds as event dicts. """
+        events = []
+        for table in self._tables(_hash, abs_rel, min_epoch, max_epoch):
+            events.extend(self._events(table))
+        events.sort(key=lambda event: event[COLUMNS[abs_rel]])
+        return events
+
+    def pages(
+        self, _hash: str, min_epoch="-inf", max_epoch="+inf", abs_rel: str = "relative", chunk_size: int = 1000
+    ) -> Iterator[List[dict]]:
+        """ Stream the cold events between two bounds in batches of `chunk_size`, one file at a time. Files are read in spill order. """
+        column = COLUMNS[abs_rel]
+        for table in self._tables(_hash, abs_rel, min_epoch, max_epoch):
+            table = table.sort_by(column)
+            for start in range(0, table.num_rows, chunk_size):
+                yield self._events(table.slice(start, chunk_size))
+
+    def first(self, _hash: str, min_epoch="-inf", abs_rel: str = "relative") -> dict:
+        """ The oldest cold event at or after `min_epoch`. Empty if there is none. """
+        column = COLUMNS[abs_rel]
+        first = {}
+        for table in self._tables(_hash, abs_rel, min_epoch, "+inf"):
+            if table.num_rows == 0:
+                continue
+            event = self._events(table.sort_by(column).slice(0, 1))[0]
+            if len(first) == 0 or event[column] < first[column]:
+                first = event
+        return first
+
+
+class ColdSpiller(object):
+    """ Calls `spill` on an event processor every `interval` seconds inside of a daemon thread. """
+
+    def __init__(self, events, interval: float = 300.0) -> None:
+        self.events = events
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.is_running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="jamboree-cold-spiller", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.events.spill()
+            except Exception as e:
+                logger.exception(e)
@@ -1,17 +1,22 @@
 from abc import ABC
-from jamboree.utils.helper import Helpers
-from pebble.pool import ThreadPool
-from multiprocessing import cpu_count
+import ujson
+from jamboree.utils.helper import Helpers, KEY_LOOKUP
+from jamboree.utils.executor import Executor, shared_executor
+from jamboree.utils.metrics import Metrics
 from typing import Union, Optional
 from redis import Redis
 from redis.client import Pipeline
+from redis.exceptions import ResponseError
 
 
 class DatabaseConnection(ABC):
     def __init__(self) -> None:
         self._connection: Optional[Union[Redis, Pipeline]] = None
         self.helpers = Helpers()
-        self._pool = ThreadPool(max_workers=(cpu_count() * 2))
+        self.metrics = Metrics()
+        self._remembered = set()
+        self._has_unlink = True
+        self._pool: Optional[Executor] = None
 
     @property
     def connection(self) -> Union[Redis, Pipeline]:
@@ -26,12 +31,33 @@ class DatabaseConnection(ABC):
         self._connection = _conn
 
     @property
-    def pool(self) -> ThreadPool:
+    def pool(self) -> Executor:
+        """ Runs background work. The process wide executor unless another was set. """
+        if self._pool is None:
+            return shared_executor()
         return self._pool
 
     @pool.setter
-    def pool(self, _pool: ThreadPool):
-        self.pool = _pool
+    def pool(self, _pool: Executor):
+        self._pool = _pool
+
+    def remember_key(self, _hash: str, query: dict):
+        """ Record digest key -> query so `Helpers.hash_to_dict` works on digest keys. Written once per key per connection. """
+        if _hash in self._remembered or not Helpers.key_lookup or not self.helpers.is_digest(_hash):
+            return
+        self.connection.hsetnx(KEY_LOOKUP, _hash, ujson.dumps(query, sort_keys=True))
+        self._remembered.add(_hash)
+
+    def unlink(self, *keys) -> int:
+        """ Remove keys without blocking redis. The memory is freed in the background. Falls back to DEL before redis 4. """
+        if len(keys) == 0:
+            return 0
+        if self._has_unlink:
+            try:
+                return self.connection.unlink(*keys)
+            except ResponseError:
+                self._has_unlink = False
+        return self.connection.delete(*keys)
 
     """ Save commands """
 
@@ -0,0 +1,537 @@
+"""
+    # Memory Connection
+    ---
+    An in-process event store with the same interface as `RedisDatabaseZSetsConnection`.
+
+    Use it when a single process owns the whole episode (offline backtests, tests).
+    There's no network stack and no serialization round trip to a server, so every step runs at memory speed.
+    Nothing is shared with other processes and nothing survives the process.
+
+    Each key keeps its events in two sorted orderings (relative and absolute time), just like the two zsets in redis.
+    An ordering is a pair of parallel python lists searched with `bisect`. Appends in time order are a plain list append.
+
+    ```
+        jam = Jamboree(BACKEND="memory")
+    ```
+"""
+import threading
+from bisect import bisect_left, bisect_right
+from copy import copy
+from functools import partial, wraps
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import maya
+import orjson
+
+from jamboree.storage.databases import rollups
+from jamboree.storage.databases.jredis_zset import RedisDatabaseZSetsConnection
+from jamboree.storage.databases.retention import NO_RETENTION, RetentionPolicy
+from jamboree.utils.helper import score_bound
+
+
+def deferred(empty=None):
+    """ Inside of a batch, queue the write of a hash until the batch is sent, and return `empty` for now. """
+
+    def wrap(method):
+        @wraps(method)
+        def write(self, _hash: str, *args, **kwargs):
+            batch = self.active_batch
+            if batch is None:
+                return method(self, _hash, *args, **kwargs)
+            batch.hashes.add(_hash)
+            batch.queue(partial(method, self, _hash, *args, **kwargs))
+            return empty
+
+        return write
+
+    return wrap
+
+
+class SortedScores(object):
+    """ Members ordered by score, then by member, like a redis zset. """
+
+    def __init__(self) -> None:
+        self.scores: List[float] = []
+        self.members: List[bytes] = []
+        self.lookup: Dict[bytes, float] = {}
+
+    def __len__(self) -> int:
+        return len(self.scores)
+
+    def _find(self, member: bytes, score: float) -> int:
+        low = bisect_left(self.scores, score)
+        high = bisect_right(self.scores, score, low)
+        return bisect_left(self.members, member, low, high)
+
+    def add(self, member: bytes, score: float) -> int:
+        """ Add a member or move it to a new score. Returns 1 for a new member, like ZADD. """
+        current = self.lookup.get(member)
+        if current is not None:
+            if current == score:
+                return 0
+            self.remove(member)
+        score = float(score)
+        if len(self.scores) == 0 or score > self.scores[-1] or (
+            score == self.scores[-1] and member > self.members[-1]
+        ):
+            self.scores.append(score)
+            self.members.append(member)
+        else:
+            position = self._find(member, score)
+            self.scores.insert(position, score)
+            self.members.insert(position, member)
+        self.lookup[member] = score
+        return 1 if current is None else 0
+
+    def remove(self, member: bytes) -> bool:
+        score = self.lookup.pop(member, None)
+        if score is None:
+            return False
+        position = self._find(member, score)
+        del self.scores[position]
+        del self.members[position]
+        return True
+
+    def by_rank(self, start: int, end: int) -> List[Tuple[bytes, float]]:
+        """ (member, score) pairs between two inclusive ranks. Negative ranks count from the end, like ZRANGE. """
+        size = len(self.scores)
+        if start < 0:
+            start = max(size + start, 0)
+        if end < 0:
+            end = size + end
+        end = min(end, size - 1)
+        if start > end:
+            return []
+        return list(zip(self.members[start : end + 1], self.scores[start : end + 1]))
+
+    def span(self, min_score, max_score) -> Tuple[int, int]:
+        """ The positions of the scores between two bounds. """
+        low, low_open = score_bound(min_score)
+        high, high_open = score_bound(max_score)
+        start = bisect_right(self.scores, low) if low_open else bisect_left(self.scores, low)
+        end = bisect_left(self.scores, high) if high_open else bisect_right(self.scores, high)
+        return start, max(start, end)
+
+    def by_score(self, min_score, max_score, start: Optional[int] = None, num: Optional[int] = None) -> List[Tuple[bytes, float]]:
+        """ (member, score) pairs between two bounds, with an optional offset and count like ZRANGEBYSCORE. """
+        low, high = self.span(min_score, max_score)
+        low += start or 0
+        if num is not None and num >= 0:
+            high = min(high, low + num)
+        return list(zip(self.members[low:high], self.scores[low:high]))
+
+
+class EventLog(object):
+    """ The events of one key, ordered by relative and by absolute time. """
+
+    def __init__(self) -> None:
+        self.relative = SortedScores()
+        self.absolute = SortedScores()
+        self.last_write = 0.0
+
+    def __len__(self) -> int:
+        return len(self.relative)
+
+    def ordering(self, abs_rel: str) -> SortedScores:
+        if abs_rel == "absolute":
+            return self.absolute
+        return self.relative
+
+    def add(self, member: bytes, _time: float, _timestamp: float) -> int:
+        added = self.relative.add(member, _time)
+        self.absolute.add(member, _timestamp)
+        return added
+
+    def remove(self, member: bytes) -> bool:
+        self.absolute.remove(member)
+        return self.relative.remove(member)
+
+
+class BucketStates(object):
+    """ The rollup states of one tier, ordered by bucket start. """
+
+    def __init__(self) -> None:
+        self.starts: List[float] = []
+        self.states: Dict[float, dict] = {}
+
+    def put(self, bucket: float, state: dict):
+        if bucket not in self.states:
+            self.starts.insert(bisect_left(self.starts, bucket), bucket)
+        self.states[bucket] = state
+
+    def drop(self, start: float, end: float):
+        """ Remove the buckets starting inside of `[start, end)`. """
+        low, high = bisect_left(self.starts, start), bisect_left(self.starts, end)
+        for bucket in self.starts[low:high]:
+            del self.states[bucket]
+        del self.starts[low:high]
+
+    def between(self, start: float, end: float) -> List[dict]:
+        """ The states of the buckets starting inside of `[start, end)`. """
+        low, high = bisect_left(self.starts, start), bisect_left(self.starts, end)
+        return [self.states[bucket] for bucket in self.starts[low:high]]
+
+
+class MemoryDatabaseConnection(RedisDatabaseZSetsConnection):
+    """
+        Keeps every event, single value, lock, retention policy and rollup in process.
+
+        Only the storage primitives are replaced. The public query methods are the redis connection's own,
+        so both backends decode and shape events the same way. The layout, write mode and read mode are accepted and ignored.
+        Every call is guarded by one re-entrant lock, so handlers on other threads of the same process are safe.
+        Writes inside of a batch are queued and applied together when it's sent, so an exception in the block drops all of them.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._retention = {}
+        self._codecs = {}
+        self._recorded: Dict[str, dict] = {}
+        self._guard = threading.RLock()
+        self._logs: Dict[str, EventLog] = {}
+        self._singles: Dict[str, bytes] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self._queries: Dict[str, dict] = {}
+        self._rollups: Dict[str, Dict[str, BucketStates]] = {}
+
+    def remember_key(self, _hash: str, query: dict):
+        """ Keep the query of every key so `compact` can find its policy. """
+        if _hash not in self._queries:
+            self._queries[_hash] = copy(query)
+
+    def batch_scope(self) -> threading.RLock:
+        """ Batches hold the lock for the whole block. Their writes are queued (see `deferred`) and applied under it. """
+        return self._guard
+
+    """
+        # Individual Access Methods
+    """
+
+    @deferred()
+    def _kill(self, _hash: str):
+        with self._guard:
+            self._singles.pop(_hash, None)
+
+    @deferred()
+    def _add(self, _hash: str, data: dict, is_serialized=True):
+        if is_serialized:
+            data = orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY)
+        elif isinstance(data, str):
+            data = data.encode("utf-8")
+        with self._guard:
+            self._singles[_hash] = data
+
+    def _get(self, _hash: str):
+        return self._singles.get(_hash)
+
+    """
+        # Save Commands
+    """
+
+    @deferred(0)
+    def _append(
+        self,
+        _hash: str,
+        events: List[Tuple[bytes, float, float]],
+        policy: RetentionPolicy = NO_RETENTION,
+    ) -> int:
+        """ Appends (member, relative time, absolute time) events and applies the retention policy. """
+        now = maya.now()._epoch
+        with self._guard:
+            log = self._logs.get(_hash)
+            if log is None:
+                log = self._logs[_hash] = EventLog()
+            added = 0
+            for member, _time, _timestamp in events:
+                added += log.add(member, _time, _timestamp)
+            trimmed = self._trim(log, policy, now)
+            self._count_trimmed(len(trimmed))
+            log.last_write = now
+            self._drop_empty(_hash)
+            if len(trimmed) > 0:
+                self.refresh_rollups(_hash, min(trimmed), max(trimmed))
+        return added
+
+    def _save(self, _hash: str, data: dict, timing: dict, policy: RetentionPolicy = NO_RETENTION):
+        serialized = self.key_codec(_hash).encode(data)
+        self._append(_hash, [(serialized, timing["time"], timing["timestamp"])], policy)
+
+    def _save_many(
+        self,
+        _hash: str,
+        relative_data: Dict[bytes, float] = {},
+        policy: RetentionPolicy = NO_RETENTION,
+    ):
+        timestamp = maya.now()._epoch
+        self._append(
+            _hash,
+            [(member, _time, timestamp) for member, _time in relative_data.items()],
+            policy,
+        )
+
+    """
+        # Delete Commands
+    """
+
+    def _drop_empty(self, _hash: str):
+        log = self._logs.get(_hash)
+        if log is not None and len(log) == 0:
+            del self._logs[_hash]
+
+    @deferred()
+    def _delete(self, _hash: str, details: dict):
+        deletion_key = self.key_codec(_hash).encode(details)
+        with self._guard:
+            log = self._logs.get(_hash)
+            if log is None:
+                return
+            _time = log.relative.lookup.get(deletion_key)
+            log.remove(deletion_key)
+            log.last_write = maya.now()._epoch
+            self._drop_empty(_hash)
+            self.refresh_rollups(_hash, _time, _time)
+
+    @deferred(0)
+    def remove_members(self, _hash: str, members: List[bytes]) -> int:
+        now = maya.now()._epoch
+        with self._guard:
+            log = self._logs.get(_hash)
+            if log is None:
+                return 0
+            removed = sum(1 for member in members if log.remove(member))
+            log.last_write = now
+            self._drop_empty(_hash)
+        return removed
+
+    @deferred(0)
+    def _delete_all(self, _hash: str) -> int:
+        """ Drop the events and rollups of a hash. Returns how many of the two existed. """
+        with self._guard:
+            removed = int(self._logs.pop(_hash, None) is not None)
+            removed += int(self._rollups.pop(_hash, None) is not None)
+            self._recorded.pop(_hash, None)
+            self._key_codecs.pop(_hash, None)
+        return removed
+
+    def delete_all_many(self, queries: List[dict]) -> int:
+        """ Delete every event of many queries. Returns the number of event logs and rollups removed. """
+        removed = 0
+        for query in queries:
+            if not self.helpers.validate_query(query):
+                continue
+            removed += self._delete_all(self.helpers.generate_hash(query))
+        return removed
+
+    """
+        # Query Commands
+        ---
+        The primitives behind every inherited `query_*` method.
+    """
+
+    def _by_rank(self, _hash: str, abs_rel: str, start: int, end: int):
+        with self._guard:
+            log = self._logs.get(_hash)
+            if log is None:
+                return []
+            return log.ordering(abs_rel).by_rank(start, end)
+
+    def _by_score(
+        self,
+        _hash: str,
+        abs_rel: str,
+        min_epoch,
+        max_epoch,
+        start: Optional[int] = None,
+        num: Optional[int] = None,
+    ):
+        with self._guard:
+            log = self._logs.get(_hash)
+            if log is None:
+                return []
+            return log.ordering(abs_rel).by_score(min_epoch, max_epoch, start=start, num=num)
+
+    def _all(self, _hash: str):
+        with self._guard:
+            log = self._logs.get(_hash)
+            if log is None:
+                return [], []
+            return log.absolute.by_rank(0, -1), log.relative.by_rank(0, -1)
+
+    def _by_score_many(self, ranges: List[Tuple[str, float, float]], abs_rel: str) -> List[List[Tuple[bytes, float]]]:
+        return [self._by_score(_hash, abs_rel, _min, _max) for _hash, _min, _max in ranges]
+
+    def _pages(
+        self, _hash: str, abs_rel: str, min_epoch, max_epoch, chunk_size: int
+    ) -> Iterator[List[Tuple[bytes, float, float]]]:
+        """ Page through a snapshot of the range. Yields lists of (member, score, other score). """
+        other = "relative" if abs_rel == "absolute" else "absolute"
+        with self._guard:
+            log = self._logs.get(_hash)
+            if log is None:
+                return
+            lookup = log.ordering(other).lookup
+            triples = [
+                (member, score, lookup[member])
+                for member, score in log.ordering(abs_rel).by_score(min_epoch, max_epoch)
+            ]
+        for start in range(0, len(triples), chunk_size):
+            yield triples[start : start + chunk_size]
+
+    def count(self, _hash: str, pipe=None) -> int:
+        log = self._logs.get(_hash)
+        return 0 if log is None else len(log)
+
+    def general_lock(self, query: dict):
+        """ A lock per query. It's only shared by threads of this process. """
+        _hash = self.helpers.generate_hash(query)
+        with self._guard:
+            if _hash not in self._locks:
+                self._locks[_hash] = threading.Lock()
+            return self._locks[_hash]
+
+    """
+        # Retention
+        ---
+        Policies only live in this process. Writes enforce them and `compact` sweeps every key.
+    """
+
+    def load_retention(self):
+        if self._retention is None:
+            self._retention = {}
+
+    def set_retention(
+        self, entity: str, max_len: int = 0, max_age: float = 0.0, age_by: str = "relative"
+    ) -> RetentionPolicy:
+        policy = RetentionPolicy(max_len=max_len, max_age=max_age, age_by=age_by)
+        if policy.is_empty:
+            self.retention.pop(entity, None)
+            return policy
+        self.retention[entity] = policy
+        return policy
+
+    """
+        # Codecs
+        ---
+        Entity codecs and the codec of every key only live in this process.
+    """
+
+    def load_codecs(self):
+        if self._codecs is None:
+            self._codecs = {}
+
+    def _put_codec_spec(self, entity: str, spec: Optional[dict]):
+        pass
+
+    def _record_codec(self, _hash: str, spec: Optional[dict]) -> Optional[dict]:
+        with self._guard:
+            if spec is not None:
+                self._recorded.setdefault(_hash, spec)
+            return self._recorded.get(_hash)
+
+    def _put_schema(self, schema):
+        pass
+
+    def _schema(self, schema_id: str) -> Optional[dict]:
+        # Every schema of this process is already in the registry
+        return None
+
+    def _trim(self, log: EventLog, policy: RetentionPolicy, now: float) -> List[float]:
+        """ The same trim as the lua scripts. Returns the relative times of the events removed. """
+        trimmed = []
+        if policy.max_age > 0 and len(log) > 0:
+            by, cutoff = log.absolute, now - policy.max_age
+            if policy.age_by == "relative":
+                by, cutoff = log.relative, log.relative.scores[-1] - policy.max_age
+            old = [member for member, _ in by.by_score("-inf", f"({cutoff}")]
+            for member in old:
+                trimmed.append(log.relative.lookup[member])
+                log.remove(member)
+        if policy.max_len > 0:
+            extra = len(log) - policy.max_len
+            if extra > 0:
+                trimmed.extend(log.relative.scores[:extra])
+                for member in log.relative.members[:extra]:
+                    log.remove(member)
+        return trimmed
+
+    def _retain(self, _hash: str, policy: RetentionPolicy, client=None) -> int:
+        now = maya.now()._epoch
+        with self._guard:
+            log = self._logs.get(_hash)
+            if log is None:
+                return 0
+            trimmed = self._trim(log, policy, now)
+            if len(trimmed) > 0:
+                log.last_write = now
+                self.refresh_rollups(_hash, min(trimmed), max(trimmed))
+            self._drop_empty(_hash)
+        return len(trimmed)
+
+    def event_hashes(self) -> Iterator[str]:
+        return iter(list(self._logs.keys()))
+
+    def compact(self) -> int:
+        self.metrics.incr("retention.compactions")
+        if len(self.retention) == 0:
+            return 0
+        total = 0
+        for _hash in self.event_hashes():
+            policy = self.retention_for(self._queries.get(_hash, {}))
+            if policy.is_empty:
+                continue
+            trimmed = self._retain(_hash, policy)
+            self._count_trimmed(trimmed)
+            total += trimmed
+        return total
+
+    """
+        # Stats
+    """
+
+    def stats(self, _hash: str) -> dict:
+        with self._guard:
+            log = self._logs.get(_hash)
+            if log is None:
+                return {}
+            return {
+                "count": len(log),
+                "min_time": log.relative.scores[0],
+                "max_time": log.relative.scores[-1],
+                "min_timestamp": log.absolute.scores[0],
+                "max_timestamp": log.absolute.scores[-1],
+                "last_write": log.last_write,
+            }
+
+    """
+        # Rollups
+        ---
+        Only the storage of the tiers is replaced. A hash with an entry in `_rollups` has been built.
+    """
+
+    def _rollup_states(self, _hash: str, reads: List[Tuple[str, float, float]]) -> List[List[dict]]:
+        with self._guard:
+            tiers = self._rollups.get(_hash)
+            if tiers is None:
+                return [[] for _ in reads]
+            return [tiers[tier].between(start, end) for tier, start, end in reads]
+
+    def _write_tier(self, _hash: str, tier: str, start: float, end: float, buckets: Dict[float, dict]):
+        with self._guard:
+            tiers = self._rollups.setdefault(_hash, {name: BucketStates() for name, _ in rollups.TIERS})
+            tiers[tier].drop(start, end)
+            for bucket, state in buckets.items():
+                tiers[tier].put(bucket, state)
+
+    def _has_rollups(self, _hash: str) -> bool:
+        return _hash in self._rollups
+
+    def _mark_rollups(self, _hash: str):
+        with self._guard:
+            self._rollups.setdefault(_hash, {tier: BucketStates() for tier, _ in rollups.TIERS})
+
+    def _drop_rollups(self, _hash: str):
+        with self._guard:
+            self._rollups.pop(_hash, None)
+
+    def _rollup_scope(self, _hash: str) -> threading.RLock:
+        return self._guard
@@ -143,16 +143,16 @@ class RedisDatabaseConnection(DatabaseConnection):
         if count == 0: return
         self._delete_many(_hash, updated_list)
 
-    def _delete_all(self, _hash: str):
-        while self.connection.llen(_hash) > 0:
-            self.connection.ltrim(_hash, 0, -99)
+    def _delete_all(self, key: str):
+        """ Drop a whole list in one server side call. """
+        self.unlink(key)
 
     def delete_all(self, query: dict, details: dict):
         if not self.helpers.validate_query(query):
             return
 
         _hash = self.helpers.generate_hash(query)
-        self._delete_all(_hash)
+        self._delete_all(f"{_hash}:list")
 
     """ 
         Query commands
@@ -0,0 +1,285 @@
+from typing import Iterator, List
+
+import maya
+import numpy as np
+import pandas as pd
+import redis
+
+from jamboree.storage.databases import DatabaseConnection
+from jamboree.utils.support.events import deserialize_df, serialize_df
+
+
+class RedisDatabaseChunksConnection(DatabaseConnection):
+    """
+        Redis Chunk Notes
+        ---
+        A columnar alternative to the zset connection for dense time series (bars, ticks).
+
+        Rows are grouped into fixed time buckets (a day by default).
+        Each bucket is one redis string holding the compressed, typed columns of every row inside of it.
+        The query fields (name, category, ...) aren't repeated per row. The key already identifies them.
+
+        ## Keys
+
+        * `{hash}:chunks` - zset of chunk ids scored by the bucket start time.
+        * `{hash}:chunk:{id}` - the packed chunk.
+        * `{hash}:chunkrows` - hash of chunk id -> number of rows. Used to count without decoding.
+
+        Range reads look up the overlapping chunk ids, then decode only those chunks.
+
+        Writes WATCH the chunks they merge into and retry `write_retries` times when another writer got there first.
+        Conflicts are counted under `chunks.contention` in `metrics`. The last one raises `WatchError`.
+    """
+
+    def __init__(self, bucket_size: float = 86400.0, write_batch: int = 256) -> None:
+        super().__init__()
+        self.bucket_size = float(bucket_size)
+        self.write_batch = write_batch
+        self.write_retries = 10
+
+    """
+        # Chunk Helpers
+    """
+
+    def _bucket(self, times: np.ndarray) -> np.ndarray:
+        return np.floor(times / self.bucket_size) * self.bucket_size
+
+    def _chunk_id(self, start: float) -> str:
+        return str(float(start))
+
+    def _chunk_key(self, _hash: str, chunk_id) -> str:
+        if isinstance(chunk_id, bytes):
+            chunk_id = chunk_id.decode("utf-8")
+        return f"{_hash}:chunk:{chunk_id}"
+
+    def _merge(self, current: pd.DataFrame, incoming: pd.DataFrame) -> pd.DataFrame:
+        """ Merge new rows into an existing chunk. Rows with the same time get replaced by the newest one. """
+        merged = pd.concat([current, incoming], ignore_index=True, sort=False)
+        merged = merged.drop_duplicates(subset="time", keep="last")
+        merged = merged.sort_values("time", kind="mergesort")
+        return merged.reset_index(drop=True)
+
+    def _load(self, _hash: str, chunk_ids: List[bytes]) -> pd.DataFrame:
+        if len(chunk_ids) == 0:
+            return pd.DataFrame()
+        keys = [self._chunk_key(_hash, cid) for cid in chunk_ids]
+        blobs = self.connection.mget(keys)
+        frames = [deserialize_df(blob) for blob in blobs if blob is not None]
+        if len(frames) == 0:
+            return pd.DataFrame()
+        if len(frames) == 1:
+            return frames[0]
+        return pd.concat(frames, ignore_index=True, sort=False)
+
+    def _ids_between(self, _hash: str, min_epoch: float, max_epoch: float) -> List[bytes]:
+        """ Get the chunk that starts at or before `min_epoch` and every chunk that starts inside of the window. """
+        index_key = f"{_hash}:chunks"
+        with self.connection.pipeline(transaction=False) as pipe:
+            pipe.zrevrangebyscore(index_key, min_epoch, "-inf", start=0, num=1)
+            pipe.zrangebyscore(index_key, f"({min_epoch}", max_epoch)
+            before, inside = pipe.execute()
+        return list(reversed(before)) + inside
+
+    """
+        # Save Commands
+    """
+
+    def _save_frame(self, _hash: str, frame: pd.DataFrame):
+        index_key = f"{_hash}:chunks"
+        rows_key = f"{_hash}:chunkrows"
+        frame = frame.sort_values("time", kind="mergesort")
+        buckets = self._bucket(frame["time"].to_numpy(dtype=np.float64))
+        groups = [(start, part) for start, part in frame.groupby(buckets, sort=True)]
+
+        for i in range(0, len(groups), self.write_batch):
+            batch = groups[i:i + self.write_batch]
+            chunk_keys = [self._chunk_key(_hash, self._chunk_id(start)) for start, _ in batch]
+            with self.connection.pipeline() as pipe:
+                for attempt in range(self.write_retries):
+                    try:
+                        pipe.watch(*chunk_keys)
+                        existing = pipe.mget(chunk_keys)
+                        pipe.multi()
+                        for (start, part), chunk_key, current in zip(batch, chunk_keys, existing):
+                            chunk_id = self._chunk_id(start)
+                            if current is not None:
+                                part = self._merge(deserialize_df(current), part)
+                            else:
+                                part = part.reset_index(drop=True)
+                            pipe.set(chunk_key, serialize_df(part))
+                            pipe.zadd(index_key, {chunk_id: float(start)})
+                            pipe.hset(rows_key, chunk_id, len(part))
+                        pipe.execute()
+                        break
+                    except redis.exceptions.WatchError:
+                        self.metrics.incr("chunks.contention")
+                        if attempt == self.write_retries - 1:
+                            raise
+
+    def save_frame(self, query: dict, frame: pd.DataFrame):
+        """
+            Save a dataframe of rows.
+
+            The frame needs a `time` column of epoch seconds. A `timestamp` column is added with the current time if it's missing.
+        """
+        if not self.helpers.validate_query(query) or frame.empty:
+            return
+        if "time" not in frame.columns:
+            raise AttributeError("The frame needs a 'time' column to be chunked")
+        frame = frame.copy()
+        frame["time"] = frame["time"].astype(np.float64)
+        if "timestamp" not in frame.columns:
+            frame["timestamp"] = maya.now()._epoch
+        _hash = self.helpers.generate_hash(query)
+        self.remember_key(_hash, query)
+        self._save_frame(_hash, frame)
+
+    """
+        # Delete Commands
+    """
+
+    def _delete_all(self, _hash: str):
+        index_key = f"{_hash}:chunks"
+        rows_key = f"{_hash}:chunkrows"
+        chunk_ids = self.connection.zrange(index_key, 0, -1)
+        keys = [self._chunk_key(_hash, cid) for cid in chunk_ids]
+        self.unlink(index_key, rows_key, *keys)
+
+    def delete_all(self, query: dict):
+        if not self.helpers.validate_query(query):
+            return
+        _hash = self.helpers.generate_hash(query)
+        self._delete_all(_hash)
+
+    """
+        # Query Commands
+        ---
+        Every range query returns a dataframe. Single row queries return a dictionary.
+    """
+
+    def query_all(self, query: dict) -> pd.DataFrame:
+        if not self.helpers.validate_query(query):
+            return pd.DataFrame()
+        _hash = self.helpers.generate_hash(query)
+        chunk_ids = self.connection.zrange(f"{_hash}:chunks", 0, -1)
+        return self._load(_hash, chunk_ids)
+
+    def query_between(
+        self,
+        query: dict,
+        min_epoch: float,
+        max_epoch: float,
+        abs_rel: str = "relative",
+    ) -> pd.DataFrame:
+        """
+            Get every row between two epochs.
+
+            Chunks are indexed by relative time. An absolute window has to decode every chunk.
+        """
+        if not self.helpers.validate_query(query) or abs_rel not in [
+            "absolute",
+            "relative",
+        ]:
+            return pd.DataFrame()
+        _hash = self.helpers.generate_hash(query)
+        if abs_rel == "relative":
+            chunk_ids = self._ids_between(_hash, min_epoch, max_epoch)
+            column = "time"
+        else:
+            chunk_ids = self.connection.zrange(f"{_hash}:chunks", 0, -1)
+            column = "timestamp"
+        frame = self._load(_hash, chunk_ids)
+        if frame.empty:
+            return frame
+        within = (frame[column] >= min_epoch) & (frame[column] <= max_epoch)
+        return frame[within].reset_index(drop=True)
+
+    def iter_between(
+        self,
+        query: dict,
+        min_epoch: float,
+        max_epoch: float,
+        abs_rel: str = "relative",
+    ) -> Iterator[List[dict]]:
+        """ Stream the rows between two epochs one chunk at a time. Only one decoded chunk is held in memory. """
+        if not self.helpers.validate_query(query) or abs_rel not in [
+            "absolute",
+            "relative",
+        ]:
+            return
+        _hash = self.helpers.generate_hash(query)
+        if abs_rel == "relative":
+            chunk_ids = self._ids_between(_hash, min_epoch, max_epoch)
+            column = "time"
+        else:
+            chunk_ids = self.connection.zrange(f"{_hash}:chunks", 0, -1)
+            column = "timestamp"
+        for chunk_id in chunk_ids:
+            frame = self._load(_hash, [chunk_id])
+            if frame.empty:
+                continue
+            within = (frame[column] >= min_epoch) & (frame[column] <= max_epoch)
+            rows = frame[within].to_dict("records")
+            if len(rows) > 0:
+                yield rows
+
+    def query_latest_by_time(self, query: dict, max_epoch: float) -> dict:
+        """ Get the first row at or after the given epoch. Matches the zset connection. """
+        if not self.helpers.validate_query(query):
+            return {}
+        _hash = self.helpers.generate_hash(query)
+        index_key = f"{_hash}:chunks"
+        with self.connection.pipeline(transaction=False) as pipe:
+            pipe.zrevrangebyscore(index_key, max_epoch, "-inf", start=0, num=1)
+            pipe.zrangebyscore(index_key, f"({max_epoch}", "+inf", start=0, num=1)
+            before, after = pipe.execute()
+
+        for chunk_ids in [before, after]:
+            frame = self._load(_hash, chunk_ids)
+            if frame.empty:
+                continue
+            position = np.searchsorted(frame["time"].to_numpy(), max_epoch, side="left")
+            if position < len(frame):
+                return frame.iloc[[position]].to_dict("records")[0]
+        return {}
+
+    def query_latest(self, query: dict) -> dict:
+        if not self.helpers.validate_query(query):
+            return {}
+        _hash = self.helpers.generate_hash(query)
+        chunk_ids = self.connection.zrange(f"{_hash}:chunks", -1, -1)
+        frame = self._load(_hash, chunk_ids)
+        if frame.empty:
+            return {}
+        return frame.iloc[[-1]].to_dict("records")[0]
+
+    """
+        Other Functions
+    """
+
+    def count(self, _hash: str) -> int:
+        rows = self.connection.hvals(f"{_hash}:chunkrows")
+        return sum(int(r) for r in rows)
+
+    def min_score(self, _hash: str) -> float:
+        frame = self._load(_hash, self.connection.zrange(f"{_hash}:chunks", 0, 0))
+        if frame.empty:
+            return float(0.0)
+        return float(frame["time"].iloc[0])
+
+    def max_score(self, _hash: str) -> float:
+        frame = self._load(_hash, self.connection.zrange(f"{_hash}:chunks", -1, -1))
+        if frame.empty:
+            return float(0.0)
+        return float(frame["time"].iloc[-1])
+
+    def stats(self, _hash: str) -> dict:
+        """ Count and time bounds. Only the first and last chunks are decoded. """
+        count = self.count(_hash)
+        if count == 0:
+            return {}
+        return {
+            "count": count,
+            "min_time": self.min_score(_hash),
+            "max_time": self.max_score(_hash),
+        }
@@ -1,11 +1,23 @@
+import hashlib
+import threading
 import maya
+import numpy as np
 import orjson
+import pandas as pd
 from copy import copy
 
-from redis.client import Pipeline, Redis
-from typing import Dict, List, Optional, Any, AnyStr, Union
+from redis.client import Pipeline, Redis, Script
+from typing import ContextManager, Dict, Iterator, List, Optional, Any, AnyStr, Tuple, Union
 from pprint import pprint
 from jamboree.storage.databases import DatabaseConnection
+from jamboree.storage.databases import lua, rollups
+from jamboree.storage.databases.batch import Batch
+from jamboree.storage.databases.retention import (
+    NO_RETENTION, RETENTION_KEY, RetentionPolicy
+)
+from jamboree.utils.support.events.cereal import (
+    CODEC_KEY, JSON, SCHEMA_KEY, SCHEMAS, Codec, Schema, StructCodec, get_codec, single_one, bulk_columns, bulk_unserialize
+)
 
 # from redis.exceptions import WatchError
 from jamboree.utils.context import watch_loop, watch_loop_callback
@@ -26,10 +38,99 @@ class RedisDatabaseZSetsConnection(DatabaseConnection):
         The fact that it's a set makes it so there can be no duplicates added.
 
         In essense. Perfect for time series. 
+
+        ## Layouts
+        ---
+        * `dual` - The serialized event is the member of both `{hash}:rlist` and `{hash}:alist` (default).
+        * `single` - The serialized event is stored once inside of the `{hash}:payloads` hash under a short member id.
+          `{hash}:rindex` and `{hash}:aindex` only hold that id. Writes and reads are lua scripts in this layout.
     """
 
     def __init__(self) -> None:
         super().__init__()
+        self._write_mode = "lock"
+        self._layout = "dual"
+        self._read_mode = "watch"
+        self.read_retries = 10
+        # Seconds a rollup update may hold the lock of its key before another process can take it
+        self.rollup_lock_timeout = 60
+        self._scripts: Dict[str, Script] = {}
+        self._retention: Optional[Dict[str, RetentionPolicy]] = None
+        self._codecs: Optional[Dict[str, Codec]] = None
+        self._key_codecs: Dict[str, Codec] = {}
+        # The batch open on each thread
+        self._batches = threading.local()
+        # The cold tier of the processor, if it has one. Rollups count the events spilled to it.
+        self.cold = None
+        # Lets readers decode struct members written by other processes
+        SCHEMAS.add_loader(self._schema)
+
+    @property
+    def write_mode(self) -> str:
+        """ How events are appended.
+
+            * `lock` - Take a redis lock then pipeline both zadds (default).
+            * `script` - Run both zadds inside of one atomic EVALSHA. No lock, one round trip.
+        """
+        return self._write_mode
+
+    @write_mode.setter
+    def write_mode(self, _mode: str):
+        if _mode not in ["lock", "script"]:
+            raise ValueError("The write mode must either be 'lock' or 'script'")
+        self._write_mode = _mode
+
+    @property
+    def layout(self) -> str:
+        """ How events are stored. Either `dual` or `single`. See the class notes. """
+        return self._layout
+
+    @layout.setter
+    def layout(self, _layout: str):
+        if _layout not in ["dual", "single"]:
+            raise ValueError("The layout must either be 'dual' or 'single'")
+        self._layout = _layout
+
+    @property
+    def read_mode(self) -> str:
+        """ How range queries are read.
+
+            * `watch` - WATCH the zsets, read, then check nothing changed. Retries `read_retries` times before a snapshot read (default).
+            * `snapshot` - Send the count and range together in one MULTI/EXEC with no WATCH. One round trip, no retries.
+
+            Conflicts are counted under `read.contention` in `metrics`. Reads that gave up on watching are counted under `read.fallback`.
+        """
+        return self._read_mode
+
+    @read_mode.setter
+    def read_mode(self, _mode: str):
+        if _mode not in ["watch", "snapshot"]:
+            raise ValueError("The read mode must either be 'watch' or 'snapshot'")
+        self._read_mode = _mode
+
+    @property
+    def is_single(self) -> bool:
+        return self._layout == "single"
+
+    def member_id(self, serialized: bytes) -> str:
+        """ The compact id of an event in the single layout. It matches the id the migration script creates. """
+        return hashlib.sha1(serialized).hexdigest()[:16]
+
+    def time_key(self, _hash: str, abs_rel: str) -> str:
+        """ Get the zset key ordering events by absolute or relative time for the current layout. """
+        if self.is_single:
+            if abs_rel == "absolute":
+                return f"{_hash}:aindex"
+            return f"{_hash}:rindex"
+        return self.helpers.dynamic_key(_hash, abs_rel)
+
+    def script(self, name: str) -> Script:
+        """ Get a registered lua script by name. Redis only sees the script body the first time it's called. """
+        if name not in self._scripts:
+            self._scripts[name] = self.connection.register_script(
+                getattr(lua, name)
+            )
+        return self._scripts[name]
 
     """
         # Individual Access Methods
@@ -48,6 +149,10 @@ class RedisDatabaseZSetsConnection(DatabaseConnection):
         """ Deletes a key within a lock"""
         rlock = f"{_hash}:lock"
         sub_key = f"{_hash}:single"
+        batched = self._batched(_hash)
+        if batched is not None:
+            batched.delete(sub_key)
+            return
         with self.connection.pipeline() as pipe:
             with pipe.lock(rlock):
                 pipe.delete(sub_key)
@@ -71,6 +176,10 @@ class RedisDatabaseZSetsConnection(DatabaseConnection):
             serialized = orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY)
         else:
             serialized = data
+        batched = self._batched(_hash)
+        if batched is not None:
+            batched.set(sub_key, serialized)
+            return
         with self.connection.pipeline() as pipe:
             with pipe.lock(rlock):
                 pipe.set(sub_key, serialized)
@@ -78,18 +187,8 @@ class RedisDatabaseZSetsConnection(DatabaseConnection):
 
     def _get(self, _hash: str):
         sub_key = f"{_hash}:single"
-        value = None
-        with self.connection.pipeline() as pipe:
-            while True:
-                try:
-                    pipe.watch(sub_key)
-                    value = pipe.get(sub_key)
-                    pipe.execute()
-                    break
-                except redis.exceptions.WatchError:
-                    continue
-
-        return value
+        # A single GET is atomic on its own. There's nothing to watch.
+        return self.connection.get(sub_key)
 
     def get(self, query: dict, is_serialized=True):
         if not self.helpers.validate_query(query):
@@ -111,6 +210,7 @@ class RedisDatabaseZSetsConnection(DatabaseConnection):
                     return
 
         _hash = self.helpers.generate_hash(query)
+        self.remember_key(_hash, query)
         self._add(_hash, data, is_serialized=is_serialized)
 
     def kill(self, query: dict):
@@ -128,10 +228,86 @@ class RedisDatabaseZSetsConnection(DatabaseConnection):
         * `save_many` - ...
     """
 
+    def _append_script(
+        self,
+        _hash: str,
+        events: List[Tuple[bytes, float, float]],
+        policy: RetentionPolicy,
+        client,
+    ):
+        """ Runs (or queues, given a pipeline) the append script of the layout. Replies with `[added, trimmed, low, high]`. """
+        if self.is_single:
+            args = [maya.now()._epoch] + policy.args()
+            for member, _time, _timestamp in events:
+                args.extend([self.member_id(member), member, _time, _timestamp])
+            return self.script("SINGLE_APPEND")(
+                keys=[
+                    f"{_hash}:payloads",
+                    f"{_hash}:rindex",
+                    f"{_hash}:aindex",
+                    f"{_hash}:stats",
+                ],
+                args=args,
+                client=client,
+            )
+
+        relative_time_key = f"{_hash}:rlist"
+        absolute_time_key = f"{_hash}:alist"
+        args = [maya.now()._epoch] + policy.args()
+        for member, _time, _timestamp in events:
+            args.extend([member, _time, _timestamp])
+        return self.script("ZSET_APPEND")(
+            keys=[relative_time_key, absolute_time_key, f"{_hash}:stats"],
+            args=args,
+            client=client,
+        )
+
+    def _scripted_append(
+        self,
+        _hash: str,
+        events: List[Tuple[bytes, float, float]],
+        policy: RetentionPolicy = NO_RETENTION,
+    ):
+        """ Appends (member, relative time, absolute time) events and applies the retention policy in a single EVALSHA. """
+        reply = self._append_script(_hash, events, policy, self.connection)
+        self._trimmed(_hash, reply[1:])
+        return reply[0]
+
+    def _queue_append(
+        self,
+        batch: Batch,
+        _hash: str,
+        events: List[Tuple[bytes, float, float]],
+        policy: RetentionPolicy,
+    ):
+        """ Queues an append into a batch. No lock is needed, the whole batch runs inside of MULTI/EXEC. """
+        if self.is_scripted:
+            self._append_script(_hash, events, policy, batch.pipe)
+            batch.reply(lambda reply: self._trimmed(_hash, reply[1:]))
+            return
+        relative_data, absolute_data = {}, {}
+        for member, _time, _timestamp in events:
+            relative_data[member] = _time
+            absolute_data[member] = _timestamp
+        batch.pipe.zadd(f"{_hash}:rlist", relative_data)
+        batch.pipe.zadd(f"{_hash}:alist", absolute_data)
+        if self._queue_retain(_hash, policy, batch.pipe) is not None:
+            batch.reply(lambda reply: self._trimmed(_hash, reply))
+
+    @property
+    def is_scripted(self) -> bool:
+        """ The single layout is always written through scripts. """
+        return self.write_mode == "script" or self.is_single
+
     @logger.catch
-    def _save(self, _hash: str, data: dict, timing: dict):
+    def _save(self, _hash: str, data: dict, timing: dict, policy: RetentionPolicy = NO_RETENTION):
         """ Appends an event to the stack. """
-        serialized = orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY)
+        serialized = self.key_codec(_hash).encode(data)
+        if self.is_scripted or self.active_batch is not None:
+            self._append(
+                _hash, [(serialized, timing["time"], timing["timestamp"])], policy
+            )
+            return
         rlock = f"{_hash}:lock"
         relative_time_key = f"{_hash}:rlist"
         absolute_time_key = f"{_hash}:alist"
@@ -141,20 +317,73 @@ class RedisDatabaseZSetsConnection(DatabaseConnection):
                 absolute_data = {serialized: timing["timestamp"]}
                 pipe.zadd(relative_time_key, relative_data)
                 pipe.zadd(absolute_time_key, absolute_data)
-            pipe.execute()
+                position = self._queue_retain(_hash, policy, pipe)
+            results = pipe.execute()
+        if position is not None:
+            self._trimmed(_hash, results[position])
+
+    def _append(
+        self,
+        _hash: str,
+        events: List[Tuple[bytes, float, float]],
+        policy: RetentionPolicy = NO_RETENTION,
+    ):
+        """ Appends (member, relative time, absolute time) events as one ZADD pair, or one EVALSHA when scripted. """
+        if self._batched(_hash) is not None:
+            return self._queue_append(self.active_batch, _hash, events, policy)
+        if self.is_scripted:
+            return self._scripted_append(_hash, events, policy)
+        relative_data, absolute_data = {}, {}
+        for member, _time, _timestamp in events:
+            relative_data[member] = _time
+            absolute_data[member] = _timestamp
+        with self.connection.pipeline() as pipe:
+            with pipe.lock(f"{_hash}:lock"):
+                pipe.zadd(f"{_hash}:rlist", relative_data)
+                pipe.zadd(f"{_hash}:alist", absolute_data)
+                position = self._queue_retain(_hash, policy, pipe)
+            results = pipe.execute()
+        if position is not None:
+            self._trimmed(_hash, results[position])
+
+    def save_events(self, query: dict, events: List[Tuple[bytes, float, float]]):
+        """ Save serialized events that each carry their own relative and absolute time, in one write. """
+        if not self.helpers.validate_query(query) or len(events) == 0:
+            return
+        _hash = self.helpers.generate_hash(query)
+        self.remember_key(_hash, query)
+        self._append(_hash, events, self.retention_for(query))
 
     def save(self, query: dict, data: dict, _time=None, _timestamp=None):
         """ Save a single record. """
         if not self.helpers.validate_query(query):
             return
         _hash = self.helpers.generate_hash(query)
-        query.update(data)
-        data, timing = self.helpers.separate_time_data(query, _time, _timestamp)
+        self.remember_key(_hash, query)
+        policy = self.retention_for(query)
+        # Pins the codec of a new key
+        self.key_codec(_hash, query)
+        merged = copy(query)
+        merged.update(data)
+        data, timing = self.helpers.separate_time_data(merged, _time, _timestamp)
         # print(timing)
-        self._save(_hash, data, timing)
+        self._save(_hash, data, timing, policy)
 
-    def _save_many(self, _hash: str, relative_data: Dict[str, float] = {}):
+    def _save_many(
+        self,
+        _hash: str,
+        relative_data: Dict[str, float] = {},
+        policy: RetentionPolicy = NO_RETENTION,
+    ):
         # serialized_list = [orjson.dumps(x) for x in data]
+        if self.is_scripted or self.active_batch is not None:
+            timestamp = maya.now()._epoch
+            events = [
+                (member, _time, timestamp)
+                for member, _time in relative_data.items()
+            ]
+            self._append(_hash, events, policy)
+            return
 
         rlock = f"{_hash}:lock"
         relative_time_key = f"{_hash}:rlist"
@@ -164,7 +393,10 @@ class RedisDatabaseZSetsConnection(DatabaseConnection):
             with pipe.lock(rlock):
                 pipe.zadd(relative_time_key, relative_data)
                 pipe.zadd(absolute_time_key, absolute_data)
-            pipe.execute()
+                position = self._queue_retain(_hash, policy, pipe)
+            results = pipe.execute()
+        if position is not None:
+            self._trimmed(_hash, results[position])
 
     def save_many(self, query, data: Dict[str, float] = {}, abs_rel="absolute"):
         """ 
@@ -176,7 +408,12 @@ class RedisDatabaseZSetsConnection(DatabaseConnection):
             return
 
         _hash = self.helpers.generate_hash(query)
-        self._save_many(_hash, data)
+        self.remember_key(_hash, query)
+        codec = self.key_codec(_hash, query)
+        if codec is not JSON:
+            # The members come in as json
+            data = {codec.encode(orjson.loads(member)): _time for member, _time in data.items()}
+        self._save_many(_hash, data, self.retention_for(query))
 
     """ 
         # Delete Commands
@@ -193,13 +430,49 @@ class RedisDatabaseZSetsConnection(DatabaseConnection):
         pass
 
     def _delete(self, _hash: str, details: dict):
+        """ Remove one event. Its score is read in the same transaction, so the rollups holding it can be recomputed. """
+        deletion_key = self.key_codec(_hash).encode(details)
+        batched = self._batched(_hash)
+        if batched is not None:
+            if self.is_single:
+                _id = self.member_id(deletion_key)
+                batched.zscore(f"{_hash}:rindex", _id)
+                batch = self.active_batch
+                batch.reply(lambda score: self.refresh_rollups(_hash, score, score))
+                batched.zrem(f"{_hash}:rindex", _id)
+                batched.zrem(f"{_hash}:aindex", _id)
+                batched.hdel(f"{_hash}:payloads", _id)
+            else:
+                batched.zscore(f"{_hash}:rlist", deletion_key)
+                batch = self.active_batch
+                batch.reply(lambda score: self.refresh_rollups(_hash, score, score))
+                batched.zrem(f"{_hash}:rlist", deletion_key)
+                batched.zrem(f"{_hash}:alist", deletion_key)
+            self._refresh_stats(_hash, client=batched)
+            return
+        if self.is_single:
+            _id = self.member_id(deletion_key)
+            with self.connection.pipeline() as pipe:
+                pipe.zscore(f"{_hash}:rindex", _id)
+                pipe.zrem(f"{_hash}:rindex", _id)
+                pipe.zrem(f"{_hash}:aindex", _id)
+                pipe.hdel(f"{_hash}:payloads", _id)
+                self._refresh_stats(_hash, client=pipe)
+                score = pipe.execute()[0]
+            self.refresh_rollups(_hash, score, score)
+            return
         rlock = f"{_hash}:lock"
         relative_time_key = f"{_hash}:rlist"
         absolute_time_key = f"{_hash}:alist"
-        deletion_key = orjson.dumps(details, option=orjson.OPT_SERIALIZE_NUMPY)
         with self.connection.lock(rlock):
-            self.connection.zrem(relative_time_key, deletion_key)
-            self.connection.zrem(absolute_time_key, deletion_key)
+            # One MULTI/EXEC, so no reader sees the events gone and the stats not yet rewritten
+            with self.connection.pipeline() as pipe:
+                pipe.zscore(relative_time_key, deletion_key)
+                pipe.zrem(relative_time_key, deletion_key)
+                pipe.zrem(absolute_time_key, deletion_key)
+                self._refresh_stats(_hash, client=pipe)
+                score = pipe.execute()[0]
+        self.refresh_rollups(_hash, score, score)
 
     def delete(self, query: dict, details: dict):
         if not self.helpers.validate_query(query):
@@ -224,20 +497,50 @@ class RedisDatabaseZSetsConnection(DatabaseConnection):
             return
         self._delete_many(_hash, updated_list)
 
-    def _delete_all(self, _hash: str):
-        rlock = f"{_hash}:lock"
-        relative_time_key = f"{_hash}:rlist"
-        absolute_time_key = f"{_hash}:alist"
-
-        with self.connection.lock(rlock):
-            keys = self.connection.zrange(relative_time_key, 0, -1, withscores=True)
-
-            values = [key[0] for key in keys]
-            if len(values) == 0:
-                return
+    def remove_members(self, _hash: str, members: List[bytes]) -> int:
+        """ 
+            Remove stored events by their serialized form and rewrite the stats. Returns the number removed.
+            The rollups are left alone. The caller knows the span removed and refreshes them (see `refresh_rollups`).
+        """
+        if len(members) == 0:
+            return 0
+        step = 3 if self.is_single else 2
+        with self.connection.pipeline() as pipe:
+            for i in range(0, len(members), 1000):
+                part = members[i : i + 1000]
+                if self.is_single:
+                    ids = [self.member_id(member) for member in part]
+                    pipe.zrem(f"{_hash}:rindex", *ids)
+                    pipe.zrem(f"{_hash}:aindex", *ids)
+                    pipe.hdel(f"{_hash}:payloads", *ids)
+                else:
+                    pipe.zrem(f"{_hash}:rlist", *part)
+                    pipe.zrem(f"{_hash}:alist", *part)
+            self._refresh_stats(_hash, client=pipe)
+            results = pipe.execute()
+        return sum(int(results[i]) for i in range(0, len(results) - 1, step))
+
+    def event_keys(self, _hash: str) -> List[str]:
+        """ Every key holding the events of a hash, in either layout. """
+        return [
+            f"{_hash}:rlist",
+            f"{_hash}:alist",
+            f"{_hash}:payloads",
+            f"{_hash}:rindex",
+            f"{_hash}:aindex",
+            f"{_hash}:stats",
+            f"{_hash}:rollup",
+            f"{_hash}:codec",
+        ] + [self.rollup_key(_hash, tier) for tier, _ in rollups.TIERS]
 
-            self.connection.zrem(relative_time_key, *values)
-            self.connection.zrem(absolute_time_key, *values)
+    def _delete_all(self, _hash: str):
+        """ Drop every event key in one UNLINK. Nothing is read back into python. """
+        self._key_codecs.pop(_hash, None)
+        batched = self._batched(_hash)
+        if batched is not None:
+            batched.delete(*self.event_keys(_hash))
+            return
+        self.unlink(*self.event_keys(_hash))
 
     def delete_all(self, query: dict):
         if not self.helpers.validate_query(query):
@@ -246,6 +549,23 @@ class RedisDatabaseZSetsConnection(DatabaseConnection):
         _hash = self.helpers.generate_hash(query)
         self._delete_all(_hash)
 
+    def delete_all_many(self, queries: List[dict]) -> int:
+        """ Delete every event of many queries (an episode's worth of handlers) with a single UNLINK. Returns the number of keys removed. """
+        keys = []
+        for query in queries:
+            if not self.helpers.validate_query(query):
+                continue
+            _hash = self.helpers.generate_hash(query)
+            self._key_codecs.pop(_hash, None)
+            keys.extend(self.event_keys(_hash))
+            self._batched(_hash)
+        batch = self.active_batch
+        if batch is not None and batch.pipe is not None and len(keys) > 0:
+            # Nothing is removed until the batch is sent
+            batch.pipe.delete(*keys)
+            return 0
+        return self.unlink(*keys)
+
     """
         Query commands
         ---
@@ -261,31 +581,135 @@ class RedisDatabaseZSetsConnection(DatabaseConnection):
         5. `query_after` - Get everything after epoch time.    
     """
 
-    def query_all(self, query: dict):
-        """ Same as query_all """
-        if not self.helpers.validate_query(query):
-            return []
+    def _pairs(self, flat: list) -> List[Tuple[bytes, float]]:
+        """ Turn a flat [member, score, member, score ...] script reply into (member, score) pairs. """
+        return [(flat[i], float(flat[i + 1])) for i in range(0, len(flat), 2)]
 
-        _hash = self.helpers.generate_hash(query)
-        relative_time_key = f"{_hash}:rlist"
-        absolute_time_key = f"{_hash}:alist"
+    def _read(self, _hash: str, watch_keys: List[str], read) -> Optional[list]:
+        """
+            Count the events of a hash then run `read(pipe)`, which queues range commands and returns them as a list.
+
+            Returns the list of range replies, or None if nothing is stored.
+        """
+        if self.read_mode == "snapshot":
+            return self._snapshot_read(_hash, read)
+
+        _count_hash = self.time_key(_hash, "absolute")
         with self.connection.pipeline() as pipe:
-            akeys = None
-            rkeys = None
-            while True:
+            for _ in range(self.read_retries):
                 try:
-                    pipe.watch(relative_time_key)
-                    pipe.watch(absolute_time_key)
+                    pipe.watch(*watch_keys)
                     count = self.count(_hash, pipe=pipe)
                     if count == 0:
-                        return []
-
-                    rkeys = pipe.zrange(relative_time_key, 0, -1, withscores=True)
-                    akeys = pipe.zrange(absolute_time_key, 0, -1, withscores=True)
+                        return None
+                    results = read(pipe)
+                    # EXEC is only sent with a queued command. It fails if a watched key changed under the reads.
+                    pipe.multi()
+                    pipe.zcard(_count_hash)
                     pipe.execute()
-                    break
+                    return results
                 except redis.exceptions.WatchError:
+                    self.metrics.incr("read.contention")
                     continue
+        self.metrics.incr("read.fallback")
+        return self._snapshot_read(_hash, read)
+
+    def _snapshot_read(self, _hash: str, read) -> Optional[list]:
+        """ Send the count and the reads as one MULTI/EXEC without a WATCH. It can't conflict, so it never retries. """
+        with self.connection.pipeline() as pipe:
+            pipe.zcard(self.time_key(_hash, "absolute"))
+            read(pipe)
+            results = pipe.execute()
+        if int(results[0]) == 0:
+            return None
+        return results[1:]
+
+    def _by_rank(self, _hash: str, abs_rel: str, start: int, end: int):
+        """ Get (event, score) pairs by rank from the absolute or relative ordering. """
+        _current_key = self.time_key(_hash, abs_rel)
+        if self.is_single:
+            flat = self.script("SINGLE_RANGE_BY_RANK")(
+                keys=[_current_key, f"{_hash}:payloads"],
+                args=[start, end],
+                client=self.connection,
+            )
+            return self._pairs(flat)
+        results = self._read(
+            _hash,
+            [_current_key],
+            lambda pipe: [pipe.zrange(_current_key, start, end, withscores=True)],
+        )
+        return [] if results is None else results[0]
+
+    def _by_score(
+        self,
+        _hash: str,
+        abs_rel: str,
+        min_epoch,
+        max_epoch,
+        start: Optional[int] = None,
+        num: Optional[int] = None,
+    ):
+        """ Get (event, score) pairs between two scores from the absolute or relative ordering. """
+        _current_key = self.time_key(_hash, abs_rel)
+        if self.is_single:
+            flat = self.script("SINGLE_RANGE_BY_SCORE")(
+                keys=[_current_key, f"{_hash}:payloads"],
+                args=[min_epoch, max_epoch, start or 0, -1 if num is None else num],
+                client=self.connection,
+            )
+            return self._pairs(flat)
+        results = self._read(
+            _hash,
+            [_current_key],
+            lambda pipe: [
+                pipe.zrangebyscore(
+                    _current_key,
+                    min=min_epoch,
+                    max=max_epoch,
+                    start=start,
+                    num=num,
+                    withscores=True,
+                )
+            ],
+        )
+        return [] if results is None else results[0]
+
+    def _all(self, _hash: str):
+        """ Get every event with both of its scores. Returns the absolute and relative pairs. """
+        if self.is_single:
+            flat = self.script("SINGLE_ALL")(
+                keys=[f"{_hash}:rindex", f"{_hash}:aindex", f"{_hash}:payloads"],
+                client=self.connection,
+            )
+            rkeys = [(flat[i], float(flat[i + 1])) for i in range(0, len(flat), 3)]
+            akeys = [(flat[i], float(flat[i + 2])) for i in range(0, len(flat), 3)]
+            return akeys, rkeys
+
+        relative_time_key = f"{_hash}:rlist"
+        absolute_time_key = f"{_hash}:alist"
+        results = self._read(
+            _hash,
+            [relative_time_key, absolute_time_key],
+            lambda pipe: [
+                pipe.zrange(relative_time_key, 0, -1, withscores=True),
+                pipe.zrange(absolute_time_key, 0, -1, withscores=True),
+            ],
+        )
+        if results is None:
+            return [], []
+        rkeys, akeys = results
+        return akeys, rkeys
+
+    def query_all(self, query: dict):
+        """ Same as query_all """
+        if not self.helpers.validate_query(query):
+            return []
+
+        _hash = self.helpers.generate_hash(query)
+        akeys, rkeys = self._all(_hash)
+        if len(rkeys) == 0:
+            return []
         combined = self.helpers.combine_results(akeys, rkeys)
         return combined
 
@@ -296,23 +720,9 @@ class RedisDatabaseZSetsConnection(DatabaseConnection):
         ]:
             return {}
         _hash = self.helpers.generate_hash(_query)
-        _current_key = self.helpers.dynamic_key(_hash, abs_rel)
-
-        with self.connection.pipeline() as pipe:
-            while True:
-                try:
-                    pipe.watch(_current_key)
-                    count = self.count(_hash, pipe=pipe)
-                    if count == 0:
-                        return {}
-
-                    keys = pipe.zrange(_current_key, -1, -1, withscores=True)
-                    if len(keys) == 0:
-                        return {}
-                    pipe.execute()
-                    break
-                except redis.exceptions.WatchError:
-                    continue
+        keys = self._by_rank(_hash, abs_rel, -1, -1)
+        if len(keys) == 0:
+            return {}
         combined = self.helpers.combined_abs_rel(keys, abs_rel=abs_rel)
         return combined[-1]
 
@@ -323,23 +733,9 @@ class RedisDatabaseZSetsConnection(DatabaseConnection):
         ]:
             return {}
         _hash = self.helpers.generate_hash(_query)
-        _current_key = self.helpers.dynamic_key(_hash, abs_rel)
-        with self.connection.pipeline() as pipe:
-            while True:
-                try:
-                    pipe.watch(_current_key)
-                    count = self.count(_hash, pipe=pipe)
-                    if count == 0:
-                        return {}
-
-                    keys = pipe.zrange(_current_key, -limit, -1, withscores=True)
-                    if len(keys) == 0:
-                        return {}
-                    pipe.execute()
-                    break
-                except redis.exceptions.WatchError:
-                    continue
-
+        keys = self._by_rank(_hash, abs_rel, -limit, -1)
+        if len(keys) == 0:
+            return {}
         combined = self.helpers.combined_abs_rel(keys, abs_rel=abs_rel)
         return combined
 
@@ -356,23 +752,7 @@ class RedisDatabaseZSetsConnection(DatabaseConnection):
         ]:
             return []
         _hash = self.helpers.generate_hash(_query)
-        _current_key = self.helpers.dynamic_key(_hash, abs_rel)
-
-        with self.connection.pipeline() as pipe:
-            while True:
-                try:
-                    pipe.watch(_current_key)
-                    count = self.count(_hash, pipe=pipe)
-                    if count == 0:
-                        return []
-
-                    keys = pipe.zrangebyscore(
-                        _current_key, min=min_epoch, max=max_epoch, withscores=True
-                    )
-                    pipe.execute()
-                    break
-                except redis.exceptions.WatchError:
-                    continue
+        keys = self._by_score(_hash, abs_rel, min_epoch, max_epoch)
         combined = self.helpers.combined_abs_rel(keys, abs_rel=abs_rel)
         return combined
 
@@ -385,27 +765,200 @@ class RedisDatabaseZSetsConnection(DatabaseConnection):
         ]:
             return []
         _hash = self.helpers.generate_hash(_query)
-        _current_key = self.helpers.dynamic_key(_hash, abs_rel)
+        keys = self._by_score(_hash, abs_rel, "-inf", "+inf")
+        combined = self.helpers.combined_abs_rel(keys, abs_rel=abs_rel)
+        return combined
 
-        with self.connection.pipeline() as pipe:
-            while True:
-                try:
-                    pipe.watch(_current_key)
-                    count = self.count(_hash, pipe=pipe)
-                    min_epoch = self.min_score(_hash, pipe=pipe)
-                    max_epoch = self.max_score(_hash, pipe=pipe)
-                    if count == 0:
-                        return []
+    def _frame(
+        self, keys: List[Tuple[bytes, float]], column: str, other: Optional[Dict[bytes, float]] = None, other_column: str = ""
+    ) -> pd.DataFrame:
+        """
+            Decode (member, score) pairs straight into a dataframe.
 
-                    keys = pipe.zrangebyscore(
-                        _current_key, min=min_epoch, max=max_epoch, withscores=True
+            Numeric struct members are read as column arrays (see `bulk_columns`). Json members are parsed in one orjson call,
+            which builds the rows in C, so turning them into columns in python wouldn't be faster.
+            The scores become a float64 column. Skips the time fallbacks of `combined_abs_rel`.
+        """
+        if len(keys) == 0:
+            return pd.DataFrame()
+        members, scores = zip(*keys)
+        columns = bulk_columns(members)
+        if columns is not None:
+            frame = pd.DataFrame(columns)
+        else:
+            frame = pd.DataFrame.from_records(bulk_unserialize(members))
+        frame[column] = np.fromiter(scores, dtype=np.float64, count=len(scores))
+        if other is not None:
+            frame[other_column] = np.fromiter(
+                (other.get(member, score) for member, score in keys),
+                dtype=np.float64,
+                count=len(keys),
+            )
+        return frame
+
+    def query_between_frame(
+        self,
+        _query: dict,
+        min_epoch: float,
+        max_epoch: float,
+        abs_rel: str = "relative",
+    ) -> pd.DataFrame:
+        """ `query_between` as a dataframe. The score is the `time` column (relative) or `timestamp` column (absolute). """
+        if not self.helpers.validate_query(_query) or abs_rel not in [
+            "absolute",
+            "relative",
+        ]:
+            return pd.DataFrame()
+        _hash = self.helpers.generate_hash(_query)
+        keys = self._by_score(_hash, abs_rel, min_epoch, max_epoch)
+        column = "timestamp" if abs_rel == "absolute" else "time"
+        return self._frame(keys, column)
+
+    def query_all_frame(self, _query: dict) -> pd.DataFrame:
+        """ `query_all` as a dataframe, in relative time order, with both the `time` and `timestamp` columns. """
+        if not self.helpers.validate_query(_query):
+            return pd.DataFrame()
+        _hash = self.helpers.generate_hash(_query)
+        akeys, rkeys = self._all(_hash)
+        return self._frame(rkeys, "time", other=dict(akeys), other_column="timestamp")
+
+    def query_between_many(
+        self,
+        queries: List[dict],
+        min_epoch: Union[float, List[float]],
+        max_epoch: Union[float, List[float]],
+        abs_rel: str = "absolute",
+    ) -> Dict[str, list]:
+        """
+            Get the events between two epochs for many queries in one round trip.
+
+            `min_epoch` and `max_epoch` are either a single window shared by every query, or lists holding a window per query.
+            Every range goes out in one non-transactional pipeline. Returns the events keyed by each query's hash.
+            Invalid queries are left out.
+        """
+        if abs_rel not in ["absolute", "relative"]:
+            return {}
+        size = len(queries)
+        mins = min_epoch if isinstance(min_epoch, (list, tuple)) else [min_epoch] * size
+        maxes = max_epoch if isinstance(max_epoch, (list, tuple)) else [max_epoch] * size
+        if len(mins) != size or len(maxes) != size:
+            raise ValueError("Per query windows need one min and max epoch for every query")
+
+        ranges = []
+        for _query, _min, _max in zip(queries, mins, maxes):
+            if not self.helpers.validate_query(_query):
+                continue
+            ranges.append((self.helpers.generate_hash(_query), _min, _max))
+        replies = self._by_score_many(ranges, abs_rel)
+        return {
+            _hash: self.helpers.combined_abs_rel(keys, abs_rel=abs_rel)
+            for (_hash, _, _), keys in zip(ranges, replies)
+        }
+
+    def _by_score_many(self, ranges: List[Tuple[str, Any, Any]], abs_rel: str) -> List[List[Tuple[bytes, float]]]:
+        """ The (member, score) pairs of many (hash, min, max) ranges, read in one pipeline. """
+        if len(ranges) == 0:
+            return []
+        with self.connection.pipeline(transaction=False) as pipe:
+            for _hash, _min, _max in ranges:
+                _current_key = self.time_key(_hash, abs_rel)
+                if self.is_single:
+                    self.script("SINGLE_RANGE_BY_SCORE")(
+                        keys=[_current_key, f"{_hash}:payloads"],
+                        args=[_min, _max, 0, -1],
+                        client=pipe,
                     )
-                    pipe.execute()
-                    break
-                except redis.exceptions.WatchError:
-                    continue
-        combined = self.helpers.combined_abs_rel(keys, abs_rel=abs_rel)
-        return combined
+                else:
+                    pipe.zrangebyscore(_current_key, _min, _max, withscores=True)
+            replies = pipe.execute()
+        if self.is_single:
+            return [self._pairs(reply) for reply in replies]
+        return replies
+
+    def _pages(
+        self, _hash: str, abs_rel: str, min_epoch, max_epoch, chunk_size: int
+    ) -> Iterator[List[Tuple[bytes, float, float]]]:
+        """
+            Page through a score range with a score cursor.
+
+            Each page starts at the last score we saw and skips the members at that score we already gave back.
+            Yields lists of (member, score, other score).
+        """
+        other = "relative" if abs_rel == "absolute" else "absolute"
+        ordering_key = self.time_key(_hash, abs_rel)
+        other_key = self.time_key(_hash, other)
+        if self.is_single:
+            page = self.script("SINGLE_PAGE_BY_SCORE")
+            keys = [ordering_key, other_key, f"{_hash}:payloads"]
+        else:
+            page = self.script("PAGE_BY_SCORE")
+            keys = [ordering_key, other_key]
+
+        low, skip = min_epoch, 0
+        while True:
+            flat = page(
+                keys=keys,
+                args=[low, max_epoch, skip, chunk_size],
+                client=self.connection,
+            )
+            if len(flat) == 0:
+                return
+            triples = [
+                (flat[i], float(flat[i + 1]), float(flat[i + 2]))
+                for i in range(0, len(flat), 3)
+            ]
+            yield triples
+            if len(triples) < chunk_size:
+                return
+            last = triples[-1][1]
+            ties = sum(1 for triple in triples if triple[1] == last)
+            skip = (skip + ties) if last == low else ties
+            low = last
+
+    def _decode_page(self, triples: List[Tuple[bytes, float, float]], abs_rel: str) -> List[dict]:
+        time_field, other_field = "time", "timestamp"
+        if abs_rel == "absolute":
+            time_field, other_field = "timestamp", "time"
+        events = []
+        for member, score, other_score in triples:
+            event = single_one(member)
+            event[time_field] = score
+            event[other_field] = other_score
+            events.append(event)
+        return events
+
+    def iter_between(
+        self,
+        _query: dict,
+        min_epoch,
+        max_epoch,
+        abs_rel: str = "absolute",
+        chunk_size: int = 1000,
+    ) -> Iterator[List[dict]]:
+        """
+            Stream the events between two epochs in batches of `chunk_size`.
+
+            Only one batch is held in memory at a time, no matter how large the key is.
+            Each event gets both its relative (`time`) and absolute (`timestamp`) score.
+        """
+        if not self.helpers.validate_query(_query) or abs_rel not in [
+            "absolute",
+            "relative",
+        ]:
+            return
+        if chunk_size < 1:
+            raise ValueError("The chunk size must be at least 1")
+        _hash = self.helpers.generate_hash(_query)
+        for triples in self._pages(_hash, abs_rel, min_epoch, max_epoch, chunk_size):
+            yield self._decode_page(triples, abs_rel)
+
+    def iter_all(
+        self, _query: dict, abs_rel: str = "relative", chunk_size: int = 1000
+    ) -> Iterator[List[dict]]:
+        """ Stream every event in batches of `chunk_size`. The streaming version of `query_all`. """
+        return self.iter_between(
+            _query, "-inf", "+inf", abs_rel=abs_rel, chunk_size=chunk_size
+        )
 
     def query_latest_by_time(
         self, _query, max_epoch, abs_rel="absolute", limit: int = 10
@@ -417,27 +970,8 @@ class RedisDatabaseZSetsConnection(DatabaseConnection):
         ]:
             return []
         _hash = self.helpers.generate_hash(_query)
-        _current_key = self.helpers.dynamic_key(_hash, abs_rel)
-        with self.connection.pipeline() as pipe:
-            while True:
-                try:
-                    pipe.watch(_current_key)
-                    count = self.count(_hash, pipe=pipe)
-                    if count == 0:
-                        return []
-                    keys = pipe.zrangebyscore(
-                        _current_key,
-                        min=max_epoch,
-                        max="+inf",
-                        start=0,
-                        num=1,
-                        withscores=True,
-                    )
-                    combined = self.helpers.combined_abs_rel(keys, abs_rel)
-                    pipe.execute()
-                    break
-                except redis.exceptions.WatchError:
-                    continue
+        keys = self._by_score(_hash, abs_rel, max_epoch, "+inf", start=0, num=1)
+        combined = self.helpers.combined_abs_rel(keys, abs_rel)
         if len(combined) == 0:
             return {}
         return combined[0]
@@ -449,21 +983,7 @@ class RedisDatabaseZSetsConnection(DatabaseConnection):
         ]:
             return []
         _hash = self.helpers.generate_hash(_query)
-        _current_key = self.helpers.dynamic_key(_hash, abs_rel)
-        with self.connection.pipeline() as pipe:
-            while True:
-                try:
-                    pipe.watch(_current_key)
-                    count = self.count(_hash, pipe=pipe)
-                    if count == 0:
-                        return []
-                    keys = pipe.zrangebyscore(
-                        _current_key, min="-inf", max=max_epoch, withscores=True
-                    )
-                    pipe.execute()
-                    break
-                except redis.exceptions.WatchError:
-                    continue
+        keys = self._by_score(_hash, abs_rel, "-inf", max_epoch)
         combined = self.helpers.combined_abs_rel(keys, abs_rel)
         return combined
 
@@ -474,21 +994,7 @@ class RedisDatabaseZSetsConnection(DatabaseConnection):
         ]:
             return []
         _hash = self.helpers.generate_hash(_query)
-        _current_key = self.helpers.dynamic_key(_hash, abs_rel)
-        with self.connection.pipeline() as pipe:
-            while True:
-                try:
-                    count = self.count(_hash, pipe=pipe)
-                    if count == 0:
-                        return []
-                    keys = pipe.zrangebyscore(
-                        _current_key, min=min_epoch, max="+inf", withscores=True
-                    )
-                    pipe.execute()
-                    break
-                except redis.exceptions.WatchError:
-                    continue
-
+        keys = self._by_score(_hash, abs_rel, min_epoch, "+inf")
         combined = self.helpers.combined_abs_rel(keys, abs_rel)
         return combined
 
@@ -535,7 +1041,7 @@ class RedisDatabaseZSetsConnection(DatabaseConnection):
 
     def count(self, _hash: str, pipe=None) -> int:
         # ZCARD to get the length of the zset
-        _count_hash = f"{_hash}:alist"
+        _count_hash = self.time_key(_hash, "absolute")
         if pipe is not None:
             pipe.watch(_count_hash)
             count = pipe.zcard(_count_hash)
@@ -552,102 +1058,482 @@ class RedisDatabaseZSetsConnection(DatabaseConnection):
         general_key = f"{_hash}:lock:generalized"
         return self.connection.lock(general_key)
 
-    def min_score(self, _hash: str, pipe: Optional[Pipeline] = None):
-        """max_score Get Max Score
+    """
+        # Retention
+        ---
+        Policies are per entity (the `type` of a query) and live in redis so every process applies the same ones.
+        Writes enforce them atomically. `compact` sweeps keys that haven't been written to since a policy changed.
+    """
 
-            Get the max score given a key. We get the maximum score and cache it. 
-            If we change any information we can swap the cache out dynamically to increase access speed.
+    @property
+    def retention(self) -> Dict[str, RetentionPolicy]:
+        if self._retention is None:
+            self.load_retention()
+        return self._retention
+
+    def load_retention(self):
+        """ Reload the policies from redis. """
+        policies = {}
+        for entity, raw in self.connection.hgetall(RETENTION_KEY).items():
+            entity = entity.decode("utf-8") if isinstance(entity, bytes) else entity
+            policies[entity] = RetentionPolicy.from_dict(orjson.loads(raw))
+        self._retention = policies
+
+    def set_retention(
+        self, entity: str, max_len: int = 0, max_age: float = 0.0, age_by: str = "relative"
+    ) -> RetentionPolicy:
+        """ Set the retention policy of an entity. A policy without a max length or max age removes it. """
+        policy = RetentionPolicy(max_len=max_len, max_age=max_age, age_by=age_by)
+        if policy.is_empty:
+            self.connection.hdel(RETENTION_KEY, entity)
+            self.retention.pop(entity, None)
+            return policy
+        self.connection.hset(RETENTION_KEY, entity, orjson.dumps(policy.to_dict()))
+        self.retention[entity] = policy
+        return policy
+
+    def retention_for(self, query: dict) -> RetentionPolicy:
+        return self.retention.get(query.get("type", ""), NO_RETENTION)
+
+    def _count_trimmed(self, trimmed):
+        trimmed = int(trimmed or 0)
+        if trimmed > 0:
+            self.metrics.incr("retention.trimmed", trimmed)
+
+    def _trimmed(self, _hash: str, reply) -> int:
+        """ Count what a trim removed and recompute the rollups over it. Takes the `[trimmed, low, high]` reply of the scripts. """
+        trimmed, low, high = reply
+        self._count_trimmed(trimmed)
+        if int(trimmed or 0) > 0:
+            self.refresh_rollups(_hash, low, high)
+        return int(trimmed or 0)
+
+    def _retain(self, _hash: str, policy: RetentionPolicy, client=None):
+        """ 
+            Apply a policy to a key and rewrite its stats. Pass a pipeline as the client to queue it with a write.
+            Replies with `[trimmed, low, high]`, see `_trimmed`.
         """
-        _count_hash = f"{_hash}:rlist"
-        if pipe is not None:
-            pipe.watch(_count_hash)
-            count = pipe.zrangebyscore(
-                start=0,
-                num=1,
-                name=_count_hash,
-                min="-inf",
-                max="+inf",
-                withscores=True,
-            )
+        keys = [
+            self.time_key(_hash, "relative"),
+            self.time_key(_hash, "absolute"),
+            f"{_hash}:stats",
+        ]
+        if self.is_single:
+            keys.append(f"{_hash}:payloads")
+        return self.script("RETAIN")(
+            keys=keys,
+            args=[maya.now()._epoch] + policy.args(),
+            client=client or self.connection,
+        )
+
+    def _queue_retain(self, _hash: str, policy: RetentionPolicy, pipe: Pipeline) -> Optional[int]:
+        """ 
+            Queue the policy of a write into its pipeline. Without a policy there's nothing to trim, so only the stats are rewritten.
+            Returns where the trim reply lands in the replies, or None if nothing was trimmed.
+        """
+        if policy.is_empty:
+            self._refresh_stats(_hash, client=pipe)
+            return None
+        # The lock commands are queued too. Remember where our reply lands.
+        position = len(pipe)
+        self._retain(_hash, policy, client=pipe)
+        return position
+
+    def event_hashes(self) -> Iterator[str]:
+        """ The hash of every key holding events in the current layout. """
+        suffix = ":rindex" if self.is_single else ":rlist"
+        for key in self.connection.scan_iter(match=f"*{suffix}", count=1000):
+            key = key.decode("utf-8") if isinstance(key, bytes) else key
+            yield key[: -len(suffix)]
+
+    def compact(self) -> int:
+        """ Apply the retention policies to every stored key. Returns the number of events trimmed. """
+        self.load_retention()
+        self.metrics.incr("retention.compactions")
+        if len(self.retention) == 0:
+            return 0
+
+        total = 0
+        for _hash in self.event_hashes():
+            try:
+                query = self.helpers.hash_to_dict(_hash, self.connection)
+            except Exception:
+                continue
+            policy = self.retention_for(query)
+            if policy.is_empty:
+                continue
+            total += self._trimmed(_hash, self._retain(_hash, policy))
+        return total
+
+    """
+        # Codecs
+        ---
+        Members are encoded with the codec of their entity (see `jamboree.utils.support.events.cereal`).
+        Codecs live in redis next to the retention policies, and struct schemas under `jamboree:schemas`.
+
+        The first write of a key records its codec under `{hash}:codec`. Later writes and deletes of the key keep using it,
+        so changing the codec of an entity only changes keys created afterwards. Reads don't need the record,
+        because every member says how it was encoded.
+    """
+
+    @property
+    def codecs(self) -> Dict[str, Codec]:
+        if self._codecs is None:
+            self.load_codecs()
+        return self._codecs
+
+    def load_codecs(self):
+        """ Reload the entity codecs. """
+        self._codecs = {entity: get_codec(spec) for entity, spec in self._codec_specs().items()}
+
+    def set_codec(self, entity: str, codec: str = "json", fields: Optional[Dict[str, str]] = None) -> Codec:
+        """ Set the codec new keys of an entity are written with. `struct` needs the fields of its schema. `json` removes it. """
+        if codec == "struct" and not fields:
+            raise ValueError("The struct codec needs the fields of its schema")
+        _codec = get_codec({"codec": codec, "fields": fields})
+        if _codec is JSON:
+            self._put_codec_spec(entity, None)
+            self.codecs.pop(entity, None)
+            return _codec
+        if isinstance(_codec, StructCodec):
+            self._put_schema(_codec.schema)
+        self._put_codec_spec(entity, _codec.to_dict())
+        self.codecs[entity] = _codec
+        return _codec
+
+    def codec_for(self, query: dict) -> Codec:
+        return self.codecs.get(query.get("type", ""), JSON)
+
+    def key_codec(self, _hash: str, query: Optional[dict] = None) -> Codec:
+        """ 
+            The codec a key is written with. 
+            Given the query of a key without one, the key takes its entity's codec and records it.
+        """
+        codec = self._key_codecs.get(_hash)
+        if codec is not None:
+            return codec
+        if len(self.codecs) == 0:
+            # Every entity we know of writes json. Skip the lookup.
+            return JSON
+        proposed = None if query is None else self.codec_for(query).to_dict()
+        spec = self._record_codec(_hash, proposed)
+        if spec is None:
+            return JSON
+        codec = get_codec(spec)
+        self._key_codecs[_hash] = codec
+        return codec
+
+    def encode(self, query: dict, data: dict, _hash: Optional[str] = None) -> bytes:
+        """ Encode an event the way the key of the query stores it. """
+        _hash = _hash or self.helpers.generate_hash(query)
+        return self.key_codec(_hash, query).encode(data)
+
+    def _codec_specs(self) -> Dict[str, dict]:
+        specs = {}
+        for entity, raw in self.connection.hgetall(CODEC_KEY).items():
+            entity = entity.decode("utf-8") if isinstance(entity, bytes) else entity
+            specs[entity] = orjson.loads(raw)
+        return specs
+
+    def _put_codec_spec(self, entity: str, spec: Optional[dict]):
+        if spec is None:
+            self.connection.hdel(CODEC_KEY, entity)
+            return
+        self.connection.hset(CODEC_KEY, entity, orjson.dumps(spec))
 
+    def _record_codec(self, _hash: str, spec: Optional[dict]) -> Optional[dict]:
+        """ Record the codec of a key unless it already has one. Returns the recorded spec. """
+        key = f"{_hash}:codec"
+        if spec is None:
+            raw = self.connection.get(key)
         else:
-            count = self.connection.zrangebyscore(
-                name=_count_hash,
-                start=0,
-                num=1,
-                min="-inf",
-                max="+inf",
-                withscores=True,
-            )
-        if count is None:
-            return float(0.0)
+            with self.connection.pipeline(transaction=False) as pipe:
+                pipe.setnx(key, orjson.dumps(spec))
+                pipe.get(key)
+                _, raw = pipe.execute()
+        return None if raw is None else orjson.loads(raw)
 
-        if len(count) > 0:
-            return float(count[0][1])
-        return float(0.0)
-
-    # def max_score(self, _hash: str, pipe: Optional[Pipeline] = None):
-    #     """max_score Get Max Score
-
-    #         Get the max score given a key. We get the maximum score and cache it.
-    #         If we change any information we can swap the cache out dynamically to increase access speed.
-    #     """
-    #     _count_hash = f"{_hash}:rlist"
-    #     if pipe is not None:
-    #         pipe.watch(_count_hash)
-    #         count = pipe.zrangebyscore(
-    #             start=0, num=1,
-    #             name=_count_hash,
-    #             min="-inf", max="+inf",
-    #             withscores=True
-    #         )
-
-    #     else:
-    #         count = self.connection.zrangebyscore(
-    #             name=_count_hash,
-    #             start=0, num=1,
-    #             min="-inf", max="+inf",
-    #             withscores=True
-    #         )
-    #     if count is None:
-    #         return float(0.0)
-
-    #     if len(count) > 0:
-    #         return float(count[0][1])
-    #     return float(0.0)
+    def _put_schema(self, schema: Schema):
+        self.connection.hset(SCHEMA_KEY, schema.hex, orjson.dumps(schema.to_dict()))
 
-    def max_score(self, _hash: str, pipe: Optional[Pipeline] = None):
-        """min_score Get Minimum Score
+    def _schema(self, schema_id: str) -> Optional[dict]:
+        raw = self.connection.hget(SCHEMA_KEY, schema_id)
+        return None if raw is None else orjson.loads(raw)
+
+    """
+        # Batches
+        ---
+        `batch` queues the writes of the calling thread into one MULTI/EXEC pipeline. See `batch` for the details.
+    """
+
+    def batch_scope(self) -> Optional[ContextManager]:
+        """ What backends that can't queue writes hold for the whole of a batch instead. Redis queues them. """
+        return None
+
+    @property
+    def active_batch(self) -> Optional[Batch]:
+        """ The batch open on the calling thread. """
+        return getattr(self._batches, "batch", None)
 
-            Get the min score given a key. We get the maximum score and cache it. 
-            If we change any information we can swap the cache out dynamically to increase access speed.
+    def batch(self, watch: List[dict] = []) -> Batch:
+        """ 
+            Open a batch on this thread, or join the one already open.
+            The stats and single value keys of the `watch` queries are watched until the batch is sent.
         """
-        _count_hash = f"{_hash}:alist"
-        first_dict: Optional[Dict[AnyStr, Any]] = None
+        batch = self.active_batch
+        if batch is not None:
+            if len(watch) > 0:
+                raise ValueError("Watch the keys on the outermost batch")
+            return batch.open()
+        keys = []
+        for query in watch:
+            if not self.helpers.validate_query(query):
+                raise ValueError(f"Can't watch an invalid query: {query}")
+            _hash = self.helpers.generate_hash(query)
+            keys.extend([f"{_hash}:stats", f"{_hash}:single"])
+        batch = Batch(self, watch=keys).open()
+        self._batches.batch = batch
+        return batch
+
+    def _batched(self, _hash: str) -> Optional[Pipeline]:
+        """ The pipeline of the batch open on this thread, if any. Marks the hash as written by the batch. """
+        batch = self.active_batch
+        if batch is None or batch.pipe is None:
+            return None
+        batch.hashes.add(_hash)
+        return batch.pipe
+
+    """
+        # Stats
+        ---
+        Every write and delete rewrites `{hash}:stats` in the same atomic step:
+        count, min_time, max_time, min_timestamp, max_timestamp and last_write.
+        Reading all of it is a single HGETALL.
+    """
 
+    def _refresh_stats(self, _hash: str, client=None):
+        """ Rewrite the stats of a key. Pass a pipeline as the client to queue it with other commands. """
+        return self.script("STATS")(
+            keys=[
+                self.time_key(_hash, "relative"),
+                self.time_key(_hash, "absolute"),
+                f"{_hash}:stats",
+            ],
+            args=[maya.now()._epoch],
+            client=client or self.connection,
+        )
+
+    def stats(self, _hash: str) -> dict:
+        """ Get the stats of a key. Keys written before stats existed get them filled in on the first read. """
+        raw = self.connection.hgetall(f"{_hash}:stats")
+        if len(raw) == 0:
+            flat = self._refresh_stats(_hash)
+            raw = dict(zip(flat[::2], flat[1::2]))
+        stats = {}
+        for field, value in raw.items():
+            field = field.decode("utf-8") if isinstance(field, bytes) else field
+            stats[field] = float(value)
+        if "count" in stats:
+            stats["count"] = int(stats["count"])
+        return stats
+
+    def min_score(self, _hash: str, pipe: Optional[Pipeline] = None):
+        """ Get the smallest relative time of a key. Uses the stats unless a watching pipeline is given. """
         if pipe is not None:
+            _count_hash = self.time_key(_hash, "relative")
             pipe.watch(_count_hash)
-            first_dict = pipe.zrangebyscore(
-                name=_count_hash,
-                start=0,
-                num=1,
-                min="+inf",
-                max="-inf",
-                withscores=True,
-            )
-        else:
-            first_dict = self.connection.zrangebyscore(
-                name=_count_hash,
-                start=0,
-                num=1,
-                min="+inf",
-                max="-inf",
-                withscores=True,
-            )
+            first = pipe.zrange(_count_hash, 0, 0, withscores=True)
+            if len(first) > 0:
+                return float(first[0][1])
+            return float(0.0)
+        return float(self.stats(_hash).get("min_time", 0.0))
 
-        if first_dict is None:
+    def max_score(self, _hash: str, pipe: Optional[Pipeline] = None):
+        """ Get the largest relative time of a key. Uses the stats unless a watching pipeline is given. """
+        if pipe is not None:
+            _count_hash = self.time_key(_hash, "relative")
+            pipe.watch(_count_hash)
+            last = pipe.zrevrange(_count_hash, 0, 0, withscores=True)
+            if len(last) > 0:
+                return float(last[0][1])
             return float(0.0)
+        return float(self.stats(_hash).get("max_time", 0.0))
+
+    """
+        # Rollups
+        ---
+        `{hash}:rollup:1m`, `:1h` and `:1d` hold one aggregated state per bucket, scored by the bucket start (see `rollups`).
+        `{hash}:rollup` marks that the tiers were built over the whole log, so reads can trust them.
+
+        Updates recompute the touched buckets from the stored events instead of adding to them,
+        so writing the same events twice doesn't count them twice.
+        Deletes, retention trims and spills recompute the buckets over the span they removed (see `refresh_rollups`).
+        Events spilled to the cold tier still count, so a spill leaves the buckets as they were.
+        An update holds `{hash}:rollup:lock`, so updates of one key from many processes run one at a time.
+    """
+
+    def rollup_key(self, _hash: str, tier: str) -> str:
+        return f"{_hash}:rollup:{tier}"
+
+    def _rollup_raw(self, _hash: str, min_epoch: float, max_epoch: float, closed: bool = True) -> pd.DataFrame:
+        """ Raw events between two relative times as a frame. An open end leaves out events at `max_epoch`. """
+        upper = max_epoch if closed else f"({max_epoch}"
+        frame = self._frame(self._by_score(_hash, "relative", min_epoch, upper), "time")
+        if self.cold is None:
+            return frame
+        cold = self.cold.frame(_hash, min_epoch, upper, "relative")
+        if cold.empty:
+            return frame
+        frame = pd.concat([cold, frame], ignore_index=True, sort=False)
+        return frame.sort_values("time", kind="mergesort", ignore_index=True)
+
+    """
+        ## Rollup Storage
+        ---
+        The only rollup methods other backends replace. Everything above and below them is shared.
+    """
+
+    def _rollup_states(self, _hash: str, reads: List[Tuple[str, float, float]]) -> List[List[dict]]:
+        """ The states of many (tier, start, end) reads, each holding the buckets starting inside of `[start, end)`. """
+        if len(reads) == 0:
+            return []
+        with self.connection.pipeline(transaction=False) as pipe:
+            for tier, start, end in reads:
+                pipe.zrangebyscore(self.rollup_key(_hash, tier), start, f"({end}")
+            replies = pipe.execute()
+        return [[orjson.loads(state) for state in reply] for reply in replies]
+
+    def _write_tier(self, _hash: str, tier: str, start: float, end: float, buckets: Dict[float, dict]):
+        """ Replace the buckets of a tier starting inside of `[start, end)`. """
+        key = self.rollup_key(_hash, tier)
+        with self.connection.pipeline() as pipe:
+            pipe.zremrangebyscore(key, start, f"({end}")
+            if len(buckets) > 0:
+                pipe.zadd(key, {orjson.dumps(state): bucket for bucket, state in buckets.items()})
+            pipe.execute()
+
+    def _has_rollups(self, _hash: str) -> bool:
+        return bool(self.connection.exists(f"{_hash}:rollup"))
+
+    def _mark_rollups(self, _hash: str):
+        """ Mark the tiers of a hash built over its whole log. """
+        self.connection.set(f"{_hash}:rollup", orjson.dumps([tier for tier, _ in rollups.TIERS]))
+
+    def _drop_rollups(self, _hash: str):
+        self.unlink(f"{_hash}:rollup", *[self.rollup_key(_hash, tier) for tier, _ in rollups.TIERS])
+
+    def _rollup_scope(self, _hash: str) -> ContextManager:
+        """ 
+            Held while the tiers of a hash are read, recomputed and written.
+            Updates from other processes would otherwise interleave and write buckets aggregated from stale children.
+        """
+        return self.connection.lock(f"{_hash}:rollup:lock", timeout=self.rollup_lock_timeout)
+
+    """
+        ## Rollup Updates
+    """
+
+    def _event_span(self, _hash: str) -> Optional[Tuple[float, float]]:
+        """ The lowest and highest relative time of a key, across both tiers. None if it has no events. """
+        bounds = [self.stats(_hash)]
+        if self.cold is not None:
+            bounds.append(self.cold.stats(_hash))
+        bounds = [stats for stats in bounds if stats.get("count", 0) > 0]
+        if len(bounds) == 0:
+            return None
+        return min(stats["min_time"] for stats in bounds), max(stats["max_time"] for stats in bounds)
+
+    def update_rollups(self, query: dict, min_epoch: float, max_epoch: float):
+        """ Recompute every rollup bucket holding relative times between `min_epoch` and `max_epoch`. Builds the whole log the first time. """
+        if not self.helpers.validate_query(query):
+            return
+        batch = self.active_batch
+        if batch is not None:
+            # The raw events aren't written until the batch is sent
+            batch.after(lambda: self.update_rollups(query, min_epoch, max_epoch))
+            return
+        _hash = self.helpers.generate_hash(query)
+        with self._rollup_scope(_hash):
+            if not self._has_rollups(_hash):
+                span = self._event_span(_hash)
+                if span is None:
+                    return
+                min_epoch = min(min_epoch, span[0])
+                max_epoch = max(max_epoch, span[1])
+            self._update_rollups(_hash, min_epoch, max_epoch)
+
+    def refresh_rollups(self, _hash: str, min_epoch: Optional[float], max_epoch: Optional[float]):
+        """ 
+            Recompute the rollup buckets holding relative times between `min_epoch` and `max_epoch` after events there were removed.
+            Keys without rollups are left alone. No bounds (nothing removed) does nothing.
+        """
+        if min_epoch is None or max_epoch is None:
+            return
+        batch = self.active_batch
+        if batch is not None:
+            batch.after(lambda: self.refresh_rollups(_hash, min_epoch, max_epoch))
+            return
+        with self._rollup_scope(_hash):
+            if self._has_rollups(_hash):
+                self._update_rollups(_hash, float(min_epoch), float(max_epoch))
+
+    def _update_rollups(self, _hash: str, min_epoch: float, max_epoch: float):
+        """ Recompute the buckets of every tier over a span of relative times and mark the tiers built. The caller holds the rollup scope. """
+        previous = None
+        for tier, width in rollups.TIERS:
+            start = rollups.bucket_of(min_epoch, width)
+            end = rollups.bucket_of(max_epoch, width) + width
+            if previous is None:
+                frame = self._rollup_raw(_hash, start, end, closed=False)
+                buckets = rollups.aggregate(frame, width)
+            else:
+                children = self._rollup_states(_hash, [(previous, start, end)])[0]
+                buckets = rollups.combine(children, width)
+            self._write_tier(_hash, tier, start, end, buckets)
+            previous = tier
+        self._mark_rollups(_hash)
+        self.metrics.incr("rollups.updates")
+
+    def rebuild_rollups(self, query: dict):
+        """ Drop the tiers of a query and build them again from every stored event. """
+        if not self.helpers.validate_query(query):
+            return
+        batch = self.active_batch
+        if batch is not None:
+            batch.after(lambda: self.rebuild_rollups(query))
+            return
+        _hash = self.helpers.generate_hash(query)
+        with self._rollup_scope(_hash):
+            self._drop_rollups(_hash)
+            span = self._event_span(_hash)
+            if span is not None:
+                self._update_rollups(_hash, span[0], span[1])
+
+    def query_rollups(self, query: dict, min_epoch: float, max_epoch: float, tiers: List[str]) -> Optional[List[dict]]:
+        """
+            Get bucket states covering the relative times `[min_epoch, max_epoch]`, using only the given tiers.
+
+            Whole buckets come from the coarsest tier that fits, the edges from finer tiers,
+            and anything smaller than the finest tier is aggregated from the raw events.
+            Returns None if the tiers of the query were never built.
+        """
+        if not self.helpers.validate_query(query):
+            return None
+        _hash = self.helpers.generate_hash(query)
+        widths = [width for tier, width in rollups.TIERS if tier in tiers]
+        if len(widths) == 0 or not self._has_rollups(_hash):
+            return None
+        names = {width: tier for tier, width in rollups.TIERS}
+
+        segments = rollups.plan(min_epoch, max_epoch, widths)
+        reads = [(names[width], start, end) for width, start, end, _ in segments if width is not None]
+        replies = iter(self._rollup_states(_hash, reads))
+        states = []
+        for width, start, end, closed in segments:
+            if width is None:
+                frame = self._rollup_raw(_hash, start, end, closed=closed)
+                states.extend(rollups.aggregate(frame, widths[0]).values())
+                continue
+            states.extend(next(replies))
+        return states
 
-        if len(first_dict) > 0:
-            return float(first_dict[0][1])
-        return float(0.0)
@@ -0,0 +1,314 @@
+"""
+    # Async ZSet Connection
+    ---
+    The asyncio twin of `RedisDatabaseZSetsConnection`. It reads and writes the same keys in either layout,
+    so sync and async processes can share the same events.
+
+    * Writes always go through the append scripts. One atomic EVALSHA, no lock to wait on.
+    * Members are encoded with the codec pinned to their key, the same as sync writes, so either side can match and delete them.
+    * Reads are a single range command (or script in the single layout). They're atomic on their own, so there's nothing to watch or retry.
+
+    Needs `redis>=4.2` (`redis.asyncio`) or `aioredis>=2`. Neither is imported until `async_client` is called.
+    The pinned redis is older than 4.2, so install the `async` extra (`pip install jamboree[async]`) for aioredis.
+
+    ```
+        conn = AsyncRedisDatabaseZSetsConnection()
+        conn.connection = async_client("localhost", 6379)
+        await conn.save_many(query, events)
+        latest = await conn.query_latest(query)
+    ```
+"""
+import hashlib
+from copy import copy
+from typing import Dict, List, Optional, Tuple
+
+import maya
+import orjson
+import ujson
+
+from jamboree.storage.databases import lua
+from jamboree.storage.databases.database import DatabaseConnection
+from jamboree.storage.databases.retention import (
+    NO_RETENTION, RETENTION_KEY, RetentionPolicy
+)
+from jamboree.utils.helper import KEY_LOOKUP, Helpers
+from jamboree.utils.support.events.cereal import CODEC_KEY, JSON, Codec, get_codec
+
+
+def async_client(host: str = "localhost", port: int = 6379, max_connections: int = 64):
+    """
+        An asyncio redis client on a blocking connection pool.
+        Every coroutine shares the pool. Past `max_connections` they wait for a free connection instead of failing.
+    """
+    try:
+        from redis import asyncio as aioredis
+    except ImportError:
+        try:
+            import aioredis
+        except ImportError:
+            raise ImportError(
+                "The async backend needs either redis>=4.2 or aioredis>=2 installed."
+            )
+    pool = aioredis.BlockingConnectionPool(
+        host=host, port=port, max_connections=max_connections, timeout=None
+    )
+    return aioredis.Redis(connection_pool=pool)
+
+
+class AsyncRedisDatabaseZSetsConnection(DatabaseConnection):
+    def __init__(self) -> None:
+        super().__init__()
+        self._layout = "dual"
+        self._scripts = {}
+        self._retention: Optional[Dict[str, RetentionPolicy]] = None
+        self._codecs: Optional[Dict[str, Codec]] = None
+        self._key_codecs: Dict[str, Codec] = {}
+
+    @property
+    def layout(self) -> str:
+        """ How events are stored. Either `dual` or `single`. Match the sync connection writing the same keys. """
+        return self._layout
+
+    @layout.setter
+    def layout(self, _layout: str):
+        if _layout not in ["dual", "single"]:
+            raise ValueError("The layout must either be 'dual' or 'single'")
+        self._layout = _layout
+
+    @property
+    def is_single(self) -> bool:
+        return self._layout == "single"
+
+    def member_id(self, serialized: bytes) -> str:
+        return hashlib.sha1(serialized).hexdigest()[:16]
+
+    def time_key(self, _hash: str, abs_rel: str) -> str:
+        if self.is_single:
+            if abs_rel == "absolute":
+                return f"{_hash}:aindex"
+            return f"{_hash}:rindex"
+        return self.helpers.dynamic_key(_hash, abs_rel)
+
+    def script(self, name: str):
+        if name not in self._scripts:
+            self._scripts[name] = self.connection.register_script(
+                getattr(lua, name)
+            )
+        return self._scripts[name]
+
+    async def remember_key(self, _hash: str, query: dict):
+        if _hash in self._remembered or not Helpers.key_lookup or not self.helpers.is_digest(_hash):
+            return
+        await self.connection.hsetnx(KEY_LOOKUP, _hash, ujson.dumps(query, sort_keys=True))
+        self._remembered.add(_hash)
+
+    async def close(self):
+        """ Close every connection in the pool. """
+        await self.connection.connection_pool.disconnect()
+
+    """
+        # Retention
+        ---
+        Same policies as the sync connection. They're loaded once and enforced by the append scripts.
+    """
+
+    async def load_retention(self) -> Dict[str, RetentionPolicy]:
+        policies = {}
+        for entity, raw in (await self.connection.hgetall(RETENTION_KEY)).items():
+            entity = entity.decode("utf-8") if isinstance(entity, bytes) else entity
+            policies[entity] = RetentionPolicy.from_dict(orjson.loads(raw))
+        self._retention = policies
+        return policies
+
+    async def retention_for(self, query: dict) -> RetentionPolicy:
+        if self._retention is None:
+            await self.load_retention()
+        return self._retention.get(query.get("type", ""), NO_RETENTION)
+
+    """
+        # Codecs
+        ---
+        Same codecs as the sync connection. A key keeps the codec recorded under `{hash}:codec` by whichever side wrote it first.
+    """
+
+    async def load_codecs(self) -> Dict[str, Codec]:
+        codecs = {}
+        for entity, raw in (await self.connection.hgetall(CODEC_KEY)).items():
+            entity = entity.decode("utf-8") if isinstance(entity, bytes) else entity
+            codecs[entity] = get_codec(orjson.loads(raw))
+        self._codecs = codecs
+        return codecs
+
+    async def key_codec(self, _hash: str, query: Optional[dict] = None) -> Codec:
+        """ The codec a key is written with. Given the query of a key without one, the key takes its entity's codec and records it. """
+        codec = self._key_codecs.get(_hash)
+        if codec is not None:
+            return codec
+        if self._codecs is None:
+            await self.load_codecs()
+        if len(self._codecs) == 0:
+            return JSON
+        key = f"{_hash}:codec"
+        proposed = None if query is None else self._codecs.get(query.get("type", ""), JSON)
+        if proposed is None or proposed is JSON:
+            raw = await self.connection.get(key)
+        else:
+            await self.connection.setnx(key, orjson.dumps(proposed.to_dict()))
+            raw = await self.connection.get(key)
+        if raw is None:
+            return JSON
+        codec = get_codec(orjson.loads(raw))
+        self._key_codecs[_hash] = codec
+        return codec
+
+    def _trimmed(self, reply) -> Optional[Tuple[float, float]]:
+        """ Count what a trim removed. Takes the `[trimmed, low, high]` reply of the scripts and returns the span of relative times removed, if any. """
+        trimmed, low, high = reply
+        trimmed = int(trimmed or 0)
+        if trimmed == 0:
+            return None
+        self.metrics.incr("retention.trimmed", trimmed)
+        return float(low), float(high)
+
+    """
+        # Save Commands
+    """
+
+    async def _append(
+        self,
+        _hash: str,
+        events: List[Tuple[bytes, float, float]],
+        policy: RetentionPolicy = NO_RETENTION,
+    ):
+        """ 
+            Appends (member, relative time, absolute time) events in a single EVALSHA.
+            Returns the span of relative times retention trimmed, if any. The sync connection refreshes the rollups over it.
+        """
+        args = [maya.now()._epoch] + policy.args()
+        if self.is_single:
+            for member, _time, _timestamp in events:
+                args.extend([self.member_id(member), member, _time, _timestamp])
+            keys = [
+                f"{_hash}:payloads",
+                f"{_hash}:rindex",
+                f"{_hash}:aindex",
+                f"{_hash}:stats",
+            ]
+            name = "SINGLE_APPEND"
+        else:
+            for member, _time, _timestamp in events:
+                args.extend([member, _time, _timestamp])
+            keys = [f"{_hash}:rlist", f"{_hash}:alist", f"{_hash}:stats"]
+            name = "ZSET_APPEND"
+        reply = await self.script(name)(keys=keys, args=args)
+        return self._trimmed(reply[1:])
+
+    async def save(self, query: dict, data: dict, _time=None, _timestamp=None):
+        """ Save a single record. Returns the span of relative times retention trimmed, if any. """
+        if not self.helpers.validate_query(query):
+            return
+        _hash = self.helpers.generate_hash(query)
+        await self.remember_key(_hash, query)
+        policy = await self.retention_for(query)
+        merged = copy(query)
+        merged.update(data)
+        data, timing = self.helpers.separate_time_data(merged, _time, _timestamp)
+        codec = await self.key_codec(_hash, query)
+        serialized = codec.encode(data)
+        return await self._append(
+            _hash, [(serialized, timing["time"], timing["timestamp"])], policy
+        )
+
+    async def save_many(self, query: dict, data: Dict[bytes, float] = {}):
+        """ Save many serialized events (member -> relative time) at once. Returns the span of relative times retention trimmed, if any. """
+        if not self.helpers.validate_query(query) or len(data) == 0:
+            return
+        _hash = self.helpers.generate_hash(query)
+        await self.remember_key(_hash, query)
+        policy = await self.retention_for(query)
+        codec = await self.key_codec(_hash, query)
+        if codec is not JSON:
+            # The members come in as json
+            data = {codec.encode(orjson.loads(member)): _time for member, _time in data.items()}
+        timestamp = maya.now()._epoch
+        events = [(member, _time, timestamp) for member, _time in data.items()]
+        return await self._append(_hash, events, policy)
+
+    """
+        # Query Commands
+    """
+
+    def _pairs(self, flat: list) -> List[Tuple[bytes, float]]:
+        return [(flat[i], float(flat[i + 1])) for i in range(0, len(flat), 2)]
+
+    async def _by_rank(self, _hash: str, abs_rel: str, start: int, end: int):
+        _current_key = self.time_key(_hash, abs_rel)
+        if self.is_single:
+            flat = await self.script("SINGLE_RANGE_BY_RANK")(
+                keys=[_current_key, f"{_hash}:payloads"], args=[start, end]
+            )
+            return self._pairs(flat)
+        return await self.connection.zrange(_current_key, start, end, withscores=True)
+
+    async def _by_score(self, _hash: str, abs_rel: str, min_epoch, max_epoch):
+        _current_key = self.time_key(_hash, abs_rel)
+        if self.is_single:
+            flat = await self.script("SINGLE_RANGE_BY_SCORE")(
+                keys=[_current_key, f"{_hash}:payloads"],
+                args=[min_epoch, max_epoch, 0, -1],
+            )
+            return self._pairs(flat)
+        return await self.connection.zrangebyscore(
+            _current_key, min_epoch, max_epoch, withscores=True
+        )
+
+    async def query_latest(self, _query: dict, abs_rel="absolute"):
+        if not self.helpers.validate_query(_query) or not self.helpers.is_abs_rel(abs_rel):
+            return {}
+        _hash = self.helpers.generate_hash(_query)
+        keys = await self._by_rank(_hash, abs_rel, -1, -1)
+        if len(keys) == 0:
+            return {}
+        return self.helpers.combined_abs_rel(keys, abs_rel=abs_rel)[-1]
+
+    async def query_latest_many(self, _query: dict, abs_rel="absolute", limit: int = 10):
+        if not self.helpers.validate_query(_query) or not self.helpers.is_abs_rel(abs_rel):
+            return []
+        _hash = self.helpers.generate_hash(_query)
+        keys = await self._by_rank(_hash, abs_rel, -limit, -1)
+        if len(keys) == 0:
+            return []
+        return self.helpers.combined_abs_rel(keys, abs_rel=abs_rel)
+
+    async def query_between(
+        self, _query: dict, min_epoch: float, max_epoch: float, abs_rel: str = "absolute"
+    ):
+        if not self.helpers.validate_query(_query) or not self.helpers.is_abs_rel(abs_rel):
+            return []
+        _hash = self.helpers.generate_hash(_query)
+        keys = await self._by_score(_hash, abs_rel, min_epoch, max_epoch)
+        return self.helpers.combined_abs_rel(keys, abs_rel=abs_rel)
+
+    async def count(self, _hash: str) -> int:
+        return int(await self.connection.zcard(self.time_key(_hash, "absolute")))
+
+    async def stats(self, _hash: str) -> dict:
+        """ Get the stats of a key. Same fields as the sync connection. """
+        raw = await self.connection.hgetall(f"{_hash}:stats")
+        if len(raw) == 0:
+            flat = await self.script("STATS")(
+                keys=[
+                    self.time_key(_hash, "relative"),
+                    self.time_key(_hash, "absolute"),
+                    f"{_hash}:stats",
+                ],
+                args=[maya.now()._epoch],
+            )
+            raw = dict(zip(flat[::2], flat[1::2]))
+        stats = {}
+        for field, value in raw.items():
+            field = field.decode("utf-8") if isinstance(field, bytes) else field
+            stats[field] = float(value)
+        if "count" in stats:
+            stats["count"] = int(stats["count"])
+        return stats
@@ -0,0 +1,576 @@
+"""
+    # SQLite Connection
+    ---
+    An embedded, file backed event store with the same interface as `RedisDatabaseZSetsConnection`.
+
+    Use it to serve history that doesn't fit in RAM from local disk, without a redis server.
+    Keys are the same query hashes. Events are clustered by (hash, relative time), so a relative range read is one sequential scan.
+    Absolute time reads go through an index on (hash, absolute time).
+
+    Every write (a whole `save_many` included) is one transaction. The database runs in WAL mode,
+    so readers on other threads or processes never wait on a writer.
+
+    ```
+        jam = Jamboree(BACKEND="sqlite", SQLITE_PATH="/data/ticks.db")
+    ```
+"""
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import maya
+import orjson
+import ujson
+
+from jamboree.storage.databases import rollups
+from jamboree.storage.databases.jredis_zset import RedisDatabaseZSetsConnection
+from jamboree.storage.databases.retention import NO_RETENTION, RetentionPolicy
+from jamboree.utils.helper import score_bound
+
+# Events are keyed by the compact member id of the single layout. Ties inside of a score are ordered by it too.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    hash TEXT NOT NULL,
+    time REAL NOT NULL,
+    id TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    member BLOB NOT NULL,
+    PRIMARY KEY (hash, time, id)
+) WITHOUT ROWID;
+CREATE UNIQUE INDEX IF NOT EXISTS events_by_id ON events (hash, id);
+CREATE INDEX IF NOT EXISTS events_by_timestamp ON events (hash, timestamp, id);
+CREATE TABLE IF NOT EXISTS logs (
+    hash TEXT PRIMARY KEY,
+    count INTEGER NOT NULL DEFAULT 0,
+    last_write REAL NOT NULL DEFAULT 0,
+    rollup INTEGER NOT NULL DEFAULT 0,
+    query TEXT
+);
+CREATE TABLE IF NOT EXISTS singles (hash TEXT PRIMARY KEY, value BLOB);
+CREATE TABLE IF NOT EXISTS retention (entity TEXT PRIMARY KEY, policy TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS codecs (entity TEXT PRIMARY KEY, spec TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS key_codecs (hash TEXT PRIMARY KEY, spec TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS schemas (id TEXT PRIMARY KEY, fields TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS rollups (
+    hash TEXT NOT NULL,
+    tier TEXT NOT NULL,
+    bucket REAL NOT NULL,
+    state BLOB NOT NULL,
+    PRIMARY KEY (hash, tier, bucket)
+) WITHOUT ROWID;
+"""
+
+COLUMNS = {"relative": "time", "absolute": "timestamp"}
+
+
+class SQLiteDatabaseConnection(RedisDatabaseZSetsConnection):
+    """
+        Keeps every event, single value, retention policy, codec and rollup inside of one sqlite file.
+
+        Only the storage primitives are replaced. The public query methods are the redis connection's own,
+        so both backends decode and shape events the same way. The layout, write mode and read mode are accepted and ignored.
+
+        Each thread gets its own sqlite connection. Writes from this process are serialized by a lock,
+        and `general_lock` only locks threads of this process.
+    """
+
+    def __init__(self, path: str = "jamboree.db") -> None:
+        super().__init__()
+        self.path = path
+        self._local = threading.local()
+        self._write_lock = threading.RLock()
+        self._locks: Dict[str, threading.Lock] = {}
+        self._opened: List[sqlite3.Connection] = []
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        """ The sqlite connection of the current thread. The schema is created on the first one. """
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+            with self._write_lock:
+                self._opened.append(conn)
+        return conn
+
+    def close(self):
+        """ Close the connection of every thread. """
+        with self._write_lock:
+            for conn in self._opened:
+                conn.close()
+            self._opened = []
+        self._local = threading.local()
+
+    @contextmanager
+    def transaction(self):
+        """ Run writes inside of one immediate transaction. Nested calls join the outer one. """
+        with self._write_lock:
+            if getattr(self._local, "depth", 0) > 0:
+                self._local.depth += 1
+                try:
+                    yield self.db
+                finally:
+                    self._local.depth -= 1
+                return
+            conn = self.db
+            conn.execute("BEGIN IMMEDIATE")
+            self._local.depth = 1
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            else:
+                conn.execute("COMMIT")
+            finally:
+                self._local.depth = 0
+
+    def batch_scope(self):
+        """ Batches run inside of one transaction. """
+        return self.transaction()
+
+    def remember_key(self, _hash: str, query: dict):
+        """ Keep the query of every key so `compact` can find its policy. """
+        if _hash in self._remembered:
+            return
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO logs (hash, query) VALUES (?, ?)",
+                (_hash, ujson.dumps(query, sort_keys=True)),
+            )
+            conn.execute(
+                "UPDATE logs SET query = ? WHERE hash = ? AND query IS NULL",
+                (ujson.dumps(query, sort_keys=True), _hash),
+            )
+        self._remembered.add(_hash)
+
+    """
+        # Individual Access Methods
+    """
+
+    def _kill(self, _hash: str):
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM singles WHERE hash = ?", (_hash,))
+
+    def _add(self, _hash: str, data: dict, is_serialized=True):
+        if is_serialized:
+            data = orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY)
+        elif isinstance(data, str):
+            data = data.encode("utf-8")
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO singles (hash, value) VALUES (?, ?)", (_hash, data)
+            )
+
+    def _get(self, _hash: str):
+        row = self.db.execute("SELECT value FROM singles WHERE hash = ?", (_hash,)).fetchone()
+        return None if row is None else row[0]
+
+    """
+        # Save Commands
+    """
+
+    def _append(
+        self,
+        _hash: str,
+        events: List[Tuple[bytes, float, float]],
+        policy: RetentionPolicy = NO_RETENTION,
+    ) -> int:
+        """ Appends (member, relative time, absolute time) events and applies the retention policy in one transaction. """
+        now = maya.now()._epoch
+        rows = [
+            (_hash, float(_time), self.member_id(member), float(_timestamp), member)
+            for member, _time, _timestamp in events
+        ]
+        with self.transaction() as conn:
+            added = conn.executemany(
+                "INSERT OR IGNORE INTO events (hash, time, id, timestamp, member) VALUES (?, ?, ?, ?, ?)",
+                rows,
+            ).rowcount
+            if added < len(rows):
+                # Some of the events were already stored. Move them to their new times, like a ZADD would.
+                conn.executemany(
+                    "UPDATE events SET time = ?, timestamp = ? WHERE hash = ? AND id = ?",
+                    [(_time, _timestamp, _hash, _id) for _, _time, _id, _timestamp, _ in rows],
+                )
+            conn.execute("INSERT OR IGNORE INTO logs (hash) VALUES (?)", (_hash,))
+            conn.execute(
+                "UPDATE logs SET count = count + ?, last_write = ? WHERE hash = ?",
+                (added, now, _hash),
+            )
+            self._count_trimmed(self._trim(_hash, policy, now))
+        return added
+
+    def _save(self, _hash: str, data: dict, timing: dict, policy: RetentionPolicy = NO_RETENTION):
+        serialized = self.key_codec(_hash).encode(data)
+        self._append(_hash, [(serialized, timing["time"], timing["timestamp"])], policy)
+
+    def _save_many(
+        self,
+        _hash: str,
+        relative_data: Dict[bytes, float] = {},
+        policy: RetentionPolicy = NO_RETENTION,
+    ):
+        timestamp = maya.now()._epoch
+        self._append(
+            _hash,
+            [(member, _time, timestamp) for member, _time in relative_data.items()],
+            policy,
+        )
+
+    """
+        # Delete Commands
+    """
+
+    def _removed(self, conn: sqlite3.Connection, _hash: str, removed: int, now: float):
+        """ Take removed events off of the count of a key. """
+        if removed > 0:
+            conn.execute(
+                "UPDATE logs SET count = MAX(count - ?, 0), last_write = ? WHERE hash = ?",
+                (removed, now, _hash),
+            )
+
+    def _delete(self, _hash: str, details: dict):
+        deletion_key = self.key_codec(_hash).encode(details)
+        _id = self.member_id(deletion_key)
+        with self.transaction() as conn:
+            row = conn.execute("SELECT time FROM events WHERE hash = ? AND id = ?", (_hash, _id)).fetchone()
+            if row is None:
+                return
+            conn.execute("DELETE FROM events WHERE hash = ? AND id = ?", (_hash, _id))
+            self._removed(conn, _hash, 1, maya.now()._epoch)
+            self.refresh_rollups(_hash, row[0], row[0])
+
+    def remove_members(self, _hash: str, members: List[bytes]) -> int:
+        with self.transaction() as conn:
+            removed = conn.executemany(
+                "DELETE FROM events WHERE hash = ? AND id = ?",
+                [(_hash, self.member_id(member)) for member in members],
+            ).rowcount
+            self._removed(conn, _hash, removed, maya.now()._epoch)
+        return removed
+
+    def _delete_all(self, _hash: str) -> int:
+        """ Drop the events and rollups of a hash. Returns how many of the two existed. """
+        with self.transaction() as conn:
+            removed = int(conn.execute("DELETE FROM events WHERE hash = ?", (_hash,)).rowcount > 0)
+            removed += int(conn.execute("DELETE FROM rollups WHERE hash = ?", (_hash,)).rowcount > 0)
+            conn.execute("DELETE FROM key_codecs WHERE hash = ?", (_hash,))
+            self._key_codecs.pop(_hash, None)
+            conn.execute(
+                "UPDATE logs SET count = 0, rollup = 0, last_write = ? WHERE hash = ?",
+                (maya.now()._epoch, _hash),
+            )
+        return removed
+
+    def delete_all_many(self, queries: List[dict]) -> int:
+        """ Delete every event of many queries in one transaction. Returns the number of event logs and rollups removed. """
+        removed = 0
+        with self.transaction():
+            for query in queries:
+                if not self.helpers.validate_query(query):
+                    continue
+                removed += self._delete_all(self.helpers.generate_hash(query))
+        return removed
+
+    """
+        # Query Commands
+        ---
+        The primitives behind every inherited `query_*` method.
+    """
+
+    def _range(self, column: str, min_epoch, max_epoch) -> Tuple[str, list]:
+        """ The where clause of a score range. """
+        low, low_open = score_bound(min_epoch)
+        high, high_open = score_bound(max_epoch)
+        clause = f"hash = ? AND {column} {'>' if low_open else '>='} ? AND {column} {'<' if high_open else '<='} ?"
+        return clause, [low, high]
+
+    def _by_rank(self, _hash: str, abs_rel: str, start: int, end: int):
+        column = COLUMNS[abs_rel]
+        if start < 0 and end < 0:
+            # Read from the newest end, so the latest event never scans the whole key
+            if start > end:
+                return []
+            rows = self.db.execute(
+                f"SELECT member, {column} FROM events WHERE hash = ? ORDER BY {column} DESC, id DESC LIMIT ? OFFSET ?",
+                (_hash, end - start + 1, -end - 1),
+            ).fetchall()
+            return rows[::-1]
+        if start < 0 or end < 0:
+            size = self.count(_hash)
+            start = max(size + start, 0) if start < 0 else start
+            end = size + end if end < 0 else end
+        if start > end:
+            return []
+        return self.db.execute(
+            f"SELECT member, {column} FROM events WHERE hash = ? ORDER BY {column}, id LIMIT ? OFFSET ?",
+            (_hash, end - start + 1, start),
+        ).fetchall()
+
+    def _by_score(
+        self,
+        _hash: str,
+        abs_rel: str,
+        min_epoch,
+        max_epoch,
+        start: Optional[int] = None,
+        num: Optional[int] = None,
+    ):
+        column = COLUMNS[abs_rel]
+        clause, bounds = self._range(column, min_epoch, max_epoch)
+        limit = -1 if num is None or num < 0 else num
+        return self.db.execute(
+            f"SELECT member, {column} FROM events WHERE {clause} ORDER BY {column}, id LIMIT ? OFFSET ?",
+            [_hash] + bounds + [limit, start or 0],
+        ).fetchall()
+
+    def _all(self, _hash: str):
+        return self._by_rank(_hash, "absolute", 0, -1), self._by_rank(_hash, "relative", 0, -1)
+
+    def _by_score_many(self, ranges: List[Tuple[str, float, float]], abs_rel: str) -> List[List[Tuple[bytes, float]]]:
+        return [self._by_score(_hash, abs_rel, _min, _max) for _hash, _min, _max in ranges]
+
+    def _pages(
+        self, _hash: str, abs_rel: str, min_epoch, max_epoch, chunk_size: int
+    ) -> Iterator[List[Tuple[bytes, float, float]]]:
+        """ Page through a score range with a (score, id) cursor. Yields lists of (member, score, other score). """
+        column = COLUMNS[abs_rel]
+        other = COLUMNS["relative" if abs_rel == "absolute" else "absolute"]
+        clause, bounds = self._range(column, min_epoch, max_epoch)
+        cursor = ""
+        while True:
+            rows = self.db.execute(
+                f"SELECT member, {column}, {other}, id FROM events WHERE {clause} {cursor} "
+                f"ORDER BY {column}, id LIMIT ?",
+                [_hash] + bounds + [chunk_size],
+            ).fetchall()
+            if len(rows) == 0:
+                return
+            yield [(member, score, other_score) for member, score, other_score, _ in rows]
+            if len(rows) < chunk_size:
+                return
+            last_score, last_id = rows[-1][1], rows[-1][3]
+            cursor = f"AND ({column}, id) > (?, ?)"
+            bounds = bounds[:2] + [last_score, last_id]
+
+    def count(self, _hash: str, pipe=None) -> int:
+        row = self.db.execute("SELECT count FROM logs WHERE hash = ?", (_hash,)).fetchone()
+        return 0 if row is None else int(row[0])
+
+    def general_lock(self, query: dict):
+        """ A lock per query. It's only shared by threads of this process. """
+        _hash = self.helpers.generate_hash(query)
+        with self._write_lock:
+            if _hash not in self._locks:
+                self._locks[_hash] = threading.Lock()
+            return self._locks[_hash]
+
+    """
+        # Retention
+        ---
+        Policies live in the database file, so every process using it applies the same ones.
+    """
+
+    def load_retention(self):
+        policies = {}
+        for entity, raw in self.db.execute("SELECT entity, policy FROM retention").fetchall():
+            policies[entity] = RetentionPolicy.from_dict(orjson.loads(raw))
+        self._retention = policies
+
+    def set_retention(
+        self, entity: str, max_len: int = 0, max_age: float = 0.0, age_by: str = "relative"
+    ) -> RetentionPolicy:
+        policy = RetentionPolicy(max_len=max_len, max_age=max_age, age_by=age_by)
+        with self.transaction() as conn:
+            if policy.is_empty:
+                conn.execute("DELETE FROM retention WHERE entity = ?", (entity,))
+                self.retention.pop(entity, None)
+                return policy
+            conn.execute(
+                "INSERT OR REPLACE INTO retention (entity, policy) VALUES (?, ?)",
+                (entity, orjson.dumps(policy.to_dict()).decode("utf-8")),
+            )
+        self.retention[entity] = policy
+        return policy
+
+    """
+        # Codecs
+        ---
+        Entity codecs, the codec of every key and struct schemas live in the database file too.
+    """
+
+    def _codec_specs(self) -> Dict[str, dict]:
+        return {entity: orjson.loads(raw) for entity, raw in self.db.execute("SELECT entity, spec FROM codecs").fetchall()}
+
+    def _put_codec_spec(self, entity: str, spec: Optional[dict]):
+        with self.transaction() as conn:
+            if spec is None:
+                conn.execute("DELETE FROM codecs WHERE entity = ?", (entity,))
+                return
+            conn.execute(
+                "INSERT OR REPLACE INTO codecs (entity, spec) VALUES (?, ?)",
+                (entity, orjson.dumps(spec).decode("utf-8")),
+            )
+
+    def _record_codec(self, _hash: str, spec: Optional[dict]) -> Optional[dict]:
+        with self.transaction() as conn:
+            if spec is not None:
+                conn.execute(
+                    "INSERT OR IGNORE INTO key_codecs (hash, spec) VALUES (?, ?)",
+                    (_hash, orjson.dumps(spec).decode("utf-8")),
+                )
+            row = conn.execute("SELECT spec FROM key_codecs WHERE hash = ?", (_hash,)).fetchone()
+        return None if row is None else orjson.loads(row[0])
+
+    def _put_schema(self, schema):
+        with self.transaction() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO schemas (id, fields) VALUES (?, ?)",
+                (schema.hex, orjson.dumps(schema.to_dict()).decode("utf-8")),
+            )
+
+    def _schema(self, schema_id: str) -> Optional[dict]:
+        row = self.db.execute("SELECT fields FROM schemas WHERE id = ?", (schema_id,)).fetchone()
+        return None if row is None else orjson.loads(row[0])
+
+    def _trim(self, _hash: str, policy: RetentionPolicy, now: float) -> int:
+        """ 
+            The same trim as the lua scripts. Call it inside of a transaction. Returns the number of events removed.
+            The rollups over the relative times removed are recomputed.
+        """
+        if policy.is_empty:
+            return 0
+        conn = self.db
+        trimmed = 0
+        spans = []
+        if policy.max_age > 0:
+            column, cutoff = "timestamp", now - policy.max_age
+            if policy.age_by == "relative":
+                newest = self._by_rank(_hash, "relative", -1, -1)
+                column, cutoff = "time", (newest[0][1] - policy.max_age if len(newest) > 0 else None)
+            if cutoff is not None:
+                where = f"hash = ? AND {column} < ?"
+                spans.append(conn.execute(f"SELECT MIN(time), MAX(time) FROM events WHERE {where}", (_hash, cutoff)).fetchone())
+                trimmed += conn.execute(f"DELETE FROM events WHERE {where}", (_hash, cutoff)).rowcount
+                self._removed(conn, _hash, trimmed, now)
+        if policy.max_len > 0:
+            extra = self.count(_hash) - policy.max_len
+            if extra > 0:
+                oldest = "SELECT id FROM events WHERE hash = ? ORDER BY time, id LIMIT ?"
+                spans.append(conn.execute(
+                    f"SELECT MIN(time), MAX(time) FROM events WHERE hash = ? AND id IN ({oldest})",
+                    (_hash, _hash, extra),
+                ).fetchone())
+                removed = conn.execute(
+                    f"DELETE FROM events WHERE hash = ? AND id IN ({oldest})",
+                    (_hash, _hash, extra),
+                ).rowcount
+                self._removed(conn, _hash, removed, now)
+                trimmed += removed
+        spans = [span for span in spans if span[0] is not None]
+        if len(spans) > 0:
+            self.refresh_rollups(_hash, min(low for low, _ in spans), max(high for _, high in spans))
+        return trimmed
+
+    def _retain(self, _hash: str, policy: RetentionPolicy, client=None) -> int:
+        with self.transaction():
+            return self._trim(_hash, policy, maya.now()._epoch)
+
+    def event_hashes(self) -> Iterator[str]:
+        return iter([row[0] for row in self.db.execute("SELECT hash FROM logs WHERE count > 0").fetchall()])
+
+    def compact(self) -> int:
+        self.load_retention()
+        self.metrics.incr("retention.compactions")
+        if len(self.retention) == 0:
+            return 0
+        total = 0
+        for _hash, raw in self.db.execute(
+            "SELECT hash, query FROM logs WHERE count > 0 AND query IS NOT NULL"
+        ).fetchall():
+            policy = self.retention_for(ujson.loads(raw))
+            if policy.is_empty:
+                continue
+            trimmed = self._retain(_hash, policy)
+            self._count_trimmed(trimmed)
+            total += trimmed
+        return total
+
+    """
+        # Stats
+    """
+
+    def stats(self, _hash: str) -> dict:
+        row = self.db.execute(
+            """
+            SELECT count, last_write,
+                (SELECT time FROM events WHERE hash = logs.hash ORDER BY time LIMIT 1),
+                (SELECT time FROM events WHERE hash = logs.hash ORDER BY time DESC LIMIT 1),
+                (SELECT timestamp FROM events WHERE hash = logs.hash ORDER BY timestamp LIMIT 1),
+                (SELECT timestamp FROM events WHERE hash = logs.hash ORDER BY timestamp DESC LIMIT 1)
+            FROM logs WHERE hash = ?
+            """,
+            (_hash,),
+        ).fetchone()
+        if row is None or row[0] == 0:
+            return {}
+        count, last_write, min_time, max_time, min_timestamp, max_timestamp = row
+        return {
+            "count": int(count),
+            "min_time": min_time,
+            "max_time": max_time,
+            "min_timestamp": min_timestamp,
+            "max_timestamp": max_timestamp,
+            "last_write": last_write,
+        }
+
+    """
+        # Rollups
+        ---
+        Only the storage of the tiers is replaced. `logs.rollup` marks the keys that have been built.
+    """
+
+    def _rollup_states(self, _hash: str, reads: List[Tuple[str, float, float]]) -> List[List[dict]]:
+        states = []
+        for tier, start, end in reads:
+            rows = self.db.execute(
+                "SELECT state FROM rollups WHERE hash = ? AND tier = ? AND bucket >= ? AND bucket < ? ORDER BY bucket",
+                (_hash, tier, start, end),
+            ).fetchall()
+            states.append([orjson.loads(row[0]) for row in rows])
+        return states
+
+    def _write_tier(self, _hash: str, tier: str, start: float, end: float, buckets: Dict[float, dict]):
+        with self.transaction() as conn:
+            conn.execute(
+                "DELETE FROM rollups WHERE hash = ? AND tier = ? AND bucket >= ? AND bucket < ?",
+                (_hash, tier, start, end),
+            )
+            conn.executemany(
+                "INSERT INTO rollups (hash, tier, bucket, state) VALUES (?, ?, ?, ?)",
+                [(_hash, tier, bucket, orjson.dumps(state)) for bucket, state in buckets.items()],
+            )
+
+    def _has_rollups(self, _hash: str) -> bool:
+        row = self.db.execute("SELECT rollup FROM logs WHERE hash = ?", (_hash,)).fetchone()
+        return row is not None and bool(row[0])
+
+    def _mark_rollups(self, _hash: str):
+        with self.transaction() as conn:
+            conn.execute("UPDATE logs SET rollup = 1 WHERE hash = ?", (_hash,))
+
+    def _drop_rollups(self, _hash: str):
+        with self.transaction() as conn:
+            conn.execute("DELETE FROM rollups WHERE hash = ?", (_hash,))
+            conn.execute("UPDATE logs SET rollup = 0 WHERE hash = ?", (_hash,))
+
+    def _rollup_scope(self, _hash: str):
+        """ The tiers of a hash are recomputed inside of one transaction. """
+        return self.transaction()
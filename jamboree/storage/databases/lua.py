@@ -0,0 +1,348 @@
+"""
+    # Lua Scripts
+    ---
+    Server-side scripts for the redis database connections.
+
+    Redis runs each script atomically, so none of these need a lock around them.
+    Register them with `register_script` so they're called through EVALSHA.
+"""
+
+
+"""
+    Shared function that rewrites the stats hash of a key from its time zsets.
+    Every bound is an O(log n) lookup, so it's cheap to run inside of each write and delete.
+    The stats hash is removed once the key is empty.
+
+    Fields: count, min_time, max_time, min_timestamp, max_timestamp, last_write
+"""
+REFRESH_STATS = """
+local function refresh_stats(relative, absolute, stats, now)
+    local count = redis.call('ZCARD', relative)
+    if count == 0 then
+        redis.call('DEL', stats)
+        return
+    end
+    local first = redis.call('ZRANGE', relative, 0, 0, 'WITHSCORES')
+    local last = redis.call('ZREVRANGE', relative, 0, 0, 'WITHSCORES')
+    local afirst = redis.call('ZRANGE', absolute, 0, 0, 'WITHSCORES')
+    local alast = redis.call('ZREVRANGE', absolute, 0, 0, 'WITHSCORES')
+    redis.call('HMSET', stats,
+        'count', count,
+        'min_time', first[2], 'max_time', last[2],
+        'min_timestamp', afirst[2] or first[2], 'max_timestamp', alast[2] or last[2],
+        'last_write', now)
+end
+"""
+
+
+"""
+    Shared functions that enforce a retention policy on a key.
+
+    * max_len - keep only the newest `max_len` events by relative time (0 turns it off).
+    * max_age - drop events older than `max_age` seconds (0 turns it off).
+      With `age_by` relative the age is measured from the newest relative time, otherwise from `now`.
+
+    `payloads` is the payload hash in the single copy layout and false in the dual layout.
+    Returns the number of events removed. `trimmed_span` then gives the lowest and highest relative time removed
+    (as strings, so no precision is lost) or false for both, so the rollups over them can be recomputed.
+"""
+TRIM = """
+local unpack = unpack or table.unpack
+local low, high
+
+local function remove_members(relative, absolute, payloads, members)
+    for _, member in ipairs(members) do
+        local score = tonumber(redis.call('ZSCORE', relative, member))
+        if score then
+            if low == nil or score < low then low = score end
+            if high == nil or score > high then high = score end
+        end
+    end
+    for i = 1, #members, 1000 do
+        local part = {unpack(members, i, math.min(i + 999, #members))}
+        redis.call('ZREM', relative, unpack(part))
+        redis.call('ZREM', absolute, unpack(part))
+        if payloads then
+            redis.call('HDEL', payloads, unpack(part))
+        end
+    end
+    return #members
+end
+
+local function trim(relative, absolute, payloads, now, max_len, max_age, age_by)
+    local trimmed = 0
+    max_len = tonumber(max_len)
+    max_age = tonumber(max_age)
+    if max_age > 0 then
+        local by = absolute
+        local cutoff = tonumber(now) - max_age
+        if age_by == 'relative' then
+            by = relative
+            local newest = redis.call('ZREVRANGE', relative, 0, 0, 'WITHSCORES')
+            cutoff = nil
+            if #newest > 0 then
+                cutoff = tonumber(newest[2]) - max_age
+            end
+        end
+        if cutoff then
+            local old = redis.call('ZRANGEBYSCORE', by, '-inf', string.format('(%.17g', cutoff))
+            trimmed = trimmed + remove_members(relative, absolute, payloads, old)
+        end
+    end
+    if max_len > 0 then
+        local extra = redis.call('ZCARD', relative) - max_len
+        if extra > 0 then
+            local oldest = redis.call('ZRANGE', relative, 0, extra - 1)
+            trimmed = trimmed + remove_members(relative, absolute, payloads, oldest)
+        end
+    end
+    return trimmed
+end
+
+local function trimmed_span()
+    if low == nil then
+        return false, false
+    end
+    return string.format('%.17g', low), string.format('%.17g', high)
+end
+"""
+
+
+"""
+    Appends events to both the relative and absolute time zsets, then applies the retention policy.
+
+    KEYS[1] - relative time zset (`{hash}:rlist`)
+    KEYS[2] - absolute time zset (`{hash}:alist`)
+    KEYS[3] - stats hash (`{hash}:stats`)
+    ARGV[1] - the current epoch
+    ARGV[2] - max length, ARGV[3] - max age, ARGV[4] - age by (see TRIM)
+    ARGV    - then flat triples of (member, relative score, absolute score)
+
+    Returns the number of new members added to the relative zset, the number of events trimmed and the span trimmed (see TRIM).
+"""
+ZSET_APPEND = REFRESH_STATS + TRIM + """
+local added = 0
+for i = 5, #ARGV, 3 do
+    added = added + redis.call('ZADD', KEYS[1], ARGV[i + 1], ARGV[i])
+    redis.call('ZADD', KEYS[2], ARGV[i + 2], ARGV[i])
+end
+local trimmed = trim(KEYS[1], KEYS[2], false, ARGV[1], ARGV[2], ARGV[3], ARGV[4])
+refresh_stats(KEYS[1], KEYS[2], KEYS[3], ARGV[1])
+local low, high = trimmed_span()
+return {added, trimmed, low, high}
+"""
+
+
+"""
+    Appends events in the single copy layout, then applies the retention policy.
+
+    KEYS[1] - payload hash (`{hash}:payloads`)
+    KEYS[2] - relative time index (`{hash}:rindex`)
+    KEYS[3] - absolute time index (`{hash}:aindex`)
+    KEYS[4] - stats hash (`{hash}:stats`)
+    ARGV[1] - the current epoch
+    ARGV[2] - max length, ARGV[3] - max age, ARGV[4] - age by (see TRIM)
+    ARGV    - then flat quads of (member id, payload, relative score, absolute score)
+
+    Returns the number of new ids added to the relative index, the number of events trimmed and the span trimmed (see TRIM).
+"""
+SINGLE_APPEND = REFRESH_STATS + TRIM + """
+local added = 0
+for i = 5, #ARGV, 4 do
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+    added = added + redis.call('ZADD', KEYS[2], ARGV[i + 2], ARGV[i])
+    redis.call('ZADD', KEYS[3], ARGV[i + 3], ARGV[i])
+end
+local trimmed = trim(KEYS[2], KEYS[3], KEYS[1], ARGV[1], ARGV[2], ARGV[3], ARGV[4])
+refresh_stats(KEYS[2], KEYS[3], KEYS[4], ARGV[1])
+local low, high = trimmed_span()
+return {added, trimmed, low, high}
+"""
+
+
+"""
+    Applies a retention policy to a key and rewrites its stats. Used after lock mode writes and by the compactor.
+
+    KEYS[1] - relative time zset or index
+    KEYS[2] - absolute time zset or index
+    KEYS[3] - stats hash
+    KEYS[4] - payload hash (single copy layout only)
+    ARGV[1] - the current epoch
+    ARGV[2] - max length, ARGV[3] - max age, ARGV[4] - age by (see TRIM)
+
+    Returns the number of events trimmed and the span trimmed (see TRIM).
+"""
+RETAIN = REFRESH_STATS + TRIM + """
+local payloads = KEYS[4] or false
+local trimmed = trim(KEYS[1], KEYS[2], payloads, ARGV[1], ARGV[2], ARGV[3], ARGV[4])
+refresh_stats(KEYS[1], KEYS[2], KEYS[3], ARGV[1])
+local low, high = trimmed_span()
+return {trimmed, low, high}
+"""
+
+
+"""
+    Rewrites the stats hash of a key. Used after lock mode writes and deletes, and to backfill keys written before stats existed.
+
+    KEYS[1] - relative time zset or index
+    KEYS[2] - absolute time zset or index
+    KEYS[3] - stats hash
+    ARGV[1] - the current epoch
+
+    Returns the stats hash as flat field/value pairs. Empty if the key has no events.
+"""
+STATS = REFRESH_STATS + """
+refresh_stats(KEYS[1], KEYS[2], KEYS[3], ARGV[1])
+return redis.call('HGETALL', KEYS[3])
+"""
+
+
+"""
+    Reads a rank range from a single copy index and resolves the payloads.
+
+    KEYS[1] - time index
+    KEYS[2] - payload hash
+    ARGV    - start, stop
+
+    Returns flat pairs of (payload, score).
+"""
+SINGLE_RANGE_BY_RANK = """
+local ids = redis.call('ZRANGE', KEYS[1], ARGV[1], ARGV[2], 'WITHSCORES')
+local result = {}
+for i = 1, #ids, 2 do
+    result[#result + 1] = redis.call('HGET', KEYS[2], ids[i])
+    result[#result + 1] = ids[i + 1]
+end
+return result
+"""
+
+
+"""
+    Reads a score range from a single copy index and resolves the payloads.
+
+    KEYS[1] - time index
+    KEYS[2] - payload hash
+    ARGV    - min, max, offset, count (a negative count reads everything)
+
+    Returns flat pairs of (payload, score).
+"""
+SINGLE_RANGE_BY_SCORE = """
+local ids
+if tonumber(ARGV[4]) < 0 then
+    ids = redis.call('ZRANGEBYSCORE', KEYS[1], ARGV[1], ARGV[2], 'WITHSCORES')
+else
+    ids = redis.call('ZRANGEBYSCORE', KEYS[1], ARGV[1], ARGV[2], 'WITHSCORES', 'LIMIT', ARGV[3], ARGV[4])
+end
+local result = {}
+for i = 1, #ids, 2 do
+    result[#result + 1] = redis.call('HGET', KEYS[2], ids[i])
+    result[#result + 1] = ids[i + 1]
+end
+return result
+"""
+
+
+"""
+    Reads every event in the single copy layout with both of its scores.
+
+    KEYS[1] - relative time index
+    KEYS[2] - absolute time index
+    KEYS[3] - payload hash
+
+    Returns flat triples of (payload, relative score, absolute score) in relative order.
+"""
+SINGLE_ALL = """
+local ids = redis.call('ZRANGE', KEYS[1], 0, -1, 'WITHSCORES')
+local result = {}
+for i = 1, #ids, 2 do
+    result[#result + 1] = redis.call('HGET', KEYS[3], ids[i])
+    result[#result + 1] = ids[i + 1]
+    result[#result + 1] = redis.call('ZSCORE', KEYS[2], ids[i]) or ids[i + 1]
+end
+return result
+"""
+
+
+"""
+    Moves one batch of events from the dual layout into the single copy layout.
+
+    KEYS[1] - relative time zset (`{hash}:rlist`)
+    KEYS[2] - absolute time zset (`{hash}:alist`)
+    KEYS[3] - payload hash
+    KEYS[4] - relative time index
+    KEYS[5] - absolute time index
+    ARGV[1] - batch size
+
+    Returns the number of events moved. Call it until it returns 0.
+"""
+MIGRATE_TO_SINGLE = """
+local batch = tonumber(ARGV[1])
+local from_relative = true
+local members = redis.call('ZRANGE', KEYS[1], 0, batch - 1, 'WITHSCORES')
+if #members == 0 then
+    from_relative = false
+    members = redis.call('ZRANGE', KEYS[2], 0, batch - 1, 'WITHSCORES')
+end
+for i = 1, #members, 2 do
+    local member = members[i]
+    local id = string.sub(redis.sha1hex(member), 1, 16)
+    local relative
+    local absolute
+    if from_relative then
+        relative = members[i + 1]
+        absolute = redis.call('ZSCORE', KEYS[2], member) or relative
+    else
+        absolute = members[i + 1]
+        relative = redis.call('ZSCORE', KEYS[1], member) or absolute
+    end
+    redis.call('HSET', KEYS[3], id, member)
+    redis.call('ZADD', KEYS[4], relative, id)
+    redis.call('ZADD', KEYS[5], absolute, id)
+    redis.call('ZREM', KEYS[1], member)
+    redis.call('ZREM', KEYS[2], member)
+end
+return #members / 2
+"""
+
+
+"""
+    Reads one page of a score range along with the other score of each event.
+
+    KEYS[1] - time zset to page through
+    KEYS[2] - the other time zset
+    ARGV    - min, max, offset, count
+
+    Returns flat triples of (member, score, other score).
+"""
+PAGE_BY_SCORE = """
+local members = redis.call('ZRANGEBYSCORE', KEYS[1], ARGV[1], ARGV[2], 'WITHSCORES', 'LIMIT', ARGV[3], ARGV[4])
+local result = {}
+for i = 1, #members, 2 do
+    result[#result + 1] = members[i]
+    result[#result + 1] = members[i + 1]
+    result[#result + 1] = redis.call('ZSCORE', KEYS[2], members[i]) or members[i + 1]
+end
+return result
+"""
+
+
+"""
+    Reads one page of a score range in the single copy layout and resolves the payloads.
+
+    KEYS[1] - time index to page through
+    KEYS[2] - the other time index
+    KEYS[3] - payload hash
+    ARGV    - min, max, offset, count
+
+    Returns flat triples of (payload, score, other score).
+"""
+SINGLE_PAGE_BY_SCORE = """
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], ARGV[1], ARGV[2], 'WITHSCORES', 'LIMIT', ARGV[3], ARGV[4])
+local result = {}
+for i = 1, #ids, 2 do
+    result[#result + 1] = redis.call('HGET', KEYS[3], ids[i])
+    result[#result + 1] = ids[i + 1]
+    result[#result + 1] = redis.call('ZSCORE', KEYS[2], ids[i]) or ids[i + 1]
+end
+return result
+"""
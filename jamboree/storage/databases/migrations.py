@@ -0,0 +1,127 @@
+"""
+    # Storage Migrations
+    ---
+    Convert keys written by an older storage layout or key scheme in place.
+
+    Pause the writers for a key while it's migrated, then switch the connections over to the new layout.
+
+    ```
+        python -m jamboree.storage.databases.migrations --host localhost --port 6379
+        python -m jamboree.storage.databases.migrations --to digest
+    ```
+"""
+import argparse
+import base64
+import binascii
+
+import ujson
+from loguru import logger
+from redis import Redis
+
+from jamboree.storage.databases.jredis_zset import RedisDatabaseZSetsConnection
+from jamboree.utils.helper import KEY_LOOKUP, digest_key
+
+
+def migrate_hash_to_single(
+    conn: RedisDatabaseZSetsConnection, _hash: str, batch: int = 1000
+) -> int:
+    """ Move every event of a hash from the dual layout (`:rlist`/`:alist`) into the single copy layout. """
+    migrate = conn.script("MIGRATE_TO_SINGLE")
+    keys = [
+        f"{_hash}:rlist",
+        f"{_hash}:alist",
+        f"{_hash}:payloads",
+        f"{_hash}:rindex",
+        f"{_hash}:aindex",
+    ]
+    total = 0
+    while True:
+        moved = int(migrate(keys=keys, args=[batch], client=conn.connection))
+        if moved == 0:
+            break
+        total += moved
+    return total
+
+
+def migrate_to_single(
+    conn: RedisDatabaseZSetsConnection, query: dict, batch: int = 1000
+) -> int:
+    """ Migrate the events of a single query into the single copy layout. """
+    if not conn.helpers.validate_query(query):
+        return 0
+    _hash = conn.helpers.generate_hash(query)
+    return migrate_hash_to_single(conn, _hash, batch=batch)
+
+
+def migrate_all_to_single(
+    conn: RedisDatabaseZSetsConnection, batch: int = 1000
+) -> int:
+    """ Scan the database for dual layout keys and migrate all of them. Returns the number of events moved. """
+    hashes = set()
+    for suffix in [":rlist", ":alist"]:
+        for key in conn.connection.scan_iter(match=f"*{suffix}"):
+            key = key.decode("utf-8") if isinstance(key, bytes) else key
+            hashes.add(key[: -len(suffix)])
+
+    total = 0
+    for _hash in hashes:
+        moved = migrate_hash_to_single(conn, _hash, batch=batch)
+        logger.info(f"Moved {moved} events for {_hash}")
+        total += moved
+    return total
+
+
+def _query_json(prefix: str):
+    """ Get the query json behind a base64 key prefix. None if the prefix isn't one. """
+    try:
+        serialized = base64.b64decode(prefix, validate=True).decode("utf-8")
+        query = ujson.loads(serialized)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        return None
+    if not isinstance(query, dict):
+        return None
+    return serialized
+
+
+def migrate_keys_to_digest(connection: Redis, batch: int = 1000) -> int:
+    """
+        Rename every base64 keyed redis key (`{base64}:rlist`, `{base64}:single`, ...) to its digest key and record the lookup.
+        Keys that already exist under the digest name are left alone. Returns the number of keys renamed.
+
+        Pause the writers first, then start the processors with `KEY_SCHEME="digest"`.
+    """
+    renamed = 0
+    # base64 of a json object always starts with `ey` (an encoded `{"`)
+    keys = [key.decode("utf-8") if isinstance(key, bytes) else key for key in connection.scan_iter(match="ey*", count=batch)]
+    for i in range(0, len(keys), batch):
+        with connection.pipeline(transaction=False) as pipe:
+            for key in keys[i:i + batch]:
+                prefix, sep, rest = key.partition(":")
+                serialized = _query_json(prefix)
+                if serialized is None:
+                    continue
+                digest = digest_key(serialized)
+                pipe.renamenx(key, f"{digest}{sep}{rest}")
+                pipe.hsetnx(KEY_LOOKUP, digest, serialized)
+            replies = pipe.execute()
+        renamed += sum(1 for reply in replies[::2] if reply)
+    return renamed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migrate stored keys in place.")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=6379)
+    parser.add_argument("--batch", type=int, default=1000)
+    parser.add_argument("--to", choices=["single", "digest"], default="single", help="The single copy zset layout or digest keys")
+    args = parser.parse_args()
+
+    rconn = Redis(host=args.host, port=args.port)
+    if args.to == "digest":
+        renamed_total = migrate_keys_to_digest(rconn, batch=args.batch)
+        logger.success(f"Renamed {renamed_total} keys to digest keys")
+    else:
+        zconn = RedisDatabaseZSetsConnection()
+        zconn.connection = rconn
+        moved_total = migrate_all_to_single(zconn, batch=args.batch)
+        logger.success(f"Moved {moved_total} events into the single copy layout")
@@ -0,0 +1,99 @@
+"""
+    # Retention
+    ---
+    Per entity caps on how much of an event log redis keeps.
+
+    A policy is enforced inside of the same lua script (or lock mode pipeline) as each write.
+    Keys that stopped getting writes are handled by the `RetentionCompactor`, a background thread that sweeps every key with a policy.
+
+    ```
+        conn.set_retention("metric", max_len=10000)
+        conn.set_retention("timeindex", max_age=86400, age_by="absolute")
+    ```
+"""
+import threading
+from typing import Optional
+
+import orjson
+from loguru import logger
+
+# Redis hash of entity -> policy json. Shared by every process using the same database.
+RETENTION_KEY = "jamboree:retention"
+
+
+class RetentionPolicy(object):
+    """
+        * `max_len` - keep the newest `max_len` events by relative time. 0 keeps everything.
+        * `max_age` - drop events older than `max_age` seconds. 0 keeps everything.
+        * `age_by` - `relative` measures the age from the newest relative time, `absolute` from the current time.
+    """
+
+    def __init__(self, max_len: int = 0, max_age: float = 0.0, age_by: str = "relative"):
+        if age_by not in ["absolute", "relative"]:
+            raise ValueError("age_by must either be 'absolute' or 'relative'")
+        if max_len < 0 or max_age < 0:
+            raise ValueError("The max length and max age can't be negative")
+        self.max_len = int(max_len)
+        self.max_age = float(max_age)
+        self.age_by = age_by
+
+    @property
+    def is_empty(self) -> bool:
+        return self.max_len == 0 and self.max_age == 0
+
+    def args(self) -> list:
+        """ The policy as lua script arguments. """
+        return [self.max_len, self.max_age, self.age_by]
+
+    def to_dict(self) -> dict:
+        return {"max_len": self.max_len, "max_age": self.max_age, "age_by": self.age_by}
+
+    @classmethod
+    def from_dict(cls, item: dict) -> "RetentionPolicy":
+        return cls(
+            max_len=item.get("max_len", 0),
+            max_age=item.get("max_age", 0.0),
+            age_by=item.get("age_by", "relative"),
+        )
+
+    def __repr__(self) -> str:
+        return f"RetentionPolicy({orjson.dumps(self.to_dict()).decode('utf-8')})"
+
+
+NO_RETENTION = RetentionPolicy()
+
+
+class RetentionCompactor(object):
+    """ Calls `compact` on a connection every `interval` seconds inside of a daemon thread. """
+
+    def __init__(self, connection, interval: float = 60.0) -> None:
+        self.connection = connection
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def is_running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.is_running:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="jamboree-compactor", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.connection.compact()
+            except Exception as e:
+                logger.exception(e)
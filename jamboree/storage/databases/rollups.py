@@ -0,0 +1,200 @@
+"""
+    # Rollups
+    ---
+    Pre-aggregated tiers of an event log. Each tier is a zset of one state per bucket, scored by the bucket start.
+
+    A state keeps the sum, count, min, max, first and last value of every numeric column.
+    That's enough to rebuild a mean at any coarser rule exactly, and to build OHLCV bars
+    (open=first, high=max, low=min, close=last, volume=sum).
+
+    ```
+        {"time": 1577836800.0, "rows": 60, "columns": {"close": [sum, count, min, max, first, last], ...}}
+    ```
+"""
+import math
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from pandas.tseries.frequencies import to_offset
+
+# Finest to coarsest. Every width divides the next one and a day.
+TIERS: List[Tuple[str, int]] = [("1m", 60), ("1h", 3600), ("1d", 86400)]
+
+OHLCV = {
+    "open": "first",
+    "high": "max",
+    "low": "min",
+    "close": "last",
+    "volume": "sum",
+}
+
+# Positions inside of a column state
+SUM, COUNT, MIN, MAX, FIRST, LAST = range(6)
+
+
+def rule_seconds(rule: str) -> Optional[float]:
+    """ The width of a fixed resample rule in seconds. None for calendar rules (weeks, months, years). """
+    try:
+        return to_offset(rule).nanos / 1e9
+    except ValueError:
+        return None
+
+
+def tiers_for(rules: List[str]) -> List[Tuple[str, int]]:
+    """
+        Every tier that can be resampled into all of the given rules exactly, finest first.
+        A tier fits a fixed rule when its width divides the rule. Calendar rules start on a day, so any tier that divides a day fits them.
+    """
+    fitting = []
+    for tier, width in TIERS:
+        fits = True
+        for rule in rules:
+            seconds = rule_seconds(rule)
+            if seconds is None:
+                seconds = 86400
+            if seconds <= 0 or seconds % width != 0:
+                fits = False
+                break
+        if fits:
+            fitting.append((tier, width))
+    return fitting
+
+
+def bucket_of(epoch: float, width: int) -> float:
+    return float(math.floor(epoch / width) * width)
+
+
+def aggregate(frame: pd.DataFrame, width: int) -> Dict[float, dict]:
+    """ Build the bucket states of raw events. The frame needs a `time` column. Non numeric columns are skipped. """
+    if frame.empty or "time" not in frame.columns:
+        return {}
+    frame = frame.sort_values("time", kind="mergesort")
+    values = frame.drop(columns=["time", "timestamp"], errors="ignore")
+    values = values.select_dtypes(include=[np.number, "bool"]).astype(np.float64)
+    buckets = np.floor(frame["time"].to_numpy(dtype=np.float64) / width) * width
+
+    rows = pd.Series(buckets).value_counts()
+    grouped = values.groupby(buckets, sort=True)
+    parts = [
+        grouped.sum(),
+        grouped.count(),
+        grouped.min(),
+        grouped.max(),
+        grouped.first(),
+        grouped.last(),
+    ]
+
+    states = {}
+    for bucket in parts[0].index:
+        columns = {}
+        for column in values.columns:
+            count = int(parts[COUNT].at[bucket, column])
+            if count == 0:
+                continue
+            columns[column] = [
+                float(parts[SUM].at[bucket, column]),
+                count,
+                float(parts[MIN].at[bucket, column]),
+                float(parts[MAX].at[bucket, column]),
+                float(parts[FIRST].at[bucket, column]),
+                float(parts[LAST].at[bucket, column]),
+            ]
+        states[float(bucket)] = {
+            "time": float(bucket),
+            "rows": int(rows[bucket]),
+            "columns": columns,
+        }
+    return states
+
+
+def combine(states: List[dict], width: int) -> Dict[float, dict]:
+    """ Merge the states of a finer tier into the buckets of a coarser one. """
+    parents: Dict[float, dict] = {}
+    for state in sorted(states, key=lambda item: item["time"]):
+        bucket = bucket_of(state["time"], width)
+        parent = parents.get(bucket)
+        if parent is None:
+            parent = {"time": bucket, "rows": 0, "columns": {}}
+            parents[bucket] = parent
+        parent["rows"] += state["rows"]
+        for column, child in state["columns"].items():
+            current = parent["columns"].get(column)
+            if current is None:
+                parent["columns"][column] = list(child)
+                continue
+            current[SUM] += child[SUM]
+            current[COUNT] += child[COUNT]
+            current[MIN] = min(current[MIN], child[MIN])
+            current[MAX] = max(current[MAX], child[MAX])
+            current[LAST] = child[LAST]
+    return parents
+
+
+def plan(min_epoch: float, max_epoch: float, widths: List[int], closed: bool = True) -> List[tuple]:
+    """
+        Cover `[min_epoch, max_epoch]` with whole buckets of the coarsest width, then finer widths and raw events at the edges.
+
+        Returns `(width, start, end, closed)` segments in time order.
+        A width of None is a raw event read and `closed` says whether its end is inclusive.
+        Every other segment is the buckets starting inside of `[start, end)`.
+    """
+    if len(widths) == 0 or not (math.isfinite(min_epoch) and math.isfinite(max_epoch)):
+        if min_epoch < max_epoch or (closed and min_epoch == max_epoch):
+            return [(None, min_epoch, max_epoch, closed)]
+        return []
+    width = widths[-1]
+    start = math.ceil(min_epoch / width) * width
+    end = math.floor(max_epoch / width) * width
+    if start >= end:
+        return plan(min_epoch, max_epoch, widths[:-1], closed)
+    return (
+        plan(min_epoch, start, widths[:-1], False)
+        + [(width, float(start), float(end), False)]
+        + plan(end, max_epoch, widths[:-1], closed)
+    )
+
+
+def _field_frame(states: List[dict], columns: List[str], field: int, index) -> pd.DataFrame:
+    values = np.full((len(states), len(columns)), np.nan)
+    for i, state in enumerate(states):
+        for j, column in enumerate(columns):
+            current = state["columns"].get(column)
+            if current is not None:
+                values[i, j] = current[field]
+    return pd.DataFrame(values, index=index, columns=columns)
+
+
+def resample(states: List[dict], rule: str, how: str = "mean") -> pd.DataFrame:
+    """
+        Resample bucket states into a frame with a datetime index.
+
+        * `mean` - every column is its mean inside of the rule. Matches `frame.resample(rule).mean()` over the raw events.
+        * `ohlcv` - open, high, low, close and volume columns are aggregated as bars. Everything else is a mean.
+    """
+    if how not in ["mean", "ohlcv"]:
+        raise ValueError("how must either be 'mean' or 'ohlcv'")
+    if len(states) == 0:
+        return pd.DataFrame()
+    states = sorted(states, key=lambda item: item["time"])
+    columns = list(dict.fromkeys(column for state in states for column in state["columns"]))
+    # Named like the index `DataHandler` builds from the raw events
+    index = pd.DatetimeIndex(pd.to_datetime([state["time"] for state in states], unit="s"), name="time")
+
+    sums = _field_frame(states, columns, SUM, index).resample(rule).sum()
+    counts = _field_frame(states, columns, COUNT, index).resample(rule).sum()
+    frame = sums / counts.replace(0, np.nan)
+    if how == "mean":
+        return frame
+
+    for column in columns:
+        kind = OHLCV.get(column)
+        if kind is None:
+            continue
+        if kind == "sum":
+            frame[column] = sums[column]
+            continue
+        field = {"first": FIRST, "last": LAST, "min": MIN, "max": MAX}[kind]
+        series = _field_frame(states, [column], field, index)[column].resample(rule)
+        frame[column] = getattr(series, kind)()
+    return frame
@@ -1 +1,3 @@
-from .caches import memoized_method, omit
\ No newline at end of file
+from .caches import memoized_method, omit
+from .metrics import Metrics
+from .executor import Executor, shared_executor
\ No newline at end of file
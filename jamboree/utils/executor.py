@@ -0,0 +1,172 @@
+"""
+    # Executor
+    ---
+    A bounded thread pool for background work, shared by every processor, connection and handler of a process.
+
+    No thread starts until the first task is submitted. At most `max_workers` tasks run at once and at most `max_queue` more wait.
+    Submitting past that blocks the caller until a task finishes, so a burst can't queue without bound.
+    `submit_nowait` raises `queue.Full` instead, for callers that must not block (an event loop).
+    Coroutines await `arun`, which waits on the loop while the queue is full.
+    A forked child gets a fresh pool on its first submit.
+
+    ```
+        future = jam.executor.submit(handler.many, 100)
+        jam.executor.stats()
+    ```
+
+    Recorded on `metrics`:
+
+    * `executor.queued` - gauge of the tasks waiting for a worker.
+    * `executor.running` - gauge of the tasks running.
+    * `executor.wait` - timing from submit to start.
+    * `executor.run` - timing of each task.
+    * `executor.failed` - the tasks that raised.
+    * `executor.full` - the `submit_nowait` calls turned away by a full queue.
+"""
+import asyncio
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Executor as BaseExecutor
+from concurrent.futures import Future, ThreadPoolExecutor
+from multiprocessing import cpu_count
+from typing import Callable, Optional, Tuple
+
+from jamboree.utils.metrics import Metrics
+
+
+class Executor(BaseExecutor):
+    def __init__(self, max_workers: Optional[int] = None, max_queue: Optional[int] = None) -> None:
+        self.max_workers = max_workers or min(32, cpu_count() + 4)
+        self.max_queue = self.max_workers * 16 if max_queue is None else max_queue
+        self.metrics = Metrics()
+        self._lock = threading.Lock()
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._slots: Optional[threading.BoundedSemaphore] = None
+        self._pid: Optional[int] = None
+        self._queued = 0
+        self._running = 0
+
+    @property
+    def is_started(self) -> bool:
+        return self._pool is not None and self._pid == os.getpid()
+
+    def configure(self, max_workers: Optional[int] = None, max_queue: Optional[int] = None):
+        """ Resize the pool. Only before it starts. """
+        max_workers = self.max_workers if max_workers is None else int(max_workers)
+        max_queue = self.max_queue if max_queue is None else int(max_queue)
+        with self._lock:
+            if (max_workers, max_queue) == (self.max_workers, self.max_queue):
+                return
+            if self.is_started:
+                raise ValueError("The executor already started. Configure it before submitting work.")
+            self.max_workers = max_workers
+            self.max_queue = max_queue
+
+    def _start(self) -> Tuple[ThreadPoolExecutor, threading.BoundedSemaphore]:
+        with self._lock:
+            if not self.is_started:
+                self._pool = ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix="jamboree"
+                )
+                self._slots = threading.BoundedSemaphore(self.max_workers + self.max_queue)
+                self._pid = os.getpid()
+                self._queued = 0
+                self._running = 0
+            return self._pool, self._slots
+
+    def _track(self, queued: int, running: int):
+        with self._lock:
+            self._queued += queued
+            self._running += running
+            self.metrics.gauge("executor.queued", self._queued)
+            self.metrics.gauge("executor.running", self._running)
+
+    def _run(self, slots: threading.BoundedSemaphore, submitted: float, fn: Callable, args, kwargs):
+        started = time.perf_counter()
+        self.metrics.timing("executor.wait", started - submitted)
+        self._track(-1, 1)
+        try:
+            return fn(*args, **kwargs)
+        except BaseException:
+            self.metrics.incr("executor.failed")
+            raise
+        finally:
+            self.metrics.timing("executor.run", time.perf_counter() - started)
+            self._track(0, -1)
+            slots.release()
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        """ Run `fn(*args, **kwargs)` on the pool. Blocks while the queue is full. """
+        pool, slots = self._start()
+        slots.acquire()
+        return self._submit(pool, slots, fn, args, kwargs)
+
+    def submit_nowait(self, fn: Callable, *args, **kwargs) -> Future:
+        """ `submit` that raises `queue.Full` instead of blocking while the queue is full. """
+        pool, slots = self._start()
+        if not slots.acquire(blocking=False):
+            self.metrics.incr("executor.full")
+            raise queue.Full("The executor queue is full")
+        return self._submit(pool, slots, fn, args, kwargs)
+
+    async def arun(self, fn: Callable, *args, **kwargs):
+        """ Await `fn(*args, **kwargs)` on the pool. While the queue is full the coroutine sleeps on the loop, so the loop keeps running. """
+        delay = 0.001
+        while True:
+            try:
+                future = self.submit_nowait(fn, *args, **kwargs)
+                break
+            except queue.Full:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 0.05)
+        return await asyncio.wrap_future(future, loop=asyncio.get_running_loop())
+
+    def _submit(self, pool: ThreadPoolExecutor, slots: threading.BoundedSemaphore, fn: Callable, args, kwargs) -> Future:
+        self._track(1, 0)
+        try:
+            return pool.submit(self._run, slots, time.perf_counter(), fn, args, kwargs)
+        except BaseException:
+            self._track(-1, 0)
+            slots.release()
+            raise
+
+    def schedule(self, function: Callable, args=(), kwargs={}) -> Future:
+        """ `submit` with the signature of `pebble.ThreadPool.schedule`. """
+        return self.submit(function, *args, **kwargs)
+
+    @property
+    def queue_depth(self) -> int:
+        """ The tasks waiting for a worker. """
+        return self._queued
+
+    def stats(self) -> dict:
+        return {
+            "max_workers": self.max_workers,
+            "max_queue": self.max_queue,
+            "queued": self._queued,
+            "running": self._running,
+            "started": self.is_started,
+        }
+
+    def shutdown(self, wait: bool = True):
+        """ Stop the pool. The next submit starts a new one. """
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=wait)
+
+
+_shared: Optional[Executor] = None
+_shared_lock = threading.Lock()
+
+
+def shared_executor() -> Executor:
+    """ The executor of this process. Creating it starts no threads. """
+    global _shared
+    if _shared is None:
+        with _shared_lock:
+            if _shared is None:
+                _shared = Executor()
+    return _shared
@@ -2,30 +2,147 @@
     A class that holds all of the helper functions.
 """
 import base64
+import hashlib
 import uuid
 from abc import ABC
 from copy import copy
-from typing import Any, Dict, List, Set
+from functools import lru_cache
+from typing import Any, Dict, List, Set, Tuple
 
 import maya
 import orjson
 import pandas as pd
 import ujson
 
+from jamboree.utils.support.events.cereal import single_one
+
+
+# Redis hash of digest key -> the query json it came from. Lets us turn digest keys back into queries.
+KEY_LOOKUP = "jamboree:keys"
+KEY_MEMO_SIZE = 8192
+
+
+@lru_cache(maxsize=KEY_MEMO_SIZE)
+def base64_key(serialized: str) -> str:
+    return base64.b64encode(str.encode(serialized)).decode("utf-8")
+
+
+@lru_cache(maxsize=KEY_MEMO_SIZE)
+def digest_key(serialized: str) -> str:
+    return hashlib.blake2b(str.encode(serialized), digest_size=16).hexdigest()
+
+
+def score_bound(value) -> Tuple[float, bool]:
+    """ Parse a redis style score bound (a number, `-inf`, `+inf` or `(` for exclusive). Returns (score, exclusive). """
+    if isinstance(value, bytes):
+        value = value.decode("utf-8")
+    if isinstance(value, str) and value.startswith("("):
+        return float(value[1:]), True
+    return float(value), False
+
+
+class BoundKey(dict):
+    """
+        A validated query with its storage key worked out once. Made by `Helpers.bind`.
+
+        Processors and connections take it anywhere a query goes, and `generate_hash` hands back the stored hash instead of hashing again.
+        It's read only, so everyone holding it sees the same key. `copy` gives back a plain dict to change.
+    """
+    __slots__ = ("hash", "scheme")
+
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("A bound key is read only. Copy it into a dict first.")
+
+    __setitem__ = __delitem__ = __ior__ = update = pop = popitem = setdefault = clear = _read_only
+
+    def __copy__(self) -> dict:
+        return dict(self)
+
+    def __deepcopy__(self, memo) -> dict:
+        return copy(dict(self))
+
+    def __reduce__(self):
+        return (dict, (dict(self),))
+
+    @property
+    def rlist(self) -> str:
+        return f"{self.hash}:rlist"
+
+    @property
+    def alist(self) -> str:
+        return f"{self.hash}:alist"
+
+    @property
+    def single(self) -> str:
+        return f"{self.hash}:single"
+
+    @property
+    def lock(self) -> str:
+        return f"{self.hash}:lock"
+
 
 class Helpers(object):
+    """
+        Helper functions.
+
+        `key_scheme` decides how queries become storage keys for every instance in the process:
+
+        * `base64` - base64 of the sorted query json. Reversible, but grows with the query (default).
+        * `digest` - a 32 character blake2b digest of the sorted query json. Set `key_lookup` to keep a digest -> query hash in redis.
+
+        Both are memoized by the query json. Move old keys over with `migrations.migrate_keys_to_digest` before switching.
+    """
+    key_scheme = "base64"
+    key_lookup = True
+
     def __init__(self) -> None:
         pass
 
+    @classmethod
+    def set_key_scheme(cls, scheme: str, lookup: bool = True):
+        if scheme not in ["base64", "digest"]:
+            raise ValueError("The key scheme must either be 'base64' or 'digest'")
+        cls.key_scheme = scheme
+        cls.key_lookup = lookup
+
     def generate_hash(self, query: dict) -> str:
-        _hash = ujson.dumps(query, sort_keys=True)
-        _hash = base64.b64encode(str.encode(_hash))
-        _hash = _hash.decode("utf-8")
-        return _hash
-
-    def hash_to_dict(self, _hash: str) -> str:
-        # TODO: Convert Hash To Dict
-        # NOTE: Not tested. Please make sure to test it
+        if type(query) is BoundKey and query.scheme == Helpers.key_scheme:
+            return query.hash
+        serialized = ujson.dumps(query, sort_keys=True)
+        if Helpers.key_scheme == "digest":
+            return digest_key(serialized)
+        return base64_key(serialized)
+
+    def bind(self, query: dict) -> BoundKey:
+        """ Hash a query once. Returns it as a `BoundKey`. Raises a ValueError if the query isn't valid. """
+        if type(query) is BoundKey and query.scheme == Helpers.key_scheme:
+            return query
+        if not self.validate_query(query):
+            raise ValueError("The query isn't correct")
+        bound = BoundKey(query)
+        bound.scheme = Helpers.key_scheme
+        bound.hash = self.generate_hash(dict(query))
+        return bound
+
+    def is_digest(self, _hash: str) -> bool:
+        """ Digest keys are 32 hex characters. A base64 key always starts with `ey` (an encoded `{"`), so they can't collide. """
+        if len(_hash) != 32:
+            return False
+        try:
+            int(_hash, 16)
+        except ValueError:
+            return False
+        return True
+
+    def hash_to_dict(self, _hash: str, connection=None) -> dict:
+        """ Turn a key back into its query. Digest keys need a redis connection to read the lookup hash. """
+        if self.is_digest(_hash):
+            if connection is None:
+                raise AttributeError("A redis connection is needed to look up a digest key")
+            serialized = connection.hget(KEY_LOOKUP, _hash)
+            if serialized is None:
+                return {}
+            return ujson.loads(serialized)
         __hash = base64.b64decode(_hash).decode("utf-8")
         _hash_json = ujson.loads(__hash)
         return _hash_json
@@ -177,7 +294,7 @@ class Helpers(object):
     def deserialize_dicts(self, dictified: dict):
         _deserialized = []
         for key, value in dictified.items():
-            _key = orjson.loads(key)
+            _key = single_one(key)
             _key["time"] = value.get("time", maya.now()._epoch)
             _key["timestamp"] = value.get("timestamp", maya.now()._epoch)
             _deserialized.append(_key)
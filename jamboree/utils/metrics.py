@@ -0,0 +1,56 @@
+"""
+    # Metrics
+
+    Thread safe, in-process counters and timings.
+    Connections and processors keep one of these so we can see contention, trims, waits, etc. without a metrics server.
+"""
+import threading
+from collections import defaultdict
+from typing import Dict, Union
+
+
+class Metrics(object):
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Union[int, float]] = defaultdict(int)
+        self._timings: Dict[str, list] = {}
+
+    def incr(self, name: str, amount: Union[int, float] = 1):
+        with self._lock:
+            self._counters[name] += amount
+
+    def gauge(self, name: str, value: Union[int, float]):
+        with self._lock:
+            self._counters[name] = value
+
+    def timing(self, name: str, seconds: float):
+        """ Record a duration. We keep the count, total and max. """
+        with self._lock:
+            current = self._timings.get(name, [0, 0.0, 0.0])
+            current[0] += 1
+            current[1] += seconds
+            current[2] = max(current[2], seconds)
+            self._timings[name] = current
+
+    def get(self, name: str) -> Union[int, float]:
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def snapshot(self) -> dict:
+        """ Get a copy of every counter and timing. """
+        with self._lock:
+            timings = {
+                name: {
+                    "count": count,
+                    "total": total,
+                    "max": _max,
+                    "mean": (total / count) if count else 0.0,
+                }
+                for name, (count, total, _max) in self._timings.items()
+            }
+            return {"counters": dict(self._counters), "timings": timings}
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._timings.clear()
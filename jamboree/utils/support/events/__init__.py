@@ -0,0 +1,5 @@
+from .cereal import serialize_df, deserialize_df
+from .cereal import (
+    CODEC_KEY, SCHEMA_KEY, SCHEMAS, Codec, JSONCodec, MsgpackCodec, Schema, StructCodec,
+    bulk_serialize, bulk_unserialize, get_codec, single_one
+)
@@ -2,16 +2,362 @@
     # Serialization commands
 
     JSON serialization functions specically tailored to the events segment of the code base
+
+    ## Event codecs
+    ---
+    An event's zset member is its payload. Every codec writes members a reader can tell apart by their first byte,
+    so `unserialize` never needs to know which codec wrote a member:
+
+    * `json` - orjson, the default. Members start with `{`.
+    * `msgpack` - a msgpack map. Smaller and faster for numeric events. Needs `msgpack` installed.
+    * `struct` - fixed typed fields packed back to back after a 9 byte header (a marker byte and the schema id).
+      The field names and kinds live once in a `Schema`. Numbers are read back as their declared kind (an int in a float field comes back a float).
+      Anything an event has outside of its schema is kept as a json tail, and an event that can't be packed
+      (a missing field, a value of another kind) is written as json instead.
+
+    Schemas are content addressed. The same fields always get the same id, so any process that knows a schema decodes it.
+    Connections store theirs and register a loader, so a reader fetches an unknown schema the first time it sees it.
 """
+import datetime
+import hashlib
+import struct
+import threading
+import weakref
+from typing import Any, Callable, Dict, List, Optional
+
+import lz4.frame
+import numpy as np
+import orjson
+import pandas as pd
+
+# Numeric, boolean and datetime columns are stored as raw typed buffers. Everything else goes through orjson.
+TYPED_KINDS = "biufcmM"
+
+# Redis hash of entity -> codec spec, and of schema id -> fields. Shared by every process using the same database.
+CODEC_KEY = "jamboree:codecs"
+SCHEMA_KEY = "jamboree:schemas"
+
+STRUCT_MARKER = 0x01
+FIELD_FORMATS = {"float": "d", "int": "q", "bool": "?"}
+FIELD_DTYPES = {"float": "<f8", "int": "<i8", "bool": "?"}
+
+
+def _msgpack():
+    try:
+        import msgpack
+    except ImportError:
+        raise ImportError("The msgpack codec needs msgpack installed. Install it with `pip install jamboree[msgpack]`.")
+    return msgpack
+
+
+def _msgpack_default(obj):
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    raise TypeError(f"Can't serialize {type(obj)} with msgpack")
+
+
+class Schema(object):
+    """ 
+        The ordered fields of an event and their kinds (`float`, `int`, `bool` or `str`).
+        
+        ```
+            Schema({"open": "float", "close": "float", "volume": "int", "asset": "str"})
+        ```
+    """
+
+    def __init__(self, fields: Dict[str, str]) -> None:
+        if len(fields) == 0:
+            raise ValueError("A schema needs at least one field")
+        for name, kind in fields.items():
+            if kind not in ["float", "int", "bool", "str"]:
+                raise ValueError(f"The kind of '{name}' must be one of 'float', 'int', 'bool' or 'str'")
+        self.fields = dict(fields)
+        self.numeric = [name for name, kind in self.fields.items() if kind != "str"]
+        self.strings = [name for name, kind in self.fields.items() if kind == "str"]
+        self.flags = [name for name, kind in self.fields.items() if kind == "bool"]
+        self.packer = struct.Struct("<" + "".join(FIELD_FORMATS[self.fields[name]] for name in self.numeric))
+        # The same layout as a numpy record (header included), to read many members as columns
+        self.dtype = np.dtype([("\0header", "V9")] + [(name, FIELD_DTYPES[self.fields[name]]) for name in self.numeric])
+        self.id = hashlib.sha1(orjson.dumps(self.fields)).digest()[:8]
+
+    @property
+    def hex(self) -> str:
+        return self.id.hex()
+
+    def to_dict(self) -> dict:
+        return dict(self.fields)
+
+    def __repr__(self) -> str:
+        return f"Schema({orjson.dumps(self.fields).decode('utf-8')})"
+
+
+class SchemaRegistry(object):
+    """ Every schema this process knows, by id. Unknown ids are asked of the loaders (one per live connection). """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._schemas: Dict[bytes, Schema] = {}
+        self._loaders: List[weakref.WeakMethod] = []
+
+    def add(self, schema: Schema) -> Schema:
+        with self._lock:
+            return self._schemas.setdefault(schema.id, schema)
+
+    def add_loader(self, loader: Callable[[str], Optional[dict]]):
+        """ Add a bound method that returns the fields of a schema id (hex), or None. Only a weak reference is kept. """
+        with self._lock:
+            self._loaders = [ref for ref in self._loaders if ref() is not None]
+            self._loaders.append(weakref.WeakMethod(loader))
+
+    def get(self, schema_id: bytes) -> Schema:
+        schema = self._schemas.get(schema_id)
+        if schema is not None:
+            return schema
+        for ref in list(self._loaders):
+            loader = ref()
+            if loader is None:
+                continue
+            try:
+                fields = loader(schema_id.hex())
+            except Exception:
+                continue
+            if fields is not None:
+                return self.add(Schema(fields))
+        raise ValueError(f"Unknown event schema {schema_id.hex()}. Register it with `set_codec` first.")
+
+
+SCHEMAS = SchemaRegistry()
+
+
+class Codec(object):
+    name = ""
+
+    def encode(self, event: dict) -> bytes:
+        raise NotImplementedError
+
+    def decode(self, member: bytes) -> dict:
+        raise NotImplementedError
+
+    def to_dict(self) -> dict:
+        return {"codec": self.name}
+
+
+class JSONCodec(Codec):
+    name = "json"
+
+    def encode(self, event: dict) -> bytes:
+        return orjson.dumps(event, option=orjson.OPT_SERIALIZE_NUMPY)
+
+    def decode(self, member: bytes) -> dict:
+        return orjson.loads(member)
+
+
+class MsgpackCodec(Codec):
+    name = "msgpack"
+
+    def __init__(self) -> None:
+        self.msgpack = _msgpack()
+
+    def encode(self, event: dict) -> bytes:
+        return self.msgpack.packb(event, use_bin_type=True, default=_msgpack_default)
+
+    def decode(self, member: bytes) -> dict:
+        return self.msgpack.unpackb(member, raw=False, strict_map_key=False)
+
+
+class StructCodec(Codec):
+    name = "struct"
+
+    def __init__(self, schema: Schema) -> None:
+        self.schema = SCHEMAS.add(schema)
+        self.header = bytes([STRUCT_MARKER]) + self.schema.id
+
+    def encode(self, event: dict) -> bytes:
+        schema = self.schema
+        try:
+            parts = [self.header, schema.packer.pack(*[event[name] for name in schema.numeric])]
+            for name in schema.strings:
+                raw = event[name].encode("utf-8")
+                parts.append(struct.pack("<H", len(raw)))
+                parts.append(raw)
+        except (KeyError, AttributeError, struct.error):
+            # A missing field, a value that isn't its kind, an int past 64 bits or a string past 64KB
+            return orjson.dumps(event, option=orjson.OPT_SERIALIZE_NUMPY)
+        for name in schema.flags:
+            if not isinstance(event[name], (bool, np.bool_)):
+                return orjson.dumps(event, option=orjson.OPT_SERIALIZE_NUMPY)
+        if len(event) > len(schema.fields):
+            fields = schema.fields
+            extras = {key: value for key, value in event.items() if key not in fields}
+            parts.append(orjson.dumps(extras, option=orjson.OPT_SERIALIZE_NUMPY))
+        return b"".join(parts)
+
+    def decode(self, member: bytes) -> dict:
+        return _unpack_struct(member)
+
+    def to_dict(self) -> dict:
+        return {"codec": self.name, "schema": self.schema.hex, "fields": self.schema.to_dict()}
+
+
+def _unpack_struct(member: bytes) -> dict:
+    schema = SCHEMAS.get(bytes(member[1:9]))
+    offset = 9
+    event = dict(zip(schema.numeric, schema.packer.unpack_from(member, offset)))
+    offset += schema.packer.size
+    for name in schema.strings:
+        size = struct.unpack_from("<H", member, offset)[0]
+        offset += 2
+        event[name] = bytes(member[offset:offset + size]).decode("utf-8")
+        offset += size
+    if offset < len(member):
+        event.update(orjson.loads(member[offset:]))
+    return event
+
+
+JSON = JSONCodec()
+
+
+def get_codec(spec: Optional[dict] = None) -> Codec:
+    """ Build a codec from its spec (`{"codec": "struct", "fields": {...}}`). No spec is the json codec. """
+    if spec is None:
+        return JSON
+    name = spec.get("codec", "json")
+    if name == "json":
+        return JSON
+    if name == "msgpack":
+        return MsgpackCodec()
+    if name == "struct":
+        return StructCodec(Schema(spec["fields"]))
+    raise ValueError("The codec must be one of 'json', 'msgpack' or 'struct'")
+
+
+def single_one(member: bytes) -> dict:
+    """ Decode one event member, whichever codec wrote it. """
+    first = member[0]
+    if first == 0x7B:
+        return orjson.loads(member)
+    if first == STRUCT_MARKER:
+        return _unpack_struct(member)
+    # Every other codec byte is the start of a msgpack map
+    return _msgpack().unpackb(member, raw=False, strict_map_key=False)
+
+def bulk_serialize(events: List[Dict[str, Any]], codec: Optional[Codec] = None) -> List[bytes]:
+    """ Encode many events with one codec (json by default). """
+    codec = codec or JSON
+    return [codec.encode(event) for event in events]
+
+def bulk_unserialize(members: List[bytes]) -> List[Dict[str, Any]]:
+    """ Decode many event members. A batch of json members is parsed in a single orjson call. """
+    if len(members) == 0:
+        return []
+    if all(member[0] == 0x7B for member in members):
+        return orjson.loads(b"[" + b",".join(members) + b"]")
+    return [single_one(member) for member in members]
+
+def bulk_columns(members: List[bytes]) -> Optional[Dict[str, Any]]:
+    """ 
+        Decode many struct members of one schema into a column per field, with no dict per event.
+        The packed fields of every member are read as one numpy record array. Json tails (the query fields, usually) 
+        are parsed once when they're all the same, and in one orjson call when they aren't.
+        Returns None for anything else (json or msgpack members, mixed schemas, string fields).
+    """
+    if len(members) == 0 or members[0][0] != STRUCT_MARKER:
+        return None
+    header = bytes(members[0][:9])
+    schema = SCHEMAS.get(header[1:])
+    size = schema.dtype.itemsize
+    if len(schema.strings) > 0 or min(map(len, members)) < size:
+        return None
+    records = np.frombuffer(b"".join([member[:size] for member in members]), dtype=schema.dtype)
+    if not np.all(records["\0header"] == np.void(header)):
+        return None
+    columns: Dict[str, Any] = {name: records[name].copy() for name in schema.numeric}
+
+    tails = [member[size:] for member in members]
+    distinct = set(tails)
+    if len(distinct) == 1:
+        tail = distinct.pop()
+        for name, value in (orjson.loads(tail) if tail else {}).items():
+            columns[name] = [value] * len(members)
+        return columns
+    extras = pd.DataFrame.from_records(orjson.loads(b"[" + b",".join([tail or b"{}" for tail in tails]) + b"]"))
+    for name in extras.columns:
+        columns[name] = extras[name].to_numpy()
+    return columns
+
+def _json_default(value):
+    """ orjson only takes plain datetimes. Hand it pandas timestamps as those, and missing times as nulls. """
+    if value is pd.NaT:
+        return None
+    if isinstance(value, pd.Timestamp):
+        return value.to_pydatetime()
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+def _tz_tag(tz):
+    """ A timezone as something json keeps: its name, or its offset in seconds for a fixed offset. """
+    name = getattr(tz, "zone", None) or getattr(tz, "key", None)
+    if name is not None:
+        return name
+    offset = tz.utcoffset(None)
+    if offset is not None:
+        return int(offset.total_seconds())
+    return str(tz)
 
-def single_one():
-    pass
+def _tz_from_tag(tag):
+    if isinstance(tag, int):
+        return datetime.timezone(datetime.timedelta(seconds=tag))
+    return tag
 
-def bulk_serialize():
-    pass
+def serialize_df(frame: pd.DataFrame) -> bytes:
+    """
+        Pack a dataframe into typed column arrays and compress them.
 
-def bulk_unserialize():
-    pass
+        The layout is a small orjson header (row count, column names, dtypes and byte sizes) followed by each column's buffer.
+        Timezone aware times are stored as UTC epochs with their timezone in the header.
+        Other columns of python objects are stored as json, with timestamps as ISO strings.
+        The index isn't kept. Put anything you need from it into a column first.
+    """
+    header = {"rows": len(frame), "columns": []}
+    buffers = []
+    for name, column in frame.items():
+        if isinstance(column.dtype, pd.DatetimeTZDtype):
+            values = column.dt.tz_convert("UTC").dt.tz_localize(None).to_numpy()
+            raw = np.ascontiguousarray(values).tobytes()
+            header["columns"].append([str(name), values.dtype.str, len(raw), _tz_tag(column.dt.tz)])
+            buffers.append(raw)
+            continue
+        values = column.to_numpy()
+        if values.dtype.kind in TYPED_KINDS:
+            raw = np.ascontiguousarray(values).tobytes()
+            header["columns"].append([str(name), values.dtype.str, len(raw)])
+        else:
+            raw = orjson.dumps(
+                values.tolist(), default=_json_default, option=orjson.OPT_SERIALIZE_NUMPY
+            )
+            header["columns"].append([str(name), "json", len(raw)])
+        buffers.append(raw)
+    head = orjson.dumps(header)
+    packed = struct.pack("<I", len(head)) + head + b"".join(buffers)
+    return lz4.frame.compress(packed)
 
-def serialize_df():
-    pass
\ No newline at end of file
+def deserialize_df(blob: bytes) -> pd.DataFrame:
+    """ Reverse `serialize_df`. The columns are writable copies, not views of the blob. """
+    packed = lz4.frame.decompress(blob)
+    head_size = struct.unpack_from("<I", packed)[0]
+    offset = 4 + head_size
+    header = orjson.loads(packed[4:offset])
+    columns = {}
+    for name, dtype, size, *tz in header["columns"]:
+        raw = packed[offset:offset + size]
+        offset += size
+        if dtype == "json":
+            columns[name] = orjson.loads(raw)
+            continue
+        values = np.frombuffer(raw, dtype=np.dtype(dtype)).copy()
+        if tz:
+            columns[name] = pd.Series(values).dt.tz_localize("UTC").dt.tz_convert(_tz_from_tag(tz[0]))
+        else:
+            columns[name] = values
+    return pd.DataFrame(columns, index=pd.RangeIndex(header["rows"]))
@@ -0,0 +1,76 @@
+"""
+    # Event Codec Benchmark
+    ---
+    Compares member size, encode and decode speed of the `json`, `msgpack` and `struct` event codecs.
+
+    Runs in process. No redis needed. The msgpack codec is skipped when msgpack isn't installed.
+
+    ```
+        python scripts/benchmarks/event_codecs.py --events 100000
+    ```
+"""
+import argparse
+import time
+import uuid
+
+from loguru import logger
+
+from jamboree.utils.support.events.cereal import (
+    JSONCodec, MsgpackCodec, Schema, StructCodec, bulk_serialize, bulk_unserialize
+)
+
+FIELDS = {
+    "type": "str",
+    "asset": "str",
+    "open": "float",
+    "high": "float",
+    "low": "float",
+    "close": "float",
+    "volume": "int",
+}
+
+
+def make_events(count: int) -> list:
+    return [
+        {
+            "type": "price",
+            "asset": "BTC",
+            "open": 100.0 + i,
+            "high": 101.5 + i,
+            "low": 99.25 + i,
+            "close": 100.75 + i,
+            "volume": 1000 + i,
+            "event_id": uuid.uuid4().hex,
+        }
+        for i in range(count)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--events", type=int, default=100000)
+    args = parser.parse_args()
+
+    events = make_events(args.events)
+    codecs = [JSONCodec(), StructCodec(Schema(FIELDS))]
+    try:
+        codecs.insert(1, MsgpackCodec())
+    except ImportError as e:
+        logger.warning(e)
+
+    for codec in codecs:
+        start = time.perf_counter()
+        members = bulk_serialize(events, codec)
+        encoded = time.perf_counter() - start
+        start = time.perf_counter()
+        bulk_unserialize(members)
+        decoded = time.perf_counter() - start
+        size = sum(len(member) for member in members) / len(members)
+        logger.info(
+            f"{codec.name:>8} | {size:>6.1f} bytes/event | encode: {args.events / encoded:>10.0f} events/sec "
+            f"| decode: {args.events / decoded:>10.0f} events/sec"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+    # Handler Memory Benchmark
+    ---
+    Reports the memory each `DataHandler` of a large universe holds, measured with `tracemalloc`.
+
+    * `lazy` - handlers as they're created now. The time, metadata and search handlers and the preprocessor aren't built yet.
+    * `eager` - every sub-handler built up front, the way handlers used to be created.
+    * `forked` - handlers forked from one template, sharing its sub-handlers.
+
+    Runs in process. No redis needed.
+
+    ```
+        python scripts/benchmarks/handler_memory.py --handlers 5000
+    ```
+"""
+import argparse
+import gc
+import tracemalloc
+
+from loguru import logger
+
+from jamboree.handlers.abstracted.search import MetadataSearchHandler
+from jamboree.handlers.complex.meta import MetaHandler
+from jamboree.handlers.default import DataHandler, TimeHandler
+from jamboree.handlers.processors import DynamicResample
+
+
+def lazy(index: int, template: DataHandler) -> DataHandler:
+    handler = DataHandler()
+    handler["name"] = f"ASSET{index}"
+    return handler
+
+
+def eager(index: int, template: DataHandler) -> DataHandler:
+    handler = lazy(index, template)
+    handler.time = TimeHandler()
+    handler.preprocessor = DynamicResample("data")
+    handler._meta = MetaHandler()
+    handler._meta._search = MetadataSearchHandler()
+    handler._metasearch = MetadataSearchHandler()
+    return handler
+
+
+def forked(index: int, template: DataHandler) -> DataHandler:
+    return template.fork(name=f"ASSET{index}")
+
+
+def measure(build, count: int) -> float:
+    """ The bytes allocated per handler while building `count` of them. """
+    template = DataHandler()
+    gc.collect()
+    tracemalloc.start()
+    start, _ = tracemalloc.get_traced_memory()
+    handlers = [build(index, template) for index in range(count)]
+    end, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del handlers
+    return (end - start) / count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--handlers", type=int, default=5000)
+    args = parser.parse_args()
+
+    for build in (eager, lazy, forked):
+        size = measure(build, args.handlers)
+        logger.info(
+            f"{build.__name__:>6} | {size:>9.0f} bytes/handler | {size * args.handlers / 2**20:>8.1f} MiB for {args.handlers} handlers"
+        )
+
+
+if __name__ == "__main__":
+    main()
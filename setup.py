@@ -83,6 +83,11 @@ setup(
         "cerberus",
         "addict",
     ],
+    extras_require={
+        "async": ["aioredis>=2.0.0"],
+        "cold": ["pyarrow>=1.0.0"],
+        "msgpack": ["msgpack>=1.0.0"],
+    },
     packages=find_packages(),
     classifiers=[
         "Programming Language :: Python :: 3",
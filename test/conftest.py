@@ -0,0 +1,37 @@
+import pytest
+
+from jamboree import Jamboree
+
+# (write mode, layout) pairs of the redis connection. Each runs the lua scripts of its path.
+REDIS_MODES = [("lock", "dual"), ("script", "dual"), ("lock", "single"), ("script", "single")]
+
+
+def fake_redis():
+    """ An in process redis. The event scripts need lupa to run, so both have to be installed. """
+    fakeredis = pytest.importorskip("fakeredis")
+    pytest.importorskip("lupa")
+    return fakeredis.FakeRedis()
+
+
+def redis_processor(write_mode: str = "lock", layout: str = "dual", read_mode: str = "watch") -> Jamboree:
+    jam = Jamboree(WRITE_MODE=write_mode, LAYOUT=layout, READ_MODE=read_mode)
+    rconn = fake_redis()
+    jam.event.rconn = rconn
+    jam.event.initialize()
+    jam.event.redis_conn.write_mode = write_mode
+    jam.event.redis_conn.layout = layout
+    jam.event.redis_conn.read_mode = read_mode
+    jam.storage.rconn = rconn
+    jam.storage.initialize()
+    return jam
+
+
+@pytest.fixture(params=["memory", "sqlite"] + [f"redis-{mode}-{layout}" for mode, layout in REDIS_MODES])
+def processor(request, tmp_path):
+    """ A processor on every backend. Redis runs on fakeredis and is skipped without it. """
+    if request.param == "sqlite":
+        return Jamboree(BACKEND="sqlite", SQLITE_PATH=str(tmp_path / "jamboree.db"))
+    if request.param == "memory":
+        return Jamboree(BACKEND="memory")
+    _, write_mode, layout = request.param.split("-")
+    return redis_processor(write_mode, layout)
@@ -0,0 +1,63 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+
+from jamboree.utils.support.events.cereal import (
+    bulk_columns, bulk_serialize, bulk_unserialize, deserialize_df, get_codec, serialize_df
+)
+
+
+def test_codecs_round_trip():
+    events = [{"price": 1.5, "size": 2, "name": "a"}, {"price": 2.5, "size": 3, "name": "b"}]
+    for spec in [{"name": "json"}, {"name": "struct", "fields": {"price": "float", "size": "int"}}]:
+        members = bulk_serialize(events, get_codec(spec))
+        assert bulk_unserialize(members) == events
+
+
+def test_struct_members_decode_to_columns():
+    codec = get_codec({"codec": "struct", "fields": {"price": "float", "size": "int", "up": "bool"}})
+    events = [{"price": i * 0.5, "size": i, "up": i % 2 == 0, "type": "bar"} for i in range(10)]
+    events[3]["note"] = "tail"
+    members = bulk_serialize(events, codec)
+    columns = bulk_columns(members)
+    pd.testing.assert_frame_equal(pd.DataFrame(columns), pd.DataFrame.from_records(bulk_unserialize(members)))
+    assert columns["size"].dtype == np.int64
+    assert bulk_columns(bulk_serialize(events)) is None
+
+
+def test_frame_round_trip():
+    frame = pd.DataFrame({
+        "time": np.arange(5.0),
+        "volume": np.arange(5),
+        "naive": pd.date_range("2020-01-01", periods=5, freq="h"),
+        "label": ["a", "b", None, "d", "e"],
+    })
+    restored = deserialize_df(serialize_df(frame))
+    pd.testing.assert_frame_equal(restored, frame)
+
+
+def test_frame_keeps_timezones():
+    times = pd.date_range("2020-03-08", periods=5, freq="h", tz="America/New_York")
+    frame = pd.DataFrame({
+        "named": times,
+        "offset": times.tz_convert(datetime.timezone(datetime.timedelta(hours=-3))),
+    })
+    restored = deserialize_df(serialize_df(frame))
+    pd.testing.assert_series_equal(restored["named"], frame["named"])
+    assert str(restored["named"].dt.tz) == "America/New_York"
+    assert (restored["offset"] == frame["offset"]).all()
+    assert restored["offset"].iloc[0].utcoffset() == datetime.timedelta(hours=-3)
+
+
+def test_frame_object_timestamps():
+    frame = pd.DataFrame({"mixed": [pd.Timestamp("2020-01-01"), pd.NaT, 1.5]})
+    restored = deserialize_df(serialize_df(frame))
+    assert restored["mixed"].tolist() == ["2020-01-01T00:00:00", None, 1.5]
+
+
+def test_frame_columns_are_writable():
+    restored = deserialize_df(serialize_df(pd.DataFrame({"close": np.arange(3.0)})))
+    assert restored["close"].to_numpy().flags.writeable
+    restored.iloc[0, 0] = 10.0
+    assert restored["close"].tolist() == [10.0, 1.0, 2.0]
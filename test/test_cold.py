@@ -0,0 +1,33 @@
+import multiprocessing
+
+import pytest
+
+pytest.importorskip("pyarrow")
+
+from jamboree.storage.databases.cold import ColdStore
+
+
+def write(root, worker, count=10):
+    store = ColdStore(root)
+    for i in range(count):
+        event = {"v": float(i), "time": float(worker * 100 + i), "timestamp": 1.0}
+        entry = store.write("key", [event], [f"{worker}-{i}"], 0.0)
+        store._done("key", entry)
+
+
+def test_manifest_follows_other_stores(tmp_path):
+    reader = ColdStore(str(tmp_path))
+    assert reader.count("key") == 0
+    write(str(tmp_path), 0, count=3)
+    assert reader.count("key") == 3
+    write(str(tmp_path), 1, count=2)
+    assert reader.count("key") == 5
+
+
+def test_concurrent_processes_keep_every_file(tmp_path):
+    workers = [multiprocessing.Process(target=write, args=(str(tmp_path), n)) for n in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert ColdStore(str(tmp_path)).count("key") == 40
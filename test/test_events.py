@@ -0,0 +1,173 @@
+import pytest
+
+TIERS = ["1m", "1h", "1d"]
+
+
+def fill(event, query, count, step=37.0):
+    for i in range(count):
+        event.save(query, {"v": float(i), "time": 1000.0 + step * i})
+
+
+def rollups(event, query):
+    return event.get_rollups_between(query, 0, 1e9, TIERS)
+
+
+def assert_rollups_rebuilt(event, query):
+    """ The incrementally kept rollups match a rebuild from scratch. """
+    kept = rollups(event, query)
+    event.rebuild_rollups(query)
+    assert kept == rollups(event, query)
+
+
+def test_save_and_read(processor):
+    event = processor.event
+    query = {"type": "bar", "name": "save"}
+    fill(event, query, 10)
+    assert event.count(query) == 10
+    assert event.get_latest(query, abs_rel="relative")["v"] == 9.0
+    between = event.get_between(query, 1000.0 + 37 * 2, 1000.0 + 37 * 4, abs_rel="relative")
+    assert [item["v"] for item in between] == [2.0, 3.0, 4.0]
+
+
+def test_delete(processor):
+    event = processor.event
+    query = {"type": "bar", "name": "delete"}
+    fill(event, query, 5)
+    event._remove(query, dict(query, v=2.0))
+    assert event.count(query) == 4
+    assert 2.0 not in [item["v"] for item in event.get_all(query)]
+    event.delete_all(query)
+    assert event.count(query) == 0
+
+
+def test_stats(processor):
+    event = processor.event
+    query = {"type": "bar", "name": "stats"}
+    assert event.stats(query).get("count", 0) == 0
+    fill(event, query, 5)
+    stats = event.stats(query)
+    assert stats["count"] == 5
+    assert stats["min_time"] == 1000.0
+    assert stats["max_time"] == 1000.0 + 37 * 4
+    event._remove(query, dict(query, v=4.0))
+    stats = event.stats(query)
+    assert stats["count"] == 4
+    assert stats["max_time"] == 1000.0 + 37 * 3
+
+
+def test_retention_trims_oldest(processor):
+    event = processor.event
+    query = {"type": "capped", "name": "trim"}
+    event.set_retention("capped", max_len=3)
+    fill(event, query, 5)
+    assert event.count(query) == 3
+    assert [item["v"] for item in event.get_all(query)] == [2.0, 3.0, 4.0]
+    assert event.stats(query)["min_time"] == 1000.0 + 37 * 2
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 4, 100])
+def test_paging_keeps_ties(processor, chunk_size):
+    """ Events sharing a time across a page boundary are neither dropped nor repeated. """
+    event = processor.event
+    query = {"type": "bar", "name": "ties"}
+    for i in range(10):
+        event.save(query, {"v": float(i), "time": 1000.0 + (i // 4)})
+    pages = list(event.iter_all(query, chunk_size=chunk_size))
+    assert all(len(page) <= chunk_size for page in pages)
+    values = [item["v"] for page in pages for item in page]
+    assert sorted(values) == [float(i) for i in range(10)]
+
+
+def test_rollups_follow_deletes(processor):
+    event = processor.event
+    query = {"type": "bar", "name": "rollup-delete"}
+    fill(event, query, 200)
+    event.update_rollups(query, 1000.0, 1000.0 + 37 * 199)
+    assert len(rollups(event, query)) > 0
+    event._remove(query, dict(query, v=5.0))
+    assert_rollups_rebuilt(event, query)
+    with event.batch():
+        event._remove(query, dict(query, v=7.0))
+    assert_rollups_rebuilt(event, query)
+
+
+def test_rollups_follow_trims(processor):
+    event = processor.event
+    query = {"type": "rolled", "name": "rollup-trim"}
+    fill(event, query, 200)
+    event.update_rollups(query, 1000.0, 1000.0 + 37 * 199)
+    assert len(rollups(event, query)) > 0
+    event.set_retention("rolled", max_len=100)
+    event.save(query, {"v": 200.0, "time": 1000.0 + 37 * 200})
+    event.update_rollups(query, 1000.0 + 37 * 200, 1000.0 + 37 * 200)
+    assert event.count(query) == 100
+    assert_rollups_rebuilt(event, query)
+
+
+def test_batch_commits_together(processor):
+    event = processor.event
+    first = {"type": "acct", "name": "a"}
+    second = {"type": "acct", "name": "b"}
+    with event.batch():
+        event.save(first, {"v": 1.0, "time": 1.0})
+        event.save(second, {"v": 1.0, "time": 1.0})
+        event.save(second, {"v": 2.0, "time": 2.0})
+    assert event.count(first) == 1
+    assert event.count(second) == 2
+
+
+def test_batch_rolls_back_on_error(processor):
+    event = processor.event
+    query = {"type": "acct", "name": "rollback"}
+    event.save(query, {"v": 1.0, "time": 1.0})
+    with pytest.raises(RuntimeError):
+        with event.batch():
+            event.save(query, {"v": 2.0, "time": 2.0})
+            event._remove(query, dict(query, v=1.0))
+            raise RuntimeError("step failed")
+    assert event.count(query) == 1
+    assert event.get_latest(query, abs_rel="relative")["v"] == 1.0
+
+
+def test_batch_discard(processor):
+    event = processor.event
+    query = {"type": "acct", "name": "discard"}
+    batch = event.batch()
+    event.save(query, {"v": 1.0, "time": 1.0})
+    batch.discard()
+    assert event.count(query) == 0
+    event.save(query, {"v": 2.0, "time": 2.0})
+    assert event.count(query) == 1
+
+
+def test_cached_single_values_are_copies(processor):
+    event = processor.event
+    event.enable_cache()
+    query = {"type": "acct", "name": "single"}
+    missing = event.single_get(query)
+    missing["changed"] = True
+    assert event.single_get(query) == {}
+    event.single_set(query, {"v": 1.0})
+    value = event.single_get(query)
+    value["v"] = 2.0
+    assert event.single_get(query) == {"v": 1.0}
+    event.disable_cache()
+
+
+def test_reads_merge_the_cold_tier(processor, tmp_path):
+    pytest.importorskip("pyarrow")
+    event = processor.event
+    query = {"type": "bar", "name": "cold"}
+    fill(event, query, 40, step=1.0)
+    event.enable_tiering(str(tmp_path / "cold"), hot_window=10, rows_per_file=15)
+    assert event.spill(query) > 0
+    everything = [float(i) for i in range(40)]
+    _hash = event.helpers.generate_hash(query)
+    between = event.get_between_many([query], 1000.0, 1039.0, abs_rel="relative")[_hash]
+    assert [item["v"] for item in between] == everything
+    pages = list(event.iter_all(query, chunk_size=7))
+    assert [item["v"] for page in pages for item in page] == everything
+    assert event.get_latest_by(query, 1005.0, abs_rel="relative")["v"] == 5.0
+    assert event.min_time(query) == 1000.0
+    assert event.max_time(query) == 1039.0
+    event.disable_tiering()
@@ -0,0 +1,38 @@
+import asyncio
+import queue
+import threading
+
+import pytest
+
+from jamboree.utils.executor import Executor
+
+
+def test_submit_nowait_raises_when_full():
+    executor = Executor(max_workers=1, max_queue=0)
+    gate = threading.Event()
+    running = executor.submit(gate.wait)
+    with pytest.raises(queue.Full):
+        executor.submit_nowait(sum, [1, 2])
+    gate.set()
+    running.result()
+    assert executor.submit_nowait(sum, [1, 2]).result() == 3
+    assert executor.metrics.get("executor.full") == 1
+    executor.shutdown()
+
+
+def test_arun_waits_on_the_loop_while_full():
+    executor = Executor(max_workers=1, max_queue=0)
+    gate = threading.Event()
+    running = executor.submit(gate.wait)
+
+    async def run():
+        waiting = asyncio.ensure_future(executor.arun(sum, [1, 2]))
+        await asyncio.sleep(0.01)
+        assert not waiting.done()
+        gate.set()
+        return await waiting
+
+    assert asyncio.run(run()) == 3
+    running.result()
+    assert executor.metrics.get("executor.full") >= 1
+    executor.shutdown()
@@ -0,0 +1,76 @@
+import pytest
+
+from jamboree.handlers.default.db import DBHandler
+
+
+class AccountHandler(DBHandler):
+    def __init__(self):
+        super().__init__()
+        self.entity = "account"
+        self.required = {"name": str}
+
+
+@pytest.fixture
+def account(processor):
+    handler = AccountHandler()
+    handler.processor = processor
+    handler["name"] = "main"
+    return handler
+
+
+def test_save_and_last(account):
+    account.save({"balance": 100.0})
+    account.save({"balance": 90.0})
+    assert account.count() == 2
+    assert account.last()["balance"] == 90.0
+    assert account.stats()["count"] == 2
+
+
+def test_fork_is_isolated(account):
+    account.save({"balance": 100.0})
+    forked = account.fork(name="other")
+    forked.save({"balance": 5.0})
+    assert account["name"] == "main"
+    assert account.count() == 1
+    assert forked.count() == 1
+    assert account.last()["balance"] == 100.0
+    assert forked.last()["balance"] == 5.0
+
+
+def test_fork_copies_on_write(account):
+    account["shared"] = "before"
+    forked = account.fork()
+    assert forked.data is account.data
+    forked["extra"] = "set"
+    assert "extra" not in account.data
+    account["late"] = "set"
+    assert "late" not in forked.data
+    assert forked["shared"] == "before"
+
+
+def test_fork_keeps_processor(account):
+    forked = account.fork(name="other")
+    assert forked.processor is account.processor
+    assert forked.entity == account.entity
+
+
+def test_batch_across_handlers(account):
+    other = account.fork(name="other")
+    with account.batch(other):
+        account.save({"balance": 1.0})
+        other.save({"balance": 2.0})
+    assert account.count() == 1
+    assert other.count() == 1
+
+
+def test_batch_rollback_across_handlers(account):
+    other = account.fork(name="other")
+    account.save({"balance": 1.0})
+    with pytest.raises(ValueError):
+        with account.batch(other):
+            account.save({"balance": 2.0})
+            other.save({"balance": 3.0})
+            raise ValueError("step failed")
+    assert account.count() == 1
+    assert account.last()["balance"] == 1.0
+    assert other.count() == 0
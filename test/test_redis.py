@@ -0,0 +1,63 @@
+import pytest
+
+from conftest import REDIS_MODES, redis_processor
+from jamboree.storage.databases.migrations import migrate_to_single
+
+
+def fill(event, query, count, step=37.0):
+    for i in range(count):
+        event.save(query, {"v": float(i), "time": 1000.0 + step * i})
+
+
+def values(events):
+    return [item["v"] for item in events]
+
+
+def test_migrate_to_single():
+    event = redis_processor(layout="dual").event
+    query = {"type": "bar", "name": "migrate"}
+    fill(event, query, 25)
+    before = event.get_all(query)
+    moved = migrate_to_single(event.redis_conn, query, batch=10)
+    assert moved == 25
+    _hash = event.redis_conn.helpers.generate_hash(query)
+    assert not event.rconn.exists(f"{_hash}:rlist", f"{_hash}:alist")
+    event.redis_conn.layout = "single"
+    assert event.count(query) == 25
+    assert event.get_all(query) == before
+    event.save(query, {"v": 25.0, "time": 1000.0 + 37 * 25})
+    assert values(event.get_latest_many(query, limit=2, abs_rel="relative")) == [24.0, 25.0]
+
+
+@pytest.mark.parametrize("layout", ["dual", "single"])
+def test_snapshot_reads(layout):
+    event = redis_processor(layout=layout, read_mode="snapshot").event
+    query = {"type": "bar", "name": "snapshot"}
+    assert event.get_between(query, 0, 1e9, abs_rel="relative") == []
+    fill(event, query, 10)
+    between = event.get_between(query, 1000.0 + 37 * 2, 1000.0 + 37 * 4, abs_rel="relative")
+    assert values(between) == [2.0, 3.0, 4.0]
+    assert event.get_latest(query, abs_rel="relative")["v"] == 9.0
+    assert values(event.get_latest_many(query, limit=3, abs_rel="relative")) == [7.0, 8.0, 9.0]
+
+
+@pytest.mark.parametrize("write_mode, layout", REDIS_MODES)
+def test_max_age_trim(write_mode, layout):
+    event = redis_processor(write_mode, layout).event
+    query = {"type": "aged", "name": "trim"}
+    event.set_retention("aged", max_age=100.0, age_by="relative")
+    fill(event, query, 10, step=30.0)
+    # The newest event is at 1270, so everything before 1170 is gone
+    assert values(event.get_all(query)) == [6.0, 7.0, 8.0, 9.0]
+    assert event.stats(query)["min_time"] == 1180.0
+
+
+@pytest.mark.parametrize("write_mode, layout", REDIS_MODES)
+def test_paging_a_bounded_range(write_mode, layout):
+    event = redis_processor(write_mode, layout).event
+    query = {"type": "bar", "name": "pages"}
+    for i in range(20):
+        event.save(query, {"v": float(i), "time": 1000.0 + (i // 3)})
+    pages = list(event.iter_between(query, 1001.0, 1004.0, abs_rel="relative", chunk_size=2))
+    assert all(len(page) <= 2 for page in pages)
+    assert sorted(values([item for page in pages for item in page])) == [float(i) for i in range(3, 15)]